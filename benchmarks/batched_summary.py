@@ -0,0 +1,117 @@
+"""
+Compares per-hit and batched summarization of the top hits: total tokens, as reported in the completions'
+usage, and wall time per search. Runs against the local stubs by default, or against the real cluster and
+deployment with --live.
+
+    python benchmarks/batched_summary.py --runs 20
+    python benchmarks/batched_summary.py --live --searchtype Elser --runs 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import variables
+
+# Every run has to reach the deployment
+variables.answer_cache_path = None
+variables.embedding_cache_path = None
+
+import streamlit as st
+from elasticsearch import Elasticsearch
+
+from benchmarks.common import QUERIES, percentile
+from benchmarks.stubs import AzureOpenAIStubHandler, ElasticsearchStubHandler, StubConfig, StubServer
+from utils.cache_helper import get_answer_cache
+from utils.es_helper import create_es_client
+from utils.metrics_helper import metrics
+from utils.openai_helper import get_openai_client, get_openai_large_guidance
+from utils.ratelimit_helper import reset_rate_limiters, set_rate_limits
+from utils.query_helper import execute_search
+
+MODES = ["per_hit", "batched"]
+
+
+def counters():
+    snapshot = metrics.snapshot()["counters"]
+    tokens = sum(value for name, value in snapshot.items() if name.startswith("openai_tokens_"))
+    return tokens, snapshot.get("batched_summary_fallbacks", 0), snapshot.get("batched_summary_parse_failures", 0)
+
+
+def run_mode(es, client, mode, searchtype, num_results, runs):
+    # Every mode starts from full token buckets, so the earlier mode's usage does not show up as queueing
+    reset_rate_limiters()
+    samples = []
+    for i in range(runs):
+        user_query = QUERIES[i % len(QUERIES)]
+        get_answer_cache().memory.clear()
+        results = execute_search(es, user_query, searchtype, 1, 200, "summary")
+
+        tokens, fallbacks, parse_failures = counters()
+        start_time = time.time()
+        processed_results, _ = get_openai_large_guidance(user_query, results, num_results, searchtype,
+                                                         client=client, mode=mode)
+        wall = (time.time() - start_time) * 1000
+        after = counters()
+        samples.append({"wall": wall, "tokens": after[0] - tokens, "fallbacks": after[1] - fallbacks,
+                        "parse_failures": after[2] - parse_failures, "summaries": len(processed_results)})
+    return samples
+
+
+def print_report(report):
+    print(f"{'mode':<10}{'summaries':>10}{'tokens':>10}{'vs per_hit':>12}{'wall p50':>10}{'wall p95':>10}"
+          f"{'fallbacks':>11}{'bad json':>10}")
+    base_tokens = None
+    for mode, samples in report.items():
+        tokens = statistics.mean(sample["tokens"] for sample in samples)
+        if mode == "per_hit":
+            base_tokens = tokens
+        ratio = f"{tokens / base_tokens:.1%}" if base_tokens else "-"
+        walls = [sample["wall"] for sample in samples]
+        print(f"{mode:<10}{statistics.mean(sample['summaries'] for sample in samples):>10.1f}{tokens:>10.0f}"
+              f"{ratio:>12}{percentile(walls, 50):>10.1f}{percentile(walls, 95):>10.1f}"
+              f"{sum(sample['fallbacks'] for sample in samples):>11}"
+              f"{sum(sample['parse_failures'] for sample in samples):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--runs", type=int, default=10, help="searches summarized per mode")
+    parser.add_argument("--num-results", type=int, default=5)
+    parser.add_argument("--searchtype", default="BM25")
+    parser.add_argument("--live", action="store_true", help="use the cluster and deployment from st.secrets")
+    parser.add_argument("--llm-latency", type=float, default=300.0, help="ms per completion (stubs)")
+    parser.add_argument("--llm-generation-latency", type=float, default=10.0, help="ms per completion word (stubs)")
+    parser.add_argument("--malformed-json-rate", type=float, default=0.0,
+                        help="fraction of batched answers the stub returns as invalid JSON")
+    args = parser.parse_args()
+
+    if args.live:
+        es = create_es_client(st.secrets['es_username'], st.secrets['es_password'], st.secrets['es_cloudid'])
+        client = get_openai_client(st.secrets['sa_pass'], variables.openai_api_sa_base, "2023-05-15")
+        report = {mode: run_mode(es, client, mode, args.searchtype, args.num_results, args.runs)
+                  for mode in args.modes}
+        print_report(report)
+        return
+
+    # Stub runs measure the summarization itself, not the production quotas
+    set_rate_limits({}, float("inf"), float("inf"))
+    es_config = StubConfig(hits=args.num_results)
+    llm_config = StubConfig(latency_ms=args.llm_latency, jitter_ms=args.llm_latency * 0.25,
+                            generation_latency_ms=args.llm_generation_latency,
+                            malformed_json_rate=args.malformed_json_rate)
+    with StubServer(ElasticsearchStubHandler, es_config) as es_server, \
+            StubServer(AzureOpenAIStubHandler, llm_config) as llm_server:
+        es = Elasticsearch(es_server.url)
+        client = get_openai_client("stub", llm_server.url, variables.openai_api_version)
+        report = {mode: run_mode(es, client, mode, args.searchtype, args.num_results, args.runs)
+                  for mode in args.modes}
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
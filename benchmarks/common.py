@@ -0,0 +1,14 @@
+"""
+Queries and statistics shared by the benchmarks. Importing this module changes no settings.
+"""
+
+QUERIES = ["how do I secure my branch network", "what is new in webex", "zero trust for hybrid work",
+           "catalyst switch upgrade", "AI in network operations"]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
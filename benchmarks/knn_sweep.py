@@ -0,0 +1,155 @@
+"""
+Sweeps k (request size) and num_candidates for the nested kNN query, measures recall against exact
+brute-force kNN and latency, and writes the chosen settings to knn_settings.json, which the query
+builders read.
+
+    python benchmarks/knn_sweep.py --queries queries.txt --target-recall 0.95 --plot sweep.png
+    python benchmarks/knn_sweep.py --sample 100 --dry-run
+
+Without --queries, the titles of random documents are used as queries. The chosen setting is the
+lowest p95 latency with mean recall@eval-k at or above the target.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit as st
+
+from benchmarks.quantization import exact_top_k, sample_queries
+from utils.es_helper import create_es_client
+from utils.query_helper import build_vector
+from variables import byom_index_name, knn_settings_path
+
+
+def run_knn(es, query_vector, size, num_candidates):
+    body = {
+        "size": size,
+        "_source": False,
+        "query": {
+            "nested": {
+                "path": "passages",
+                "query": {
+                    "knn": {
+                        "query_vector": query_vector,
+                        "field": "passages.vector.predicted_value",
+                        "num_candidates": num_candidates
+                    }
+                }
+            }
+        }
+    }
+    start_time = time.time()
+    response = es.search(index=byom_index_name, body=body)
+    return [hit["_id"] for hit in response["hits"]["hits"]], (time.time() - start_time) * 1000
+
+
+def sweep(es, queries, sizes, candidates, eval_k, repeats):
+    vectors = [build_vector(es, user_query) for user_query in queries]
+    truths = [set(exact_top_k(es, vector, eval_k)) for vector in vectors]
+
+    rows = []
+    for size in sizes:
+        for num_candidates in candidates:
+            if num_candidates < size:
+                continue
+            recalls = []
+            latencies = []
+            for vector, truth in zip(vectors, truths):
+                for _ in range(repeats):
+                    ids, latency = run_knn(es, vector, size, num_candidates)
+                    latencies.append(latency)
+                recalls.append(len(truth & set(ids[:eval_k])) / len(truth) if truth else 1.0)
+            latencies.sort()
+            rows.append({
+                "size": size,
+                "num_candidates": num_candidates,
+                "recall": statistics.mean(recalls),
+                "p50": statistics.median(latencies),
+                "p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+            })
+    return rows
+
+
+def plot(rows, path):
+    try:
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("matplotlib is not installed; skipping the plot")
+        return
+    fig, ax = plt.subplots(figsize=(8, 5))
+    for size in sorted({row["size"] for row in rows}):
+        points = [row for row in rows if row["size"] == size]
+        ax.plot([row["p95"] for row in points], [row["recall"] for row in points], marker="o", label=f"k={size}")
+        for row in points:
+            ax.annotate(str(row["num_candidates"]), (row["p95"], row["recall"]), fontsize=7)
+    ax.set_xlabel("p95 latency (ms)")
+    ax.set_ylabel("recall")
+    ax.legend()
+    fig.savefig(path, bbox_inches="tight")
+    print(f"Plot written to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", help="text file with one query per line")
+    parser.add_argument("--sample", type=int, default=50, help="random titles used when --queries is not given")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[5, 10, 20])
+    parser.add_argument("--candidates", nargs="+", type=int, default=[5, 10, 25, 50, 100, 200, 500])
+    parser.add_argument("--eval-k", type=int, default=5, help="recall is measured on the top eval-k documents")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per query and setting")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--plot", help="write a recall vs latency plot to this file")
+    parser.add_argument("--output", default=knn_settings_path)
+    parser.add_argument("--dry-run", action="store_true", help="report without writing the settings file")
+    args = parser.parse_args()
+
+    es = create_es_client(st.secrets['es_username'], st.secrets['es_password'], st.secrets['es_cloudid'])
+
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = sample_queries(es, args.sample)
+
+    rows = sweep(es, queries, args.sizes, args.candidates, args.eval_k, args.repeats)
+
+    print(f"{len(queries)} queries, recall@{args.eval_k}")
+    print(f"{'k':>5}{'num_candidates':>16}{'recall':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    for row in rows:
+        print(f"{row['size']:>5}{row['num_candidates']:>16}{row['recall']:>9.3f}{row['p50']:>9.1f}{row['p95']:>9.1f}")
+
+    if args.plot:
+        plot(rows, args.plot)
+
+    eligible = [row for row in rows if row["size"] >= args.eval_k and row["recall"] >= args.target_recall]
+    if not eligible:
+        print(f"No setting reached recall {args.target_recall}; settings file left unchanged")
+        return
+    chosen = min(eligible, key=lambda row: (row["p95"], row["num_candidates"]))
+    print(f"Chosen: k={chosen['size']} num_candidates={chosen['num_candidates']} "
+          f"(recall {chosen['recall']:.3f}, p95 {chosen['p95']:.1f}ms)")
+
+    if args.dry_run:
+        return
+
+    settings = {}
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            settings = json.load(f)
+    settings["knn"] = {"num_candidates": chosen["num_candidates"], "size": chosen["size"]}
+    # The RRF kNN sub-search runs the same nested query; it only needs the candidate count
+    settings["rrf"] = {"num_candidates": chosen["num_candidates"]}
+    with open(args.output, "w") as f:
+        json.dump(settings, f, indent=2)
+    print(f"Settings written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Offline end-to-end latency benchmark. Starts local Elasticsearch and Azure OpenAI stubs and drives every
+searchtype through the real query builders and helpers at several concurrency levels.
+
+    python benchmarks/latency_suite.py --concurrency 1 4 16 --requests 50 --output benchmarks/baseline.json
+    python benchmarks/latency_suite.py --compare benchmarks/baseline.json
+
+Reports p50/p95/p99 per stage (embedding, es_client, es_took, llm, total) and throughput.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import variables
+
+# Keep benchmark runs away from the on-disk caches the apps use
+variables.embedding_cache_path = None
+variables.answer_cache_path = None
+
+from elasticsearch import Elasticsearch
+
+from benchmarks.common import QUERIES, percentile
+from benchmarks.stubs import AzureOpenAIStubHandler, ElasticsearchStubHandler, StubConfig, StubServer
+from utils.cache_helper import get_answer_cache, get_embedding_cache
+from utils.openai_helper import get_chat_guidance_stream, get_openai_client, get_openai_large_guidance
+from utils.ratelimit_helper import set_rate_limits
+from utils.query_helper import build_vector, execute_search, search_passage_context
+
+SEARCH_TYPES = ["BM25", "Vector", "Elser", "Reciprocal Rank Fusion", "Client Hybrid"]
+SCENARIOS = SEARCH_TYPES + ["Chat"]
+RRF_RANK_CONSTANT = 1
+RRF_WINDOW_SIZE = 200
+
+
+def clear_caches():
+    get_embedding_cache().memory.clear()
+    get_answer_cache().memory.clear()
+
+
+def run_search(es, client, searchtype, user_query, use_cache):
+    # Stage timings (ms) for one blog search request, following search_products step by step
+    if not use_cache:
+        clear_caches()
+    stages = {}
+    start_time = time.time()
+
+    if searchtype in ("Vector", "Reciprocal Rank Fusion"):
+        build_vector(es, user_query)
+        stages["embedding"] = (time.time() - start_time) * 1000
+
+    # For "Client Hybrid" the embedding overlaps with the BM25/ELSER legs and is counted in es_client
+    es_start = time.time()
+    results = execute_search(es, user_query, searchtype, RRF_RANK_CONSTANT, RRF_WINDOW_SIZE, "summary")
+    stages["es_client"] = (time.time() - es_start) * 1000
+    stages["es_took"] = results['took']
+
+    llm_start = time.time()
+    num_results = min(5, len(results['hits']['hits']))
+    get_openai_large_guidance(user_query, results, num_results, searchtype, client=client)
+    stages["llm"] = (time.time() - llm_start) * 1000
+
+    stages["total"] = (time.time() - start_time) * 1000
+    return stages
+
+
+def run_chat(es, client, user_query, use_cache):
+    # Stage timings (ms) for one chatbot turn with retrieval
+    if not use_cache:
+        clear_caches()
+    stages = {}
+    start_time = time.time()
+
+    context, sources = search_passage_context(es, user_query, "Elser", RRF_RANK_CONSTANT, RRF_WINDOW_SIZE)
+    stages["es_client"] = (time.time() - start_time) * 1000
+
+    messages = [
+        {"role": "system", "content": "You are an AI assistant."},
+        {"role": "user", "content": f"find the answer using this content only:  {context}"},
+        {"role": "user", "content": user_query}
+    ]
+    timings = {}
+    "".join(get_chat_guidance_stream(client, timings, messages))
+    stages["llm_first_token"] = timings["time_to_first_token"]
+    stages["llm"] = timings["total_time"]
+
+    stages["total"] = (time.time() - start_time) * 1000
+    return stages
+
+
+def run_level(es, client, scenario, concurrency, requests, use_cache):
+    def one(i):
+        user_query = QUERIES[i % len(QUERIES)]
+        try:
+            if scenario == "Chat":
+                return run_chat(es, client, user_query, use_cache)
+            return run_search(es, client, scenario, user_query, use_cache)
+        except Exception as e:
+            return {"error": repr(e)}
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(one, range(requests)))
+    wall = time.time() - start_time
+
+    errors = [sample["error"] for sample in samples if "error" in sample]
+    samples = [sample for sample in samples if "error" not in sample]
+    stages = {}
+    for stage in sorted({stage for sample in samples for stage in sample}):
+        values = [sample[stage] for sample in samples if stage in sample]
+        stages[stage] = {"p50": percentile(values, 50), "p95": percentile(values, 95),
+                         "p99": percentile(values, 99)}
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "throughput": len(samples) / wall if wall else 0.0,
+        "stages": stages
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"{'scenario':<24}{'conc':>5}{'rps':>9}{'err':>5}  {'stage':<16}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'Δp95':>9}")
+    for scenario, levels in report["results"].items():
+        for concurrency, level in levels.items():
+            base_level = (baseline or {}).get("results", {}).get(scenario, {}).get(concurrency)
+            first = True
+            for stage, values in level["stages"].items():
+                head = (f"{scenario:<24}{concurrency:>5}{level['throughput']:>9.1f}{level['errors']:>5}" if first
+                        else " " * 43)
+                delta = ""
+                if base_level and stage in base_level["stages"] and base_level["stages"][stage]["p95"]:
+                    change = values["p95"] / base_level["stages"][stage]["p95"] - 1
+                    delta = f"{change:+.0%}"
+                print(f"{head}  {stage:<16}{values['p50']:>9.1f}{values['p95']:>9.1f}{values['p99']:>9.1f}"
+                      f"{delta:>9}")
+                first = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=40, help="requests per scenario and concurrency level")
+    parser.add_argument("--cache", action="store_true", help="keep embedding/answer caches warm between requests")
+    parser.add_argument("--es-latency", type=float, default=20.0, help="ms")
+    parser.add_argument("--es-error-rate", type=float, default=0.0)
+    parser.add_argument("--es-hits", type=int, default=5)
+    parser.add_argument("--es-body-size", type=int, default=4000, help="characters of body_content per hit")
+    parser.add_argument("--llm-latency", type=float, default=300.0, help="ms")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-tokens", type=int, default=30, help="words per completion")
+    parser.add_argument("--llm-token-latency", type=float, default=5.0, help="ms between streamed tokens")
+    parser.add_argument("--output", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON to diff p95 against")
+    args = parser.parse_args()
+
+    es_config = StubConfig(latency_ms=args.es_latency, error_rate=args.es_error_rate, hits=args.es_hits,
+                           body_size=args.es_body_size, jitter_ms=args.es_latency * 0.25)
+    llm_config = StubConfig(latency_ms=args.llm_latency, error_rate=args.llm_error_rate,
+                            completion_tokens=args.llm_tokens, token_latency_ms=args.llm_token_latency,
+                            jitter_ms=args.llm_latency * 0.25)
+
+    # The stubs have no quota; the production token buckets would drain across scenarios and turn the llm
+    # stage into rate limiter queueing that depends on scenario order
+    set_rate_limits({}, float("inf"), float("inf"))
+
+    report = {"config": vars(args), "results": {}}
+    with StubServer(ElasticsearchStubHandler, es_config) as es_server, \
+            StubServer(AzureOpenAIStubHandler, llm_config) as llm_server:
+        es = Elasticsearch(es_server.url)
+        client = get_openai_client("stub", llm_server.url, variables.openai_api_version)
+
+        for scenario in args.scenarios:
+            report["results"][scenario] = {}
+            for concurrency in args.concurrency:
+                level = run_level(es, client, scenario, concurrency, args.requests, args.cache)
+                report["results"][scenario][str(concurrency)] = level
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Compares the float dense_vector index with its int8_hnsw copy: vector memory footprint, recall@k
+against exact brute-force kNN on the float vectors, and latency.
+
+    python benchmarks/quantization.py --create          # create the int8 index and reindex into it
+    python benchmarks/quantization.py --queries queries.txt -k 10
+
+Without --queries, the titles of random documents are used as queries.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit as st
+
+from utils.es_helper import create_es_client
+from utils.query_helper import build_knn_query, build_vector
+from variables import byom_index_name, byom_int8_index_name, local_vector_dims, quantized_rescore_oversample
+
+MAPPING_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "additional_es_assets",
+                            "cisco-search-blogs-byom-int8.mapping")
+
+
+def create_int8_index(es):
+    # Vectors are copied from _source, so no inference is re-run
+    with open(MAPPING_PATH) as f:
+        mappings = json.load(f)["mappings"]
+    if not es.indices.exists(index=byom_int8_index_name):
+        es.indices.create(index=byom_int8_index_name, mappings=mappings)
+    es.reindex(body={"source": {"index": byom_index_name}, "dest": {"index": byom_int8_index_name}},
+               wait_for_completion=True, request_timeout=3600)
+    es.indices.refresh(index=byom_int8_index_name)
+
+
+def vector_footprint(es, index):
+    # HNSW keeps the (quantized) vectors in memory: 4 bytes per dim for float, 1 byte plus a float offset for int8
+    stats = es.indices.stats(index=index, metric="dense_vector,store")["_all"]["primaries"]
+    count = stats.get("dense_vector", {}).get("value_count", 0)
+    bytes_per_vector = local_vector_dims + 4 if index == byom_int8_index_name else local_vector_dims * 4
+    return {"vectors": count, "vector_memory_bytes": count * bytes_per_vector,
+            "store_bytes": stats["store"]["size_in_bytes"]}
+
+
+def exact_top_k(es, query_vector, k):
+    # Ground truth: brute-force dot product over every passage of the float index
+    response = es.search(index=byom_index_name, body={
+        "size": k,
+        "_source": False,
+        "query": {
+            "nested": {
+                "path": "passages",
+                "score_mode": "max",
+                "query": {
+                    "script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            "source": "(1.0 + dotProduct(params.query_vector, 'passages.vector.predicted_value')) / 2.0",
+                            "params": {"query_vector": query_vector}
+                        }
+                    }
+                }
+            }
+        }
+    })
+    return [hit["_id"] for hit in response["hits"]["hits"]]
+
+
+def run_knn(es, index, user_query, query_vector, k, num_candidates, rescore_oversample):
+    query = build_knn_query(user_query, query_vector, rescore_oversample=rescore_oversample, size=k)
+    knn = query["query"]["nested"]["query"]["knn"]
+    knn["num_candidates"] = max(knn["num_candidates"], num_candidates)
+    query["size"] = k
+    query["_source"] = False
+    start_time = time.time()
+    response = es.search(index=index, body=query)
+    return [hit["_id"] for hit in response["hits"]["hits"]], (time.time() - start_time) * 1000
+
+
+def sample_queries(es, count):
+    response = es.search(index=byom_index_name, body={
+        "size": count, "_source": ["title"],
+        "query": {"function_score": {"random_score": {"seed": 42, "field": "_seq_no"}}}
+    })
+    return [hit["_source"]["title"] for hit in response["hits"]["hits"] if hit["_source"].get("title")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--create", action="store_true", help="create and fill the int8 index first")
+    parser.add_argument("--queries", help="text file with one query per line")
+    parser.add_argument("--sample", type=int, default=50, help="random titles used when --queries is not given")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--oversample", type=int, default=quantized_rescore_oversample)
+    args = parser.parse_args()
+
+    es = create_es_client(st.secrets['es_username'], st.secrets['es_password'], st.secrets['es_cloudid'])
+    if args.create:
+        create_int8_index(es)
+
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = sample_queries(es, args.sample)
+
+    variants = [
+        ("float", byom_index_name, None),
+        ("int8", byom_int8_index_name, None),
+        ("int8+rescore", byom_int8_index_name, args.oversample),
+    ]
+    recalls = {name: [] for name, _, _ in variants}
+    latencies = {name: [] for name, _, _ in variants}
+    for user_query in queries:
+        query_vector = build_vector(es, user_query)
+        truth = set(exact_top_k(es, query_vector, args.k))
+        for name, index, oversample in variants:
+            ids, latency = run_knn(es, index, user_query, query_vector, args.k, args.num_candidates, oversample)
+            recalls[name].append(len(truth & set(ids)) / len(truth) if truth else 1.0)
+            latencies[name].append(latency)
+
+    footprints = {byom_index_name: vector_footprint(es, byom_index_name),
+                  byom_int8_index_name: vector_footprint(es, byom_int8_index_name)}
+
+    print(f"{len(queries)} queries, k={args.k}, num_candidates={args.num_candidates}, oversample={args.oversample}")
+    print(f"{'variant':<14}{'vector mem MB':>15}{'store MB':>10}{'recall@k':>10}{'p50 ms':>9}{'p95 ms':>9}")
+    for name, index, _ in variants:
+        footprint = footprints[index]
+        ordered = sorted(latencies[name])
+        p95 = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] if ordered else 0.0
+        print(f"{name:<14}{footprint['vector_memory_bytes'] / 2 ** 20:>15.1f}{footprint['store_bytes'] / 2 ** 20:>10.1f}"
+              f"{statistics.mean(recalls[name]) if recalls[name] else 0:>10.3f}"
+              f"{statistics.median(ordered) if ordered else 0:>9.1f}{p95:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares response size and latency of full _source responses against the per-consumer projections
+used by the search helpers.
+
+    python benchmarks/source_projection.py "how do I secure my network" --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit as st
+
+from utils.es_helper import create_es_client
+from utils.query_helper import SEARCH_FILTER_PATH, apply_source_projection, build_search_query
+from variables import byom_index_name
+
+SEARCH_TYPES = ["BM25", "Vector", "Elser", "Reciprocal Rank Fusion"]
+
+
+def measure(es, query, consumer, runs):
+    sizes = []
+    latencies = []
+    for _ in range(runs):
+        kwargs = {} if consumer == "full" else {"filter_path": SEARCH_FILTER_PATH}
+        start_time = time.time()
+        response = es.search(index=byom_index_name, body=apply_source_projection(query, consumer), **kwargs)
+        latencies.append((time.time() - start_time) * 1000)
+        sizes.append(len(json.dumps(response.body).encode("utf-8")))
+    return statistics.median(sizes), statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("query")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--consumers", nargs="+", default=["full", "summary", "chat", "display"])
+    args = parser.parse_args()
+
+    es = create_es_client(st.secrets['es_username'], st.secrets['es_password'], st.secrets['es_cloudid'])
+
+    print(f"{'searchtype':<24}{'consumer':<10}{'bytes':>12}{'vs full':>10}{'latency ms':>12}")
+    for searchtype in SEARCH_TYPES:
+        query = build_search_query(es, args.query, searchtype, 1, 200)
+        full_size = None
+        for consumer in args.consumers:
+            size, latency = measure(es, query, consumer, args.runs)
+            if consumer == "full":
+                full_size = size
+            ratio = f"{size / full_size:.1%}" if full_size else "-"
+            print(f"{searchtype:<24}{consumer:<10}{size:>12,.0f}{ratio:>10}{latency:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Local stand-ins for Elasticsearch and Azure OpenAI, for benchmarking without Elastic Cloud or Azure.
+
+Both servers speak enough of the real HTTP APIs for the official Python clients: search, _msearch,
+_bulk and trained model inference on the Elasticsearch side, chat completions (plain and streamed)
+on the Azure OpenAI side. Latency, error rate and response size are configurable.
+"""
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class StubConfig:
+    latency_ms: float = 20.0  # mean added latency per request
+    jitter_ms: float = 5.0  # uniform +/- jitter around latency_ms
+    error_rate: float = 0.0  # fraction of requests answered with error_status
+    error_status: int = 429
+    retry_after: float = 0.0  # seconds, sent as Retry-After on errors when non-zero
+    hits: int = 5  # hits per search response
+    body_size: int = 4000  # characters of body_content per hit
+    passages: int = 10  # passages per hit
+    dims: int = 384  # embedding dimensions returned by inference
+    completion_tokens: int = 30  # words per chat completion
+    token_latency_ms: float = 0.0  # delay between streamed tokens
+    generation_latency_ms: float = 0.0  # delay per completion word on non-streamed responses
+    malformed_json_rate: float = 0.0  # fraction of batched summary answers that are not valid JSON
+
+
+def _words(count, seed):
+    rng = random.Random(seed)
+    vocabulary = ["network", "security", "cisco", "cloud", "switch", "router", "policy", "data", "AI", "the"]
+    return " ".join(rng.choice(vocabulary) for _ in range(count))
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = StubConfig()
+    extra_headers = {}
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this Nagle + delayed ACK add ~40ms per response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _delay(self):
+        latency = self.config.latency_ms + random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, payload, content_type="application/json"):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in self.extra_headers.items():
+            self.send_header(name, value)
+        if status >= 400 and self.config.retry_after:
+            self.send_header("Retry-After", str(self.config.retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _maybe_fail(self):
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            self._send_json(self.config.error_status, {"error": {"type": "stub_error", "reason": "injected"},
+                                                       "status": self.config.error_status})
+            return True
+        return False
+
+
+class ElasticsearchStubHandler(_StubHandler):
+    extra_headers = {"X-Elastic-Product": "Elasticsearch"}
+
+    def do_HEAD(self):
+        self._send_json(200, {})
+
+    def do_GET(self):
+        self._read_body()
+        if self.path.split("?")[0] in ("", "/"):
+            self._send_json(200, {"version": {"number": "8.12.0"}, "tagline": "You Know, for Search"})
+        else:
+            self.do_POST()
+
+    def do_PUT(self):
+        # elasticsearch-py sends bulk requests as PUT /_bulk; only index and alias creation get a plain ack
+        if self.path.split("?")[0].endswith(("/_bulk", "/_search", "/_msearch")):
+            self.do_POST()
+            return
+        self._read_body()
+        self._send_json(200, {"acknowledged": True})
+
+    def do_DELETE(self):
+        self._read_body()
+        self._send_json(200, {"acknowledged": True})
+
+    def do_POST(self):
+        raw = self._read_body()
+        path = self.path.split("?")[0]
+        self._delay()
+        if self._maybe_fail():
+            return
+
+        if path.endswith("/_infer"):
+            self._send_json(200, self._infer(path, json.loads(raw or b"{}")))
+        elif path.endswith("/_msearch"):
+            lines = [json.loads(line) for line in raw.splitlines() if line.strip()]
+            responses = [dict(self._search(body), status=200) for body in lines[1::2]]
+            self._send_json(200, {"took": 1, "responses": responses})
+        elif path.endswith("/_bulk"):
+            lines = [json.loads(line) for line in raw.splitlines() if line.strip()]
+            items = []
+            actions = iter(lines)
+            for action in actions:
+                op, meta = next(iter(action.items()))
+                if op != "delete":
+                    next(actions, None)  # the document line
+                items.append({op: {"_index": meta.get("_index"), "_id": meta.get("_id") or uuid.uuid4().hex,
+                                   "status": 200 if op == "delete" else 201,
+                                   "result": "deleted" if op == "delete" else "created"}})
+            self._send_json(200, {"took": 1, "errors": False, "items": items})
+        elif path.endswith("/_search"):
+            self._send_json(200, self._search(json.loads(raw or b"{}")))
+        elif path.endswith("/_mget"):
+            ids = json.loads(raw or b"{}").get("ids", [])
+            self._send_json(200, {"docs": [dict(self._hit(i, doc_id), found=True) for i, doc_id in enumerate(ids)]})
+        else:
+            self._send_json(200, {"acknowledged": True})
+
+    def _infer(self, path, body):
+        model_id = re.search(r"trained_models/([^/]+)/", path).group(1)
+        results = []
+        for doc in body.get("docs", []):
+            rng = random.Random(str(doc))
+            if "elser" in model_id:
+                value = {word: rng.random() for word in _words(20, str(doc)).split()}
+            else:
+                value = [rng.uniform(-1, 1) for _ in range(self.config.dims)]
+            results.append({"predicted_value": value})
+        return {"inference_results": results}
+
+    def _hit(self, rank, doc_id=None):
+        doc_id = doc_id or f"doc-{rank}"
+        passages = [{"text": _words(40, f"{doc_id}-{p}")} for p in range(self.config.passages)]
+        return {
+            "_index": "stub",
+            "_id": doc_id,
+            "_score": 10.0 / (rank + 1),
+            "_source": {
+                "id": doc_id,
+                "title": f"Stub blog {doc_id}",
+                "url": f"https://blogs.cisco.com/stub/{doc_id}",
+                "additional_urls": [],
+                "last_crawled_at": "2024-01-01T00:00:00Z",
+                "body_content": _words(self.config.body_size // 6, doc_id)[:self.config.body_size],
+                "passages": passages
+            },
+            "inner_hits": {"passages": {"hits": {"hits": [
+                {"_score": 5.0 / (p + 1), "_source": passages[p]} for p in range(min(3, len(passages)))
+            ]}}}
+        }
+
+    def _search(self, body):
+        size = min(body.get("size", self.config.hits), self.config.hits)
+        hits = [self._hit(i) for i in range(size)]
+        script_fields = body.get("script_fields", {})
+        for hit in hits:
+            # The passage script fields of utils/query_helper.py, evaluated on the stub document
+            texts = [passage["text"] for passage in hit["_source"]["passages"]]
+            fields = {}
+            if "first_passage" in script_fields:
+                fields["first_passage"] = [texts[0] if texts else ""]
+            if "matched_passages" in script_fields:
+                offsets = script_fields["matched_passages"]["script"]["params"]["offsets"]
+                fields["matched_passages"] = [texts[i] if i < len(texts) else "" for i in offsets]
+            if fields:
+                hit["fields"] = fields
+        return {
+            "took": random.randint(5, 30),
+            "timed_out": False,
+            "hits": {"total": {"value": size, "relation": "eq"}, "hits": hits}
+        }
+
+
+class AzureOpenAIStubHandler(_StubHandler):
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b"{}")
+        self._delay()
+        if self._maybe_fail():
+            return
+
+        deployment = re.search(r"deployments/([^/]+)/", self.path)
+        model = deployment.group(1) if deployment else body.get("model", "stub")
+        words = _words(self.config.completion_tokens, str(body.get("messages"))).split()
+        # Batched summary prompts get the JSON array they ask for, one short answer per document
+        doc_ids = re.findall(r'<document id="([^"]+)">', str(body.get("messages", [{}])[-1].get("content", "")))
+        if doc_ids:
+            if random.random() < self.config.malformed_json_rate:
+                words = ["Sorry,"] + words
+            else:
+                words = json.dumps([{"id": doc_id, "insight": _words(self.config.completion_tokens, doc_id)}
+                                    for doc_id in doc_ids]).split(" ")
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in body.get("messages", []))
+
+        if body.get("stream"):
+            self._stream(model, words)
+            return
+
+        if self.config.generation_latency_ms:
+            time.sleep(self.config.generation_latency_ms * len(words) / 1000)
+        self._send_json(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": " ".join(words)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                      "total_tokens": prompt_tokens + len(words)}
+        })
+
+    def _stream(self, model, words):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        for i, word in enumerate(words):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word},
+                             "finish_reason": None}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if self.config.token_latency_ms:
+                time.sleep(self.config.token_latency_ms / 1000)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+class StubServer:
+    """
+    Runs a stub handler on a background thread.
+
+        with StubServer(ElasticsearchStubHandler, StubConfig(latency_ms=10)) as server:
+            es = Elasticsearch(server.url)
+    """
+
+    def __init__(self, handler, config=None, host="127.0.0.1", port=0):
+        handler_class = type(handler.__name__, (handler,), {"config": config or StubConfig()})
+        self.server = ThreadingHTTPServer((host, port), handler_class)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,59 @@
+"""
+Loads crawled blog documents from a JSONL file into the search index, chunking and embedding the
+passages client side instead of through the chunker ingest pipeline.
+
+    python cisco-blog-ingest.py crawl.jsonl --threads 8 --chunk-size 50
+    python cisco-blog-ingest.py crawl.jsonl --reindex   # build a new version and swap the alias
+    python cisco-blog-ingest.py --rollback              # point the alias back at the previous version
+"""
+import argparse
+
+import streamlit as st
+
+from utils.es_helper import create_es_client, rollback_alias
+from utils.ingest_helper import ingest_documents, read_jsonl, reindex_documents
+from variables import byom_index_name, ingest_thread_count, ingest_chunk_size, ingest_docs_per_batch, \
+    passage_model_limit, byom_mapping_path, index_versions_to_keep
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", help="JSONL file with one crawled document per line")
+    parser.add_argument("--index", default=byom_index_name, help="target index, or the alias with --reindex")
+    parser.add_argument("--threads", type=int, default=ingest_thread_count)
+    parser.add_argument("--chunk-size", type=int, default=ingest_chunk_size, help="documents per bulk request")
+    parser.add_argument("--docs-per-batch", type=int, default=ingest_docs_per_batch,
+                        help="documents whose passages share one set of inference calls")
+    parser.add_argument("--model-limit", type=int, default=passage_model_limit, help="max passage length")
+    parser.add_argument("--reindex", action="store_true",
+                        help="load into a new versioned index, reusing unchanged passages, then swap the alias")
+    parser.add_argument("--mapping", default=byom_mapping_path, help="mapping file for --reindex")
+    parser.add_argument("--keep", type=int, default=index_versions_to_keep,
+                        help="versions kept for rollback with --reindex")
+    parser.add_argument("--rollback", action="store_true", help="point the alias at the previous version")
+    args = parser.parse_args()
+    if not args.rollback and not args.path:
+        parser.error("path is required unless --rollback is given")
+
+    es = create_es_client(st.secrets['es_username'], st.secrets['es_password'], st.secrets['es_cloudid'])
+
+    if args.rollback:
+        rollback_alias(es, args.index)
+        return
+
+    if args.reindex:
+        stats = reindex_documents(es, read_jsonl(args.path), args.index, args.mapping, args.threads,
+                                  args.chunk_size, args.docs_per_batch, args.model_limit, args.keep)
+    else:
+        stats = ingest_documents(es, read_jsonl(args.path), args.index, args.threads, args.chunk_size,
+                                 args.docs_per_batch, args.model_limit)
+
+    print(f"Indexed {stats['indexed']} documents ({stats['failed']} failed) in {stats['elapsed']:.1f}s "
+          f"- {stats['docs_per_sec']:.1f} docs/sec, {stats['reused']} reused, {stats['enriched']} enriched")
+    print(f"{stats['duplicate_passages']} of {stats['passages']} passage inferences served from the fingerprint "
+          f"store ({stats['duplicate_ratio']:.1%}), {stats['inference_seconds']:.1f}s inference, "
+          f"~{stats['inference_seconds_saved']:.1f}s saved")
+
+
+if __name__ == "__main__":
+    main()
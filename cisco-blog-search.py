@@ -1,10 +1,15 @@
 # Import the required libraries
 import math
 import sys
-from utils.es_helper import create_es_client
+import time
+from utils.es_helper import get_es_client
 import streamlit as st
 
-from utils.query_helper import search_products
+from utils.metrics_helper import record_span, start_metrics_server, trace
+
+from utils.query_helper import search_products, search_products_progressive
+from utils import service_client
+from variables import search_service_url, progressive_results
 
 # Initialize these variables with default values at the start of the script
 BM25_Boost = 0
@@ -12,16 +17,75 @@ KNN_Boost = 0
 rrf_rank_constant = 1
 rrf_window_size = 200
 
-# Connect to Elasticsearch
-try:
-    username = st.secrets['es_username']
-    password = st.secrets['es_password']
-    cloudid = st.secrets['es_cloudid']
-    es = create_es_client(username, password, cloudid)
-except Exception as e:
-    print("Connection failed", str(e))
-    st.error("Error connecting to Elasticsearch. Fix connection and restart app")
-    sys.exit(1)
+# Connect to Elasticsearch, unless retrieval runs in cisco-search-service.py
+es = None
+if not search_service_url:
+    try:
+        username = st.secrets['es_username']
+        password = st.secrets['es_password']
+        cloudid = st.secrets['es_cloudid']
+        es = get_es_client(username, password, cloudid)
+    except Exception as e:
+        print("Connection failed", str(e))
+        st.error("Error connecting to Elasticsearch. Fix connection and restart app")
+        sys.exit(1)
+
+# Expose /metrics when metrics_port is configured (started once per process)
+start_metrics_server()
+
+BADGE_STYLE = "background-color: red; color: white; border-radius: 50%; padding: 5px 10px;"
+
+
+def render_progressive_results(events, searchtype):
+    # Renders hits as soon as ES returns them and fills in each summary when its completion finishes
+    render_start_time = time.time()
+    header = st.empty()
+    placeholders = {}
+    took = 0
+    summaries = []
+
+    for event in events:
+        if event["event"] == "hits":
+            took = event["took"]
+            if not event["hits"]:
+                st.info("No search results found.")
+                break
+            header.markdown(
+                f'<div style="color: lightgreen">Elastic Query Response Time: {took}ms   |    GenAI Time: ...</div><br><br>',
+                unsafe_allow_html=True)
+            for hit in event["hits"]:
+                if hit["url"]:
+                    st.markdown(f'<center><a href="{hit["url"]}" target="_blank">{hit["title"]}</a></center><br>',
+                                unsafe_allow_html=True)
+                placeholders[hit["rank"]] = st.empty()
+                placeholders[hit["rank"]].markdown(
+                    f'<span style="{BADGE_STYLE}">{hit["rank"] + 1}</span> AI Insight/Summary: <i>generating...</i>',
+                    unsafe_allow_html=True)
+                st.markdown("**Supporting Document Excerpt:**")
+                st.markdown(
+                    f'<div style="height:100px;overflow-y:scroll;padding:10px;border:1px solid gray;">{hit["first_passage_text"]}</div>',
+                    unsafe_allow_html=True)
+                st.markdown('<hr style="border-top: 3px solid white">', unsafe_allow_html=True)
+            record_span("ui_first_paint", render_start_time, (time.time() - render_start_time) * 1000,
+                        searchtype=searchtype, results=len(event["hits"]))
+
+        elif event["event"] == "summary":
+            result = event["result"]
+            completion_output = result[1] if result is not None else "Summary not available."
+            placeholders[event["rank"]].markdown(
+                f'<span style="{BADGE_STYLE}">{event["rank"] + 1}</span> AI Insight/Summary: {completion_output}',
+                unsafe_allow_html=True)
+            if result is not None:
+                summaries.append(result)
+
+    if summaries:
+        total_genai_query_time = math.ceil(sum(result[4] for result in summaries))
+        header.markdown(
+            f'<div style="color: lightgreen">Elastic Query Response Time: {took}ms   |    GenAI Time: {total_genai_query_time}ms</div><br><br>',
+            unsafe_allow_html=True)
+    record_span("ui_render", render_start_time, (time.time() - render_start_time) * 1000,
+                searchtype=searchtype, results=len(summaries))
+
 
 # Layout columns
 col1, col2 = st.columns([1, 3])  # col1 is 1/4 of the width, and col2 is 3/4
@@ -117,11 +181,28 @@ with col2:
     # user_query = st.text_area("Tariff Search")
 
     if st.button("Search"):
-        if user_query:
-
-
-            processed_results, original_results = search_products(es, user_query, searchtype, BM25_Boost, KNN_Boost,
-                                                                  rrf_rank_constant, rrf_window_size)
+        if user_query and progressive_results and searchtype != "GenAI":
+            with trace("blog_search", searchtype=searchtype, progressive=True):
+                if search_service_url:
+                    events = service_client.search_products_progressive(
+                        user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size)
+                else:
+                    events = search_products_progressive(es, user_query, searchtype, BM25_Boost, KNN_Boost,
+                                                         rrf_rank_constant, rrf_window_size)
+                render_progressive_results(events, searchtype)
+
+        elif user_query:
+
+
+            with trace("blog_search", searchtype=searchtype):
+                if search_service_url:
+                    processed_results, original_results = service_client.search_products(
+                        user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size)
+                else:
+                    processed_results, original_results = search_products(es, user_query, searchtype, BM25_Boost,
+                                                                          KNN_Boost, rrf_rank_constant,
+                                                                          rrf_window_size)
+            render_start_time = time.time()
             if searchtype != "GenAI":
 
                 first_instance = processed_results[0]
@@ -132,7 +213,7 @@ with col2:
 
 
                 query_response_time_first_instance = first_instance[3]
-                total_genai_query_time = math.ceil(sum(result[3] for result in processed_results))
+                total_genai_query_time = math.ceil(sum(result[4] for result in processed_results))
 
 
                 st.markdown(
@@ -167,5 +248,8 @@ with col2:
                         processed_results):
                     st.markdown(f"**AI Insight:** {completion_output}")
 
+            record_span("ui_render", render_start_time, (time.time() - render_start_time) * 1000,
+                        searchtype=searchtype, results=len(processed_results))
+
         else:
             st.error("Please enter a question before searching.")
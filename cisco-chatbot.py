@@ -1,13 +1,16 @@
 import sys
+from collections import deque
 
 import streamlit as st
 
-from openai import AzureOpenAI
-
-from utils.es_helper import create_es_client
-from utils.openai_helper import get_chat_guidance
-from utils.query_helper import search_products_for_chatbot, search_products_v2
-from variables import openai_api_version, openai_api_sa_base
+from utils.context_helper import context_available, context_message
+from utils.es_helper import get_es_client
+from utils.history_helper import build_chat_messages
+from utils.metrics_helper import logger, start_metrics_server, trace
+from utils.openai_helper import get_chat_guidance_stream, get_openai_client
+from utils.query_helper import search_context_documents
+from utils import service_client
+from variables import openai_api_version, openai_api_sa_base, search_service_url, chat_timings_max_entries
 
 # Initialize these variables with default values at the start of the script
 BM25_Boost = 0
@@ -17,26 +20,41 @@ rrf_window_size = 200
 
 first_response_text = None
 
-# Connect to Elasticsearch
-try:
-    username = st.secrets['es_username']
-    password = st.secrets['es_password']
-    cloudid = st.secrets['es_cloudid']
-    es = create_es_client(username, password, cloudid)
-except Exception as e:
-    print("Connection failed", str(e))
-    st.error("Error connecting to Elasticsearch. Fix connection and restart app")
-    sys.exit(1)
+# Connect to Elasticsearch, unless retrieval runs in cisco-search-service.py
+es = None
+if not search_service_url:
+    try:
+        username = st.secrets['es_username']
+        password = st.secrets['es_password']
+        cloudid = st.secrets['es_cloudid']
+        es = get_es_client(username, password, cloudid)
+    except Exception as e:
+        print("Connection failed", str(e))
+        st.error("Error connecting to Elasticsearch. Fix connection and restart app")
+        sys.exit(1)
 
 
-azureclient = AzureOpenAI(
-  api_key = st.secrets['sa_pass'],
-  api_version = openai_api_version,
-  azure_endpoint = openai_api_sa_base
-)
+azureclient = None if search_service_url else get_openai_client(st.secrets['sa_pass'], openai_api_sa_base,
+                                                                openai_api_version)
 
 searchtype = 'Elser'
 
+
+def retrieve_context(query):
+    # Best matching passages of the top blogs, with source attribution. The text goes to the process-wide
+    # document store; the session only keeps references to it
+    with trace("chat_retrieval", searchtype=searchtype):
+        if search_service_url:
+            documents = service_client.search_context_documents(query, searchtype, rrf_rank_constant,
+                                                                rrf_window_size)
+        else:
+            documents = search_context_documents(es, query, searchtype, rrf_rank_constant, rrf_window_size)
+    return context_message(documents, query)
+
+
+# Expose /metrics when metrics_port is configured (started once per process)
+start_metrics_server()
+
 st.markdown("""
         <style>
         .subheader-style {
@@ -72,30 +90,47 @@ if prompt := st.chat_input("How may I help you?"):
         st.markdown(prompt)
 
 
-    blog_bodies= search_products_v2(es, prompt, searchtype, rrf_rank_constant, rrf_window_size)
-
-
-    with st.spinner('Thinking...'):
-        # Initially, set response_text to None or an appropriate default value
-        response_text = None
-
-        print(len(st.session_state.messages))
-
-        # Check if the session state has more than just the initial system message
-        # Assuming the system message is the first item in the list
-        if len(st.session_state.messages) == 1:
-            print("ini retrival")
-            st.session_state.messages.append({"role": "user", "content": f"find the answer using this content only:  {blog_bodies}"})
-            st.session_state.messages.append({"role": "user", "content": f"{prompt}"})
-            response_text = get_chat_guidance(azureclient)
-        else:
-            print("no retrival")
-            st.session_state.messages.append({"role": "user", "content": f"{prompt}"})
-            response_text = get_chat_guidance(azureclient)
-
-    # Display the assistant's response in the chat
-    with st.chat_message("assistant"):
-        st.markdown(response_text)
+    # Initially, set response_text to None or an appropriate default value
+    response_text = None
+
+    logger.debug("Session messages: %d", len(st.session_state.messages))
+
+    # Check if the session state has more than just the initial system message
+    # Assuming the system message is the first item in the list
+    if len(st.session_state.messages) == 1:
+        logger.debug("ini retrival")
+        st.session_state.messages.append(retrieve_context(prompt))
+        st.session_state.messages.append({"role": "user", "content": f"{prompt}"})
+    else:
+        logger.debug("no retrival")
+        for i, message in enumerate(st.session_state.messages):
+            # Evicted from the document store while the session was idle: retrieve it again
+            if "context_refs" in message and not context_available(message):
+                st.session_state.messages[i] = retrieve_context(message["query"])
+        st.session_state.messages.append({"role": "user", "content": f"{prompt}"})
+
+    # Display the assistant's response in the chat as the tokens arrive
+    if search_service_url:
+        # The service applies the token budget; the rolling summary state lives in this session
+        timings = {}
+        with st.chat_message("assistant"):
+            response_text = st.write_stream(
+                service_client.chat_stream(st.session_state.messages, st.session_state, timings))
+    else:
+        # Keep the prompt within the token budget: pinned context, rolling summary, recent turns
+        prompt_messages, prompt_tokens = build_chat_messages(azureclient)
+
+        timings = {"prompt_tokens": prompt_tokens}
+        with st.chat_message("assistant"):
+            response_text = st.write_stream(get_chat_guidance_stream(azureclient, timings, prompt_messages))
+
+    logger.info(f"Prompt tokens: {timings.get('prompt_tokens', 0)} | "
+                f"Time to first token: {timings.get('time_to_first_token', 0):.0f}ms | "
+                f"Total time: {timings.get('total_time', 0):.0f}ms")
+    # Only the most recent turns are kept, so long sessions do not grow the session state
+    if "timings" not in st.session_state:
+        st.session_state.timings = deque(maxlen=chat_timings_max_entries)
+    st.session_state.timings.append(timings)
 
     # Append the assistant's response to the session state
     st.session_state.messages.append({"role": "assistant", "content": response_text})
@@ -0,0 +1,216 @@
+"""
+Headless search and chat service. Runs retrieval and generation on AsyncElasticsearch and AsyncAzureOpenAI
+so the search tier can be scaled and load balanced apart from the Streamlit UIs.
+
+    python cisco-search-service.py --port 8080 --workers 4
+
+Endpoints (JSON request bodies):
+    POST /search_products      same arguments and results as utils.query_helper.search_products
+    POST /search_products/stream  search_products_progressive events as NDJSON, hits first, then summaries
+    POST /search_products_v2   the body_content of the top 3 hits
+    POST /chat/context         prompt context and sources for the first chat turn ("documents": true for the
+                               per-document passage selection instead)
+    POST /chat                 streams the answer as NDJSON: a header line, {"token": ...} lines, a timings line
+    GET  /health, /stats, /metrics
+
+Each worker admits search_service_max_in_flight requests at a time and queues up to search_service_max_queue
+more; beyond that requests are rejected with 503 and a Retry-After header instead of piling up.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+import streamlit as st
+from aiohttp import web
+
+from utils.async_helper import build_chat_messages_async, chat_stream_async, create_async_es_client, \
+    create_async_openai_client, search_context_documents_async, search_flight_stats, search_passage_context_async, \
+    search_products_async, search_products_progressive_async, search_products_v2_async
+from utils.metrics_helper import logger, metrics
+from utils.ratelimit_helper import rate_limiter_stats
+from variables import openai_api_sa_base, openai_api_version, search_service_host, search_service_port, \
+    search_service_workers, search_service_max_in_flight, search_service_max_queue, search_service_retry_after
+
+ES_CLIENT = web.AppKey("es", object)
+OPENAI_CLIENT = web.AppKey("openai", object)
+ADMISSION = web.AppKey("admission", dict)
+
+# Endpoints that are always answered, even when the worker is saturated
+UNTHROTTLED_PATHS = ("/health", "/stats", "/metrics")
+
+
+def json_response(payload, status=200):
+    return web.json_response(payload, status=status, dumps=lambda value: json.dumps(value, default=str))
+
+
+@web.middleware
+async def backpressure(request, handler):
+    if request.path in UNTHROTTLED_PATHS:
+        return await handler(request)
+
+    admission = request.app[ADMISSION]
+    if admission["queued"] >= search_service_max_queue:
+        metrics.increment("service_rejected")
+        return web.json_response({"error": "overloaded"}, status=503,
+                                 headers={"Retry-After": str(search_service_retry_after)})
+
+    admission["queued"] += 1
+    queued_at = time.time()
+    try:
+        await admission["semaphore"].acquire()
+    finally:
+        admission["queued"] -= 1
+    metrics.observe("service_queue_wait", (time.time() - queued_at) * 1000)
+
+    admission["in_flight"] += 1
+    metrics.set_gauge("service_in_flight", admission["in_flight"])
+    try:
+        return await handler(request)
+    finally:
+        admission["in_flight"] -= 1
+        metrics.set_gauge("service_in_flight", admission["in_flight"])
+        admission["semaphore"].release()
+
+
+async def handle_search_products(request):
+    params = await request.json()
+    processed_results, results = await search_products_async(
+        request.app[ES_CLIENT], request.app[OPENAI_CLIENT], params["user_query"], params["searchtype"],
+        params.get("BM25_Boost", 0), params.get("KNN_Boost", 0), params.get("rrf_rank_constant", 1),
+        params.get("rrf_window_size", 200))
+    return json_response({"processed_results": processed_results, "results": results})
+
+
+async def handle_search_products_stream(request):
+    params = await request.json()
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    async for event in search_products_progressive_async(
+            request.app[ES_CLIENT], request.app[OPENAI_CLIENT], params["user_query"], params["searchtype"],
+            params.get("BM25_Boost", 0), params.get("KNN_Boost", 0), params.get("rrf_rank_constant", 1),
+            params.get("rrf_window_size", 200)):
+        await response.write((json.dumps(event, default=str) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def handle_search_products_v2(request):
+    params = await request.json()
+    blog_bodies = await search_products_v2_async(
+        request.app[ES_CLIENT], params["user_query"], params["searchtype"], params.get("rrf_rank_constant", 1),
+        params.get("rrf_window_size", 200))
+    return json_response({"blog_bodies": blog_bodies})
+
+
+async def handle_chat_context(request):
+    params = await request.json()
+    if params.get("documents"):
+        # The unformatted passage selection, for clients that keep it in their own document store
+        documents = await search_context_documents_async(
+            request.app[ES_CLIENT], params["user_query"], params.get("searchtype", "Elser"),
+            params.get("rrf_rank_constant", 1), params.get("rrf_window_size", 200))
+        return json_response({"documents": documents})
+    context, sources = await search_passage_context_async(
+        request.app[ES_CLIENT], params["user_query"], params.get("searchtype", "Elser"),
+        params.get("rrf_rank_constant", 1), params.get("rrf_window_size", 200))
+    return json_response({"context": context, "sources": sources})
+
+
+async def handle_chat(request):
+    params = await request.json()
+    client = request.app[OPENAI_CLIENT]
+    prompt_messages, prompt_tokens, state = await build_chat_messages_async(client, params["messages"],
+                                                                            params.get("state", {}))
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    async def send(payload):
+        await response.write((json.dumps(payload) + "\n").encode("utf-8"))
+
+    # The updated summary state goes first so the client can keep it even if the stream is cut short
+    await send({"state": state, "prompt_tokens": prompt_tokens})
+    timings = {"prompt_tokens": prompt_tokens}
+    async for token in chat_stream_async(client, prompt_messages, timings):
+        await send({"token": token})
+    await send({"timings": timings})
+
+    await response.write_eof()
+    return response
+
+
+async def handle_health(request):
+    return json_response({"status": "ok"})
+
+
+async def handle_stats(request):
+    admission = request.app[ADMISSION]
+    return json_response({"in_flight": admission["in_flight"], "queued": admission["queued"],
+                          "singleflight": search_flight_stats(), "rate_limits": rate_limiter_stats(),
+                          "metrics": metrics.snapshot()})
+
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.prometheus(), content_type="text/plain")
+
+
+async def create_clients(app):
+    app[ES_CLIENT] = create_async_es_client(st.secrets['es_username'], st.secrets['es_password'],
+                                            st.secrets['es_cloudid'])
+    app[OPENAI_CLIENT] = create_async_openai_client(st.secrets['sa_pass'], openai_api_sa_base, openai_api_version)
+    yield
+    await app[ES_CLIENT].close()
+    await app[OPENAI_CLIENT].close()
+
+
+def create_app():
+    app = web.Application(middlewares=[backpressure])
+    app[ADMISSION] = {"semaphore": asyncio.Semaphore(search_service_max_in_flight), "queued": 0, "in_flight": 0}
+    app.cleanup_ctx.append(create_clients)
+    app.router.add_post("/search_products", handle_search_products)
+    app.router.add_post("/search_products/stream", handle_search_products_stream)
+    app.router.add_post("/search_products_v2", handle_search_products_v2)
+    app.router.add_post("/chat/context", handle_chat_context)
+    app.router.add_post("/chat", handle_chat)
+    app.router.add_get("/health", handle_health)
+    app.router.add_get("/stats", handle_stats)
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+
+def run_worker(host, port, reuse_port):
+    # In-flight requests get shutdown_timeout seconds to finish on SIGTERM/SIGINT
+    web.run_app(create_app(), host=host, port=port, reuse_port=reuse_port, shutdown_timeout=30,
+                print=None if reuse_port else print)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=search_service_host)
+    parser.add_argument("--port", type=int, default=search_service_port)
+    parser.add_argument("--workers", type=int, default=search_service_workers,
+                        help="worker processes sharing the port through SO_REUSEPORT")
+    args = parser.parse_args()
+
+    if args.workers <= 1:
+        run_worker(args.host, args.port, False)
+        return
+
+    workers = [multiprocessing.Process(target=run_worker, args=(args.host, args.port, True), daemon=False)
+               for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Serving on http://{args.host}:{args.port} with {args.workers} workers")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # Ctrl+C reaches every worker through the process group; wait for their graceful shutdown
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Maintains the local memory-mapped passage vector snapshot used by the "Local Vector" searchtype.
+
+    python cisco-vector-snapshot.py export          # full export of every passage vector
+    python cisco-vector-snapshot.py refresh         # append documents crawled since the last export
+    python cisco-vector-snapshot.py build-ivf --nlist 256
+"""
+import argparse
+
+import streamlit as st
+
+from utils.es_helper import create_es_client
+from utils.vector_index_helper import build_ivf, export_snapshot, refresh_snapshot
+from variables import byom_index_name, local_vector_index_path, ivf_nlist
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "refresh", "build-ivf"])
+    parser.add_argument("--prefix", default=local_vector_index_path)
+    parser.add_argument("--index", default=byom_index_name)
+    parser.add_argument("--nlist", type=int, default=ivf_nlist)
+    args = parser.parse_args()
+
+    if args.command == "build-ivf":
+        print(f"Built IVF index with {build_ivf(args.prefix, args.nlist)} lists")
+        return
+
+    es = create_es_client(st.secrets['es_username'], st.secrets['es_password'], st.secrets['es_cloudid'])
+    if args.command == "export":
+        print(f"Exported {export_snapshot(es, args.prefix, args.index)} passage vectors to {args.prefix}")
+    else:
+        print(f"Appended {refresh_snapshot(es, args.prefix)} passage vectors to {args.prefix}")
+
+
+if __name__ == "__main__":
+    main()
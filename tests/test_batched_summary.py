@@ -0,0 +1,112 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from utils import openai_helper
+from utils.metrics_helper import metrics
+from utils.openai_helper import apply_batched_insights, iter_openai_large_guidance, parse_batched_insights
+from utils.ratelimit_helper import reset_rate_limiters
+
+
+def hit(doc_id, score=1.0):
+    return {"_id": doc_id, "_score": score,
+            "_source": {"id": doc_id, "title": f"Title {doc_id}", "url": f"https://blogs.cisco.com/{doc_id}",
+                        "body_content": f"Body of {doc_id}."},
+            "fields": {"first_passage": [f"Body of {doc_id}."]}}
+
+
+def answers(*doc_ids):
+    return json.dumps([{"id": doc_id, "insight": f"About {doc_id}"} for doc_id in doc_ids])
+
+
+@pytest.fixture(autouse=True)
+def no_answer_cache(monkeypatch):
+    monkeypatch.setattr(openai_helper, "get_cached_answer", lambda *args: None)
+    monkeypatch.setattr(openai_helper, "set_cached_answer", lambda *args: None)
+    reset_rate_limiters()
+
+
+@pytest.mark.parametrize("content", [
+    answers("a", "b"),
+    "Here are the answers:\n```json\n" + answers("a", "b") + "\n```",
+    json.dumps({"answers": json.loads(answers("a", "b"))}),
+])
+def test_parse_batched_insights_finds_the_array(content):
+    assert parse_batched_insights(content, ["a", "b"]) == {"a": "About a", "b": "About b"}
+
+
+def test_parse_batched_insights_drops_invalid_entries():
+    content = json.dumps([
+        {"id": "a", "insight": "  first  "},
+        {"id": "a", "insight": "duplicate"},
+        {"id": "unknown", "insight": "not asked for"},
+        {"id": "b", "insight": "   "},
+        {"id": "c", "insight": 42},
+        "not an object",
+        {"id": 7, "insight": "numeric id"},
+    ])
+    assert parse_batched_insights(content, ["a", "b", "c", 7]) == {"a": "first", 7: "numeric id"}
+
+
+@pytest.mark.parametrize("content", ["Sorry, I cannot help with that.", "[{\"id\": \"a\", \"insight\": }]", ""])
+def test_parse_batched_insights_rejects_malformed_responses(content):
+    with pytest.raises(ValueError):
+        parse_batched_insights(content, ["a"])
+
+
+def test_apply_batched_insights_counts_parse_failures():
+    pending = [(0, hit("a"), "a")]
+    failures = metrics.snapshot()["counters"].get("batched_summary_parse_failures", 0)
+    assert apply_batched_insights("query", pending, "Sorry,", 10, 0.0) == {}
+    assert metrics.snapshot()["counters"]["batched_summary_parse_failures"] == failures + 1
+
+
+def test_apply_batched_insights_maps_answers_to_ranks():
+    pending = [(0, hit("a"), "a"), (2, hit("c"), "c")]
+    answered = apply_batched_insights("query", pending, answers("c"), 10, 0.0)
+    assert list(answered) == [2]
+    assert answered[2][1] == "About c"
+
+
+class FakeClient:
+    # Answers batched prompts with batched_content and per-hit prompts with a plain summary
+    def __init__(self, batched_content):
+        self.batched_content = batched_content
+        self.prompts = []
+        self.lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=self)
+
+    def with_options(self, max_retries):
+        return self
+
+    def create(self, **kwargs):
+        prompt = kwargs["messages"][-1]["content"]
+        with self.lock:
+            self.prompts.append(prompt)
+        content = self.batched_content if '<document id="' in prompt else "Per-hit summary"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+def summarize(client, hits):
+    results = {"took": 10, "hits": {"hits": hits}}
+    return dict(iter_openai_large_guidance("query", results, len(hits), client=client, mode="batched"))
+
+
+def test_batched_mode_falls_back_per_hit_for_missing_answers():
+    client = FakeClient(answers("a", "b"))
+    summaries = summarize(client, [hit("a"), hit("b"), hit("c")])
+
+    assert {rank: result[1] for rank, result in summaries.items()} == \
+        {0: "About a", 1: "About b", 2: "Per-hit summary"}
+    assert len(client.prompts) == 2
+
+
+def test_batched_mode_falls_back_per_hit_on_malformed_json():
+    client = FakeClient("Sorry, here is some prose instead.")
+    summaries = summarize(client, [hit("a"), hit("b")])
+
+    assert {rank: result[1] for rank, result in summaries.items()} == \
+        {0: "Per-hit summary", 1: "Per-hit summary"}
+    assert len(client.prompts) == 3
@@ -0,0 +1,37 @@
+import time
+
+from utils.cache_helper import LRUCache, SQLiteCache, TieredCache
+
+
+def test_promoted_disk_hit_keeps_remaining_ttl(tmp_path):
+    disk = SQLiteCache(str(tmp_path / "cache.db"), ttl=0.3)
+    disk.set("key", "value")
+    time.sleep(0.2)
+    cache = TieredCache(LRUCache(ttl=60), disk)
+
+    assert cache.get("key") == "value"
+    time.sleep(0.15)
+    # The disk entry has expired by now, so the promoted copy must not outlive it
+    assert cache.memory.get("key") is None
+    assert cache.get("key") is None
+
+
+def test_promoted_disk_hit_respects_memory_ttl(tmp_path):
+    disk = SQLiteCache(str(tmp_path / "cache.db"), ttl=60)
+    disk.set("key", "value")
+    cache = TieredCache(LRUCache(ttl=0.1), disk)
+
+    assert cache.get("key") == "value"
+    time.sleep(0.15)
+    assert cache.memory.get("key") is None
+    assert cache.get("key") == "value"
+
+
+def test_promoted_disk_hit_without_expiry_uses_memory_ttl(tmp_path):
+    disk = SQLiteCache(str(tmp_path / "cache.db"))
+    disk.set("key", "value")
+    cache = TieredCache(LRUCache(), disk)
+
+    assert cache.get("key") == "value"
+    assert cache.memory._data["key"][1] is None
+    assert disk.get_with_expiry("missing", "default") == ("default", None)
@@ -0,0 +1,60 @@
+import pytest
+
+from utils.query_helper import fuse_hybrid, fuse_rrf, fuse_weighted, merge_fused_hits
+
+
+def hits(*scored):
+    return [{"_id": doc_id, "_score": score} for doc_id, score in scored]
+
+
+LEGS = {
+    "bm25": hits(("a", 12.0), ("b", 8.0), ("c", 4.0)),
+    "knn": hits(("b", 0.9), ("d", 0.8)),
+    "elser": hits(("c", 20.0), ("b", 10.0)),
+}
+
+
+def test_fuse_rrf_sums_reciprocal_ranks():
+    scores = fuse_rrf(LEGS, rank_constant=1, window_size=10)
+    assert scores == pytest.approx({
+        "a": 1 / 2,
+        "b": 1 / 3 + 1 / 2 + 1 / 3,
+        "c": 1 / 4 + 1 / 2,
+        "d": 1 / 3,
+    })
+
+
+def test_fuse_rrf_only_counts_the_window():
+    scores = fuse_rrf(LEGS, rank_constant=60, window_size=1)
+    assert scores == pytest.approx({"a": 1 / 61, "b": 1 / 61, "c": 1 / 61})
+
+
+def test_fuse_weighted_normalizes_each_leg():
+    scores = fuse_weighted(LEGS, {"bm25": 1.0, "knn": 2.0, "elser": 0.5}, window_size=10)
+    assert scores == pytest.approx({
+        "a": 1.0,
+        "b": 0.5 + 2.0 * 1.0 + 0.5 * 0.0,
+        "c": 0.0 + 0.5 * 1.0,
+        "d": 2.0 * 0.0,
+    })
+
+
+def test_fuse_weighted_handles_single_and_empty_legs():
+    legs = {"bm25": hits(("a", 3.0)), "knn": [], "elser": hits(("a", None), ("b", None))}
+    # A leg with identical scores gives every hit full weight; missing weights default to 1
+    assert fuse_weighted(legs, {"bm25": 2.0}, window_size=10) == pytest.approx({"a": 3.0, "b": 1.0})
+
+
+def test_fuse_hybrid_dispatches_on_fusion():
+    assert fuse_hybrid(LEGS, "rrf", None, 1, 10) == fuse_rrf(LEGS, 1, 10)
+    weights = {"bm25": 1.0, "knn": 1.0, "elser": 1.0}
+    assert fuse_hybrid(LEGS, "weighted", weights, 1, 10) == fuse_weighted(LEGS, weights, 10)
+    with pytest.raises(ValueError):
+        fuse_hybrid(LEGS, "unknown", None, 1, 10)
+
+
+def test_merge_fused_hits_keeps_fused_order_and_scores():
+    fetched = {"hits": {"hits": [{"_id": "b", "_score": 1.0, "_source": {"title": "B"}},
+                                 {"_id": "a", "_score": 1.0, "_source": {"title": "A"}}]}}
+    merged = merge_fused_hits(["a", "missing", "b"], {"a": 0.9, "b": 0.5, "missing": 0.7}, fetched)
+    assert [(hit["_id"], hit["_score"]) for hit in merged] == [("a", 0.9), ("b", 0.5)]
@@ -0,0 +1,88 @@
+import pytest
+
+from utils import ingest_helper
+from utils.cache_helper import LRUCache, TieredCache
+from utils.ingest_helper import chunk_passages, infer_passages
+
+
+def texts(passages):
+    return [passage["text"] for passage in passages]
+
+
+# Outputs of the painless script in additional_es_assets/Ingest_pipeline.chunker for the same inputs
+@pytest.mark.parametrize("body_content, model_limit, expected", [
+    ("Hello world. How are you? I am fine! Thanks.", 400,
+     ["Hello world. How are you? I am fine! Thanks."]),
+    ("Hello world. How are you? I am fine! Thanks.", 20,
+     ["Hello world.", "How are you?", "I am fine! Thanks."]),
+    ("Mr. Smith went home. Mrs. Jones stayed. Ms. Lee left.", 10,
+     ["Mr. Smith went home.", "Mrs. Jones stayed.", "Ms. Lee left."]),
+    ("Dr. Who arrived.", 3, ["Dr.", "Who arrived."]),
+    ("One.  Two.", 5, ["One.", " Two."]),
+    ("One.  Two.", 400, ["One.  Two."]),
+    ("End. ", 400, ["End."]),
+    ("No sentence boundary", 5, ["No sentence boundary"]),
+    ("3.5 percent.", 400, ["3.5 percent."]),
+    # String.length() counts UTF-16 code units: each emoji is 2
+    ("\U0001F600\U0001F600. abc.", 9, ["\U0001F600\U0001F600.", "abc."]),
+    ("\U0001F600\U0001F600. abc.", 10, ["\U0001F600\U0001F600. abc."]),
+    ("", 400, [""]),
+])
+def test_chunk_passages_matches_painless(body_content, model_limit, expected):
+    assert texts(chunk_passages(body_content, model_limit)) == expected
+
+
+def test_chunk_passages_without_body_content():
+    assert chunk_passages(None) == []
+
+
+class FakeML:
+    def __init__(self):
+        self.calls = []
+
+    def infer_trained_model(self, model_id, docs):
+        self.calls.append((model_id, [doc["text_field"] for doc in docs]))
+        return {"inference_results": [{"predicted_value": f"{model_id}:{doc['text_field']}"} for doc in docs]}
+
+
+class FakeES:
+    def __init__(self):
+        self.ml = FakeML()
+
+
+@pytest.fixture
+def fingerprints(monkeypatch):
+    store = TieredCache(LRUCache(100))
+    monkeypatch.setattr(ingest_helper, "get_passage_fingerprints", lambda: store)
+    return store
+
+
+def test_infer_passages_infers_each_text_once(fingerprints):
+    es = FakeES()
+    results, stats = infer_passages(es, "minilm", ["a", "b", "a"])
+
+    assert [result["predicted_value"] for result in results] == ["minilm:a", "minilm:b", "minilm:a"]
+    assert es.ml.calls == [("minilm", ["a", "b"])]
+    assert stats["passages"] == 3
+    assert stats["duplicates"] == 1
+    assert stats["inferred"] == 2
+
+
+def test_infer_passages_reuses_earlier_runs_per_model(fingerprints):
+    es = FakeES()
+    infer_passages(es, "minilm", ["a"])
+    results, stats = infer_passages(es, "minilm", ["a", "c"])
+
+    assert es.ml.calls[-1] == ("minilm", ["c"])
+    assert [result["predicted_value"] for result in results] == ["minilm:a", "minilm:c"]
+    assert stats["duplicates"] == 1
+
+    # Another model never reuses the stored output
+    infer_passages(es, "elser", ["a"])
+    assert es.ml.calls[-1] == ("elser", ["a"])
+
+
+def test_infer_passages_batches_calls(fingerprints):
+    es = FakeES()
+    infer_passages(es, "minilm", ["a", "b", "c"], batch_size=2)
+    assert es.ml.calls == [("minilm", ["a", "b"]), ("minilm", ["c"])]
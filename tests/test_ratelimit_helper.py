@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from utils import ratelimit_helper
+from utils.ratelimit_helper import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RateLimiter, get_rate_limiter, \
+    limited_completion, limited_completion_async, reset_rate_limiters, retry_after
+
+REQUEST = httpx.Request("POST", "https://stub/openai/deployments/test/chat/completions")
+
+
+def rate_limit_error(headers=None):
+    return openai.RateLimitError("rate limited", response=httpx.Response(429, headers=headers, request=REQUEST),
+                                 body=None)
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+class FakeCompletions:
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(time.monotonic())
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class FakeClient:
+    def __init__(self, outcomes):
+        self.completions = FakeCompletions(outcomes)
+        self.chat = self
+        self.max_retries = None
+
+    def with_options(self, max_retries):
+        self.max_retries = max_retries
+        return self
+
+
+class FakeAsyncCompletions(FakeCompletions):
+    async def create(self, **kwargs):
+        return super().create(**kwargs)
+
+
+class FakeAsyncClient(FakeClient):
+    def __init__(self, outcomes):
+        super().__init__(outcomes)
+        self.completions = FakeAsyncCompletions(outcomes)
+
+
+@pytest.fixture(autouse=True)
+def fresh_limiters(monkeypatch):
+    monkeypatch.setattr(ratelimit_helper, "backoff_delay", lambda attempt: 0.0)
+    reset_rate_limiters()
+    yield
+    reset_rate_limiters()
+
+
+def test_interactive_requests_are_served_before_queued_background_requests():
+    limiter = RateLimiter("priority", rpm=60, tpm=1_000_000)
+    for _ in range(60):
+        limiter.acquire(1)
+
+    order = []
+
+    def acquire(name, priority):
+        limiter.acquire(1, priority, timeout=10)
+        order.append(name)
+
+    background = threading.Thread(target=acquire, args=("background", PRIORITY_BACKGROUND))
+    background.start()
+    wait_until(lambda: limiter.stats()["queued"] == 1)
+    interactive = threading.Thread(target=acquire, args=("interactive", PRIORITY_INTERACTIVE))
+    interactive.start()
+    wait_until(lambda: limiter.stats()["queued"] == 2)
+
+    background.join(5)
+    interactive.join(5)
+    assert order == ["interactive", "background"]
+
+
+def test_requests_wait_for_the_token_bucket():
+    limiter = RateLimiter("tokens", rpm=1000, tpm=600)
+    limiter.acquire(600)
+    start_time = time.monotonic()
+    # 600 tpm refills 10 tokens per second
+    limiter.acquire(6, timeout=5)
+    assert time.monotonic() - start_time >= 0.5
+
+
+def test_pause_holds_every_request_until_it_has_passed():
+    limiter = RateLimiter("pause", rpm=1000, tpm=1_000_000)
+    limiter.pause(0.3)
+    assert limiter.stats()["paused_for"] > 0
+    start_time = time.monotonic()
+    limiter.acquire(1)
+    assert time.monotonic() - start_time >= 0.25
+
+
+def test_acquire_times_out_and_leaves_the_queue():
+    limiter = RateLimiter("timeout", rpm=1, tpm=1_000_000)
+    limiter.acquire(1)
+    with pytest.raises(TimeoutError):
+        limiter.acquire(1, timeout=0.2)
+    assert limiter.stats()["queued"] == 0
+
+
+def test_retry_after_reads_the_headers():
+    assert retry_after(rate_limit_error({"retry-after-ms": "1500"}), 0) == 1.5
+    assert retry_after(rate_limit_error({"retry-after": "2"}), 0) == 2.0
+    # Without headers: the backoff delay
+    assert retry_after(rate_limit_error(), 3) == 0.0
+
+
+def test_limited_completion_pauses_for_retry_after_and_retries():
+    client = FakeClient([rate_limit_error({"retry-after-ms": "200"}), "response"])
+    response = limited_completion(client, model="retry-after", messages=[{"role": "user", "content": "hi"}])
+
+    assert response == "response"
+    assert client.max_retries == 0
+    first, second = client.completions.calls
+    assert second - first >= 0.15
+    assert get_rate_limiter("retry-after").stats()["paused_for"] == 0
+
+
+def test_limited_completion_gives_up_after_retry_attempts():
+    client = FakeClient([rate_limit_error({"retry-after-ms": "1"})] * 2)
+    with pytest.raises(openai.RateLimitError):
+        limited_completion(client, retry_attempts=2, model="give-up", messages=[{"role": "user", "content": "hi"}])
+    assert len(client.completions.calls) == 2
+
+
+def test_limited_completion_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(ratelimit_helper, "openai_max_retries", 1)
+    client = FakeClient([openai.APIConnectionError(request=REQUEST), "response"])
+    assert limited_completion(client, model="transient", messages=[{"role": "user", "content": "hi"}]) == "response"
+
+    client = FakeClient([openai.APIConnectionError(request=REQUEST)] * 2)
+    with pytest.raises(openai.APIConnectionError):
+        limited_completion(client, model="transient", messages=[{"role": "user", "content": "hi"}])
+
+
+def test_limited_completion_async_pauses_for_retry_after_and_retries():
+    client = FakeAsyncClient([rate_limit_error({"retry-after-ms": "200"}), "response"])
+    response = asyncio.run(limited_completion_async(client, model="async-retry-after",
+                                                    messages=[{"role": "user", "content": "hi"}]))
+
+    assert response == "response"
+    first, second = client.completions.calls
+    assert second - first >= 0.15
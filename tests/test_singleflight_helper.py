@@ -0,0 +1,257 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.singleflight_helper import AsyncSingleFlight, SingleFlight
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def run_threads(target, count):
+    outcomes = [None] * count
+
+    def run(i):
+        try:
+            outcomes[i] = ("result", target())
+        except Exception as e:
+            outcomes[i] = ("error", e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def test_do_runs_concurrent_identical_calls_once():
+    flights = SingleFlight("test")
+    release = threading.Event()
+    calls = []
+
+    def fn(value):
+        calls.append(value)
+        release.wait(5)
+        return value * 2
+
+    threads, outcomes = run_threads(lambda: flights.do("key", fn, 21), 5)
+    wait_until(lambda: flights.collapsed == 4)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [21]
+    assert outcomes == [("result", 42)] * 5
+    assert flights.stats()["in_flight"] == 0
+
+    # Once finished, the next call runs again
+    assert flights.do("key", fn, 1) == 2
+    assert len(calls) == 2
+
+
+def test_do_gives_every_waiter_the_leaders_exception():
+    flights = SingleFlight("test")
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise ValueError("boom")
+
+    threads, outcomes = run_threads(lambda: flights.do("key", fn), 3)
+    wait_until(lambda: flights.collapsed == 2)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert all(kind == "error" and isinstance(error, ValueError) for kind, error in outcomes)
+    assert flights.errors == 1
+
+
+def test_do_waiter_times_out_without_affecting_the_leader():
+    flights = SingleFlight("test", timeout=0.1)
+    release = threading.Event()
+    threads, outcomes = run_threads(lambda: flights.do("key", lambda: release.wait(5) and "done"), 1)
+    wait_until(lambda: flights.leaders == 1)
+
+    with pytest.raises(TimeoutError):
+        flights.do("key", lambda: "not run")
+    assert flights.timeouts == 1
+
+    release.set()
+    threads[0].join(5)
+    assert outcomes == [("result", "done")]
+
+
+def test_stream_shares_every_item_with_joining_callers():
+    flights = SingleFlight("test")
+    release = threading.Event()
+
+    def fn(publish, count):
+        publish("first")
+        release.wait(5)
+        for i in range(count):
+            publish(i)
+        return "result"
+
+    leader = flights.stream("key", fn, lambda result: ["replayed", result], 2)
+    assert next(leader) == "first"
+    joiner = flights.stream("key", fn, lambda result: ["replayed", result], 2)
+    assert next(joiner) == "first"
+    release.set()
+
+    assert list(leader) == [0, 1]
+    assert list(joiner) == [0, 1]
+    assert flights.leaders == 1
+    assert flights.collapsed == 1
+
+
+def test_stream_and_do_join_each_other():
+    flights = SingleFlight("test")
+    release = threading.Event()
+
+    def streamed(publish):
+        release.wait(5)
+        publish("item")
+        return "streamed result"
+
+    # The generator registers its execution when it is first read
+    leader, streamed_items = run_threads(lambda: list(flights.stream("key", streamed, lambda result: [result])), 1)
+    wait_until(lambda: flights.leaders == 1)
+    threads, outcomes = run_threads(lambda: flights.do("key", lambda: "not run"), 1)
+    wait_until(lambda: flights.collapsed == 1)
+    release.set()
+    leader[0].join(5)
+    threads[0].join(5)
+    assert streamed_items == [("result", ["item"])]
+    # A do() caller gets the stream's return value
+    assert outcomes == [("result", "streamed result")]
+
+    # A stream joining a do() execution gets replay(result)
+    release.clear()
+    threads, outcomes = run_threads(lambda: flights.do("key", lambda: release.wait(5) and "plain result"), 1)
+    wait_until(lambda: flights.stats()["in_flight"] == 1)
+    joiner = flights.stream("key", streamed, lambda result: ["replayed", result])
+    release.set()
+    assert list(joiner) == ["replayed", "plain result"]
+    threads[0].join(5)
+
+
+def test_stream_raises_the_execution_error_after_its_items():
+    flights = SingleFlight("test")
+
+    def fn(publish):
+        publish("partial")
+        raise ValueError("boom")
+
+    received = []
+    with pytest.raises(ValueError):
+        for item in flights.stream("key", fn, list):
+            received.append(item)
+    assert received == ["partial"]
+    assert flights.errors == 1
+
+
+def test_stream_times_out_between_items():
+    flights = SingleFlight("test", timeout=0.1)
+    release = threading.Event()
+
+    def fn(publish):
+        publish("first")
+        release.wait(5)
+
+    stream = flights.stream("key", fn, list)
+    assert next(stream) == "first"
+    with pytest.raises(TimeoutError):
+        next(stream)
+    release.set()
+
+
+def test_stream_execution_finishes_when_the_caller_stops_reading():
+    flights = SingleFlight("test")
+    finished = threading.Event()
+
+    def fn(publish):
+        publish("first")
+        time.sleep(0.05)
+        publish("second")
+        finished.set()
+
+    stream = flights.stream("key", fn, list)
+    assert next(stream) == "first"
+    stream.close()
+    assert finished.wait(2)
+
+
+def test_async_do_collapses_and_propagates_errors():
+    async def main():
+        flights = AsyncSingleFlight("test")
+        calls = []
+
+        async def fn(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value * 2
+
+        results = await asyncio.gather(*(flights.do("key", fn, 21) for _ in range(4)))
+        assert results == [42] * 4
+        assert calls == [21]
+
+        async def failing():
+            await asyncio.sleep(0.05)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(*(flights.do("error", failing) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flights.errors == 1
+
+    asyncio.run(main())
+
+
+def test_async_do_waiter_times_out_and_leaves_the_execution_running():
+    async def main():
+        flights = AsyncSingleFlight("test", timeout=0.05)
+
+        async def slow():
+            await asyncio.sleep(0.2)
+            return "done"
+
+        leader = asyncio.ensure_future(flights.do("key", slow))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await flights.do("key", slow)
+        assert await leader == "done"
+        assert flights.timeouts == 1
+
+    asyncio.run(main())
+
+
+def test_async_stream_shares_items_and_errors():
+    async def main():
+        flights = AsyncSingleFlight("test")
+
+        async def fn(publish):
+            publish("first")
+            await asyncio.sleep(0.05)
+            publish("second")
+            raise ValueError("boom")
+
+        async def consume():
+            received = []
+            try:
+                async for item in flights.stream("key", fn, list):
+                    received.append(item)
+            except ValueError:
+                received.append("error")
+            return received
+
+        results = await asyncio.gather(consume(), consume())
+        assert results == [["first", "second", "error"]] * 2
+        assert flights.leaders == 1
+        assert flights.errors == 1
+
+    asyncio.run(main())
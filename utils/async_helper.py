@@ -0,0 +1,400 @@
+"""
+asyncio counterparts of the search, summarization and chat helpers, used by cisco-search-service.py.
+
+Query building, fusion, result shaping, context packing and caching are shared with the synchronous helpers;
+only the Elasticsearch and Azure OpenAI round trips are awaited here, and disk-backed cache access runs in
+worker threads.
+"""
+import asyncio
+import time
+
+import httpx
+import openai
+from elasticsearch import AsyncElasticsearch
+from openai import AsyncAzureOpenAI
+
+from utils.cache_helper import INDEX_GENERATION_FILTER_PATH, INDEX_GENERATION_QUERY, INDEX_META_FILTER_PATH, \
+    cached_index_generation, get_embedding_cache, get_result_cache, update_index_generation
+from utils.context_helper import format_passage_context, select_context_documents
+from utils.history_helper import assemble_chat_messages, select_chat_window, summary_request
+from utils.http_helper import AsyncTrackedTransport, PoolTracker
+from utils.metrics_helper import logger, metrics, record_span, span
+from utils.openai_helper import apply_batched_insights, cached_hit_summary, extract_hit_fields, \
+    hit_summary_result, log_summary_error, plan_batched_summary, store_hit_summary, summary_prompt_messages
+from utils.ratelimit_helper import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, limited_completion_async
+from utils.singleflight_helper import AsyncSingleFlight
+from utils.query_helper import HYBRID_LEG_FILTER_PATH, SEARCH_FILTER_PATH, VECTOR_SEARCHTYPES, \
+    apply_source_projection, build_hybrid_leg_queries, build_search_query, embedding_cache_key, ensure_hits, \
+    finish_search_products, fuse_hybrid, hits_event, ids_query, index_for_searchtype, inference_vector, \
+    local_fetch_query, merge_fused_hits, merge_local_hits, result_events, search_products_key, search_products_v2_key, search_response, \
+    summary_hits, top_blog_bodies, uses_client_hybrid
+from utils.vector_index_helper import get_local_vector_index
+
+from variables import model, byom_index_name, es_connections_per_node, es_request_timeout, es_max_retries, \
+    es_retry_on_timeout, openai_max_connections, openai_max_keepalive_connections, openai_request_timeout, \
+    openai_max_retries, openai_completion_deployment_name, openai_summary_deployment_name, \
+    openai_summary_concurrency, openai_retry_attempts, rag_top_n_docs, rag_passages_per_doc, summary_mode
+
+
+# Identical searches in flight on this worker's event loop share one execution
+_search_flights = AsyncSingleFlight("service_singleflight")
+
+
+def search_flight_stats():
+    return _search_flights.stats()
+
+
+def create_async_es_client(username, password, cloudid):
+    return AsyncElasticsearch(
+        cloud_id=cloudid,
+        basic_auth=(username, password),
+        connections_per_node=es_connections_per_node,
+        request_timeout=es_request_timeout,
+        max_retries=es_max_retries,
+        retry_on_timeout=es_retry_on_timeout
+    )
+
+
+def create_async_openai_client(api_key, azure_endpoint, api_version):
+    tracker = PoolTracker("openai", f"{httpx.URL(azure_endpoint).host}_{api_version}_async", openai_max_connections)
+    limits = httpx.Limits(max_connections=openai_max_connections,
+                          max_keepalive_connections=openai_max_keepalive_connections)
+    http_client = httpx.AsyncClient(transport=AsyncTrackedTransport(tracker, limits), timeout=openai_request_timeout)
+    return AsyncAzureOpenAI(
+        azure_endpoint=azure_endpoint,
+        api_key=api_key,
+        api_version=api_version,
+        max_retries=openai_max_retries,
+        timeout=openai_request_timeout,
+        http_client=http_client
+    )
+
+
+async def build_vector_async(es, text):
+    with span("embedding", model=model) as attributes:
+        # The embedding cache may read and write its SQLite tier: keep that off the event loop
+        cache = get_embedding_cache()
+        cache_key = embedding_cache_key(text)
+        predicted_value = await asyncio.to_thread(cache.get, cache_key)
+        attributes["cache_hit"] = predicted_value is not None
+        if predicted_value is not None:
+            return predicted_value
+
+        response = await es.ml.infer_trained_model(model_id=model, docs=[{"text_field": text}])
+        predicted_value = inference_vector(response)
+        if predicted_value:
+            await asyncio.to_thread(cache.set, cache_key, predicted_value)
+        return predicted_value
+
+
+async def search_index_async(es, query, consumer, index=byom_index_name):
+    with span("es_search", consumer=consumer) as attributes:
+        results = await es.search(index=index, body=apply_source_projection(query, consumer),
+                                  filter_path=SEARCH_FILTER_PATH)
+        attributes["es_took_ms"] = results.get("took")
+
+    return ensure_hits(results)
+
+
+async def hybrid_search_async(es, user_query, rrf_rank_constant, rrf_window_size, consumer="summary", fusion=None,
+                              weights=None, size=5, index=byom_index_name):
+    # hybrid_search with the legs gathered on the event loop instead of a thread pool
+    start_time = time.time()
+
+    async def run_leg(name, body):
+        with span("es_search_leg", leg=name) as attributes:
+            results = await es.search(index=index, body=body, filter_path=HYBRID_LEG_FILTER_PATH)
+            attributes["es_took_ms"] = results.get("took")
+        return results.get("hits", {}).get("hits", [])
+
+    async def run_knn_leg():
+        query_vector = await build_vector_async(es, user_query)
+        return await run_leg("knn", build_hybrid_leg_queries(user_query, query_vector, rrf_window_size)["knn"])
+
+    legs = build_hybrid_leg_queries(user_query, None, rrf_window_size)
+    names = list(legs) + ["knn"]
+    leg_results = await asyncio.gather(*[run_leg(name, body) for name, body in legs.items()], run_knn_leg())
+    leg_hits = dict(zip(names, leg_results))
+
+    scores = fuse_hybrid(leg_hits, fusion, weights, rrf_rank_constant, rrf_window_size)
+    top_ids = sorted(scores, key=scores.get, reverse=True)[:size]
+
+    hits = []
+    if top_ids:
+        fetched = await search_index_async(es, ids_query(top_ids), consumer, index=index)
+        hits = merge_fused_hits(top_ids, scores, fetched)
+
+    return search_response(hits, len(scores), start_time)
+
+
+async def local_vector_search_async(es, user_query, consumer="summary", size=5, passages_per_doc=1,
+                                    index=byom_index_name):
+    # local_vector_search; the numpy scan runs in a worker thread so it does not block the event loop
+    start_time = time.time()
+    query_vector = await build_vector_async(es, user_query)
+
+    with span("local_knn"):
+        matches = await asyncio.to_thread(get_local_vector_index().search, query_vector, size,
+                                          passages_per_doc=passages_per_doc)
+
+    hits = []
+    if matches:
+        fetched = await search_index_async(es, local_fetch_query(matches), consumer,
+                                           index=index)
+        hits = merge_local_hits(matches, fetched)
+
+    return search_response(hits, len(hits), start_time)
+
+
+async def execute_search_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, consumer,
+                               passages_per_doc=None):
+    if uses_client_hybrid(searchtype):
+        return await hybrid_search_async(es, user_query, rrf_rank_constant, rrf_window_size, consumer)
+    if searchtype == "Local Vector":
+        return await local_vector_search_async(es, user_query, consumer, passages_per_doc=passages_per_doc or 1)
+
+    query_vector = None
+    if searchtype in VECTOR_SEARCHTYPES:
+        query_vector = await build_vector_async(es, user_query)
+    query = build_search_query(None, user_query, searchtype, rrf_rank_constant, rrf_window_size, passages_per_doc,
+                               query_vector=query_vector)
+    return await search_index_async(es, query, consumer, index=index_for_searchtype(searchtype))
+
+
+async def get_index_generation_async(es, index):
+    # get_index_generation with the periodic check awaited
+    generation = cached_index_generation(index)
+    if generation is not None:
+        return generation
+    try:
+        response = await es.search(index=index, body=INDEX_GENERATION_QUERY, filter_path=INDEX_GENERATION_FILTER_PATH)
+        mapping = await es.indices.get_mapping(index=index, filter_path=INDEX_META_FILTER_PATH)
+    except Exception:
+        response, mapping = None, None
+    return update_index_generation(index, response, mapping)
+
+
+async def summarize_hit_async(client, user_query, hit, query_response_time, retry_attempts=openai_retry_attempts):
+    # _summarize_hit on AsyncAzureOpenAI; the SQLite-backed answer cache is read and written in a thread
+    genai_start_time = time.time()
+
+    cached = await asyncio.to_thread(cached_hit_summary, user_query, hit, query_response_time, genai_start_time)
+    if cached is not None:
+        return cached
+
+    text, _, _, _ = extract_hit_fields(hit)
+    try:
+        with span("llm_completion", deployment=openai_summary_deployment_name):
+            response = await limited_completion_async(
+                client, PRIORITY_BACKGROUND, retry_attempts,
+                model=openai_summary_deployment_name,
+                messages=summary_prompt_messages(user_query, text)
+            )
+
+        completion_output = response.choices[0].message.content
+        await asyncio.to_thread(store_hit_summary, user_query, hit, completion_output)
+        return hit_summary_result(hit, completion_output, query_response_time, genai_start_time)
+
+    except Exception as e:
+        log_summary_error(e)
+
+    return None
+
+
+async def summarize_hits_batched_async(client, user_query, hits, query_response_time,
+                                       retry_attempts=openai_retry_attempts):
+    # _summarize_hits_batched on AsyncAzureOpenAI
+    genai_start_time = time.time()
+    answered, pending, kwargs = await asyncio.to_thread(plan_batched_summary, user_query, hits, query_response_time)
+    if not pending:
+        return answered
+
+    try:
+        with span("llm_completion", deployment=openai_summary_deployment_name, documents=len(pending)):
+            response = await limited_completion_async(client, PRIORITY_BACKGROUND, retry_attempts, **kwargs)
+    except (openai.OpenAIError, TimeoutError) as e:
+        logger.error(f"Batched summary failed: {e}")
+        return answered
+
+    answered.update(await asyncio.to_thread(apply_batched_insights, user_query, pending,
+                                            response.choices[0].message.content, query_response_time,
+                                            genai_start_time))
+    return answered
+
+
+async def summarize_hits_async(client, user_query, hits, query_response_time):
+    """
+    iter_openai_large_guidance on AsyncAzureOpenAI: yields (rank, result) as each summary finishes, with the
+    same summary_mode handling.
+    """
+    pending = list(enumerate(hits))
+    if summary_mode == "batched":
+        answered = await summarize_hits_batched_async(client, user_query, hits, query_response_time)
+        for rank, result in sorted(answered.items()):
+            yield rank, result
+        pending = [(rank, hit) for rank, hit in pending if rank not in answered]
+        if not pending:
+            return
+        metrics.increment("batched_summary_fallbacks", len(pending))
+        logger.info(f"Batched summary missed {len(pending)} of {len(hits)} hits, summarizing them one by one")
+
+    # Same fan-out bound as the thread pool in iter_openai_large_guidance
+    semaphore = asyncio.Semaphore(openai_summary_concurrency)
+
+    async def summarize(rank, hit):
+        async with semaphore:
+            return rank, await summarize_hit_async(client, user_query, hit, query_response_time)
+
+    tasks = [asyncio.ensure_future(summarize(rank, hit)) for rank, hit in pending]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # The consumer went away: stop the remaining completions
+        for task in tasks:
+            task.cancel()
+
+
+async def search_products_async(es, client, user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant,
+                                rrf_window_size):
+    """
+    search_products for the async service: same cache key, results and tuple layout.
+
+    Returns:
+    - A tuple (processed_results, results).
+    """
+    result_cache = get_result_cache()
+    generation = await get_index_generation_async(es, index_for_searchtype(searchtype))
+    cache_key = search_products_key(searchtype, user_query, BM25_Boost, KNN_Boost, rrf_rank_constant,
+                                    rrf_window_size, generation)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    return await _search_flights.do(cache_key, _search_products_progressive_async, lambda event: None, es, client,
+                                    user_query, searchtype, rrf_rank_constant, rrf_window_size, cache_key)
+
+
+async def search_products_progressive_async(es, client, user_query, searchtype, BM25_Boost, KNN_Boost,
+                                           rrf_rank_constant, rrf_window_size):
+    # search_products_progressive: yields the hits event, then one summary event per hit as it finishes
+    result_cache = get_result_cache()
+    generation = await get_index_generation_async(es, index_for_searchtype(searchtype))
+    cache_key = search_products_key(searchtype, user_query, BM25_Boost, KNN_Boost, rrf_rank_constant,
+                                    rrf_window_size, generation)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        for event in result_events(*cached):
+            yield event
+        return
+
+    # Shares one execution with identical searches in flight, progressive or not; it keeps running and
+    # fills the result cache when the client goes away
+    async for event in _search_flights.stream(cache_key, _search_products_progressive_async,
+                                              lambda result: result_events(*result), es, client, user_query,
+                                              searchtype, rrf_rank_constant, rrf_window_size, cache_key):
+        yield event
+
+
+async def _search_products_progressive_async(publish, es, client, user_query, searchtype, rrf_rank_constant,
+                                             rrf_window_size, cache_key):
+    results = await execute_search_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "summary")
+    hits = summary_hits(results)
+    publish(hits_event(results, len(hits)))
+
+    processed_results = [None] * len(hits)
+    async for rank, result in summarize_hits_async(client, user_query, hits, results['took']):
+        processed_results[rank] = result
+        publish({"event": "summary", "rank": rank, "result": result})
+
+    return finish_search_products(cache_key, processed_results, results)
+
+
+async def search_products_v2_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    # search_products_v2: the body_content of the top 3 hits
+    result_cache = get_result_cache()
+    generation = await get_index_generation_async(es, index_for_searchtype(searchtype))
+    cache_key = search_products_v2_key(searchtype, user_query, rrf_rank_constant, rrf_window_size, generation)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    return await _search_flights.do(cache_key, _search_products_v2_async, es, user_query, searchtype,
+                                    rrf_rank_constant, rrf_window_size, cache_key)
+
+
+async def _search_products_v2_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, cache_key):
+    results = await execute_search_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "chat")
+    if not results['hits']['hits']:
+        logger.info("No results found.")
+    blog_bodies = top_blog_bodies(results)
+
+    get_result_cache().set(cache_key, blog_bodies)
+    return blog_bodies
+
+
+async def search_passage_context_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    return format_passage_context(await search_context_documents_async(es, user_query, searchtype,
+                                                                       rrf_rank_constant, rrf_window_size))
+
+
+async def search_context_documents_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    results = await execute_search_async(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "display",
+                                         passages_per_doc=rag_passages_per_doc)
+    if not results['hits']['hits']:
+        logger.info("No results found.")
+    return select_context_documents(results, top_n=rag_top_n_docs)
+
+
+async def build_chat_messages_async(client, messages, state, budget=None):
+    """
+    build_chat_messages with the rolling summary kept in the state dict the client sends along
+    ('history_summary' and 'history_summarized_upto') instead of st.session_state.
+
+    Returns:
+    - A tuple (prompt_messages, prompt_tokens, state).
+    """
+    pinned, conversation, window_start = select_chat_window(messages, budget)
+
+    summary = state.get("history_summary", "")
+    summarized_upto = state.get("history_summarized_upto", 0)
+    if window_start > summarized_upto:
+        response = await limited_completion_async(
+            client, PRIORITY_INTERACTIVE, **summary_request(summary, conversation[summarized_upto:window_start]))
+        summary = response.choices[0].message.content.strip()
+        state = dict(state, history_summary=summary, history_summarized_upto=window_start)
+
+    prompt_messages, prompt_tokens = assemble_chat_messages(pinned, summary, conversation, window_start)
+    return prompt_messages, prompt_tokens, state
+
+
+async def chat_stream_async(client, messages, timings=None):
+    # get_chat_guidance_stream on AsyncAzureOpenAI
+    start_time = time.time()
+    first_token_time = None
+
+    stream = await limited_completion_async(
+        client, PRIORITY_INTERACTIVE,
+        model=openai_completion_deployment_name,
+        messages=messages,
+        stream=True
+    )
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        token = chunk.choices[0].delta.content
+        if not token:
+            continue
+        if first_token_time is None:
+            first_token_time = time.time()
+        yield token
+
+    end_time = time.time()
+    time_to_first_token = ((first_token_time or end_time) - start_time) * 1000
+    total_time = (end_time - start_time) * 1000
+    if timings is not None:
+        timings["time_to_first_token"] = time_to_first_token
+        timings["total_time"] = total_time
+    record_span("llm_stream", start_time, total_time, deployment=openai_completion_deployment_name,
+                time_to_first_token_ms=time_to_first_token)
@@ -0,0 +1,523 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+
+from utils.metrics_helper import logger
+
+
+def normalize_query(text):
+    # Collapse whitespace and case so trivially different spellings of the same query share an entry
+    return " ".join(str(text).split()).lower()
+
+
+def make_key(*parts):
+    # Stable string key for any JSON-serializable tuple of parts
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def estimate_size(value):
+    # Approximate in-memory footprint by the size of the JSON encoding
+    return len(json.dumps(value, default=str))
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache with an optional per-entry TTL.
+
+    Parameters:
+    - max_entries: Maximum number of entries kept before the least recently used is evicted.
+    - ttl: Seconds an entry stays valid, or None to never expire.
+    - max_bytes: Optional bound on the total estimated size of the cached values.
+    - sizer: Function estimating the size of a value in bytes, used with max_bytes.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None, sizer=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizer = sizer or estimate_size
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at, size = entry
+                if expires_at is None or expires_at > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self.bytes -= size
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        size = self.sizer(value) if self.max_bytes else 0
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._data[key] = (value, expires_at, size)
+            self.bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes
+                                                         and len(self._data) > 1):
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= evicted[2]
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SQLiteCache:
+    """
+    Small on-disk key/value store backed by SQLite, so cached values survive Streamlit restarts.
+
+    Values are stored as BLOBs; callers pass encode/decode functions for their value type.
+    When max_entries is set, the least recently accessed rows are evicted once the table grows past it.
+    A hit only rewrites accessed_at when the stored value is older than touch_interval seconds (a tenth of
+    the TTL by default), so repeated reads of hot keys do not turn into a write and commit each.
+    """
+
+    def __init__(self, path, table="cache", ttl=None, encode=None, decode=None, max_entries=None,
+                 touch_interval=None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval if touch_interval is not None else (ttl / 10 if ttl else 300)
+        self.encode = encode or (lambda value: json.dumps(value).encode("utf-8"))
+        self.decode = decode or (lambda blob: json.loads(blob.decode("utf-8")))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            # WAL lets readers proceed while a write is committed; NORMAL sync is durable enough for a cache
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                f"(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        value, _ = self.get_with_expiry(key, default)
+        return value
+
+    def get_with_expiry(self, key, default=None):
+        """
+        Same lookup as get, also returning the entry's expires_at timestamp.
+
+        Returns:
+        - (value, expires_at), where expires_at is None for entries that never expire.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, expires_at, accessed_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                if row is not None:
+                    self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return default, None
+            if now - row[2] >= self.touch_interval:
+                self._conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+            self.hits += 1
+        return self.decode(row[0]), row[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        blob = self.encode(value)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(blob), expires_at, now)
+            )
+            if self.max_entries:
+                overflow = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.max_entries
+                if overflow > 0:
+                    self._conn.execute(
+                        f"DELETE FROM {self.table} WHERE key IN "
+                        f"(SELECT key FROM {self.table} ORDER BY accessed_at ASC LIMIT ?)", (overflow,)
+                    )
+                    self.evictions += overflow
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def stats(self):
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def encode_float32(vector):
+    return array("f", vector).tobytes()
+
+
+def decode_float32(blob):
+    vector = array("f")
+    vector.frombytes(bytes(blob))
+    return vector.tolist()
+
+
+class TieredCache:
+    """
+    In-memory LRU in front of an optional SQLiteCache. Disk hits are promoted into memory.
+    """
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value, expires_at = self.disk.get_with_expiry(key)
+            if value is not None:
+                # Keep the disk entry's remaining lifetime instead of restarting the TTL on promotion
+                ttl = None
+                if expires_at is not None:
+                    remaining = max(expires_at - time.time(), 0.001)
+                    ttl = min(remaining, self.memory.ttl) if self.memory.ttl else remaining
+                self.memory.set(key, value, ttl=ttl)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses, "memory": self.memory.stats()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    # Process-wide embedding cache, created lazily from the settings in variables.py
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                from variables import embedding_cache_max_entries, embedding_cache_ttl, embedding_cache_path
+
+                disk = None
+                if embedding_cache_path:
+                    disk = SQLiteCache(embedding_cache_path, table="embeddings", ttl=embedding_cache_ttl,
+                                       encode=encode_float32, decode=decode_float32)
+                _embedding_cache = TieredCache(LRUCache(embedding_cache_max_entries, embedding_cache_ttl), disk)
+    return _embedding_cache
+
+
+def embedding_cache_stats():
+    return get_embedding_cache().stats()
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    # Process-wide cache of per-document LLM answers, created lazily from the settings in variables.py
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                from variables import answer_cache_max_entries, answer_cache_ttl, answer_cache_path
+
+                disk = None
+                if answer_cache_path:
+                    disk = SQLiteCache(answer_cache_path, table="answers", ttl=answer_cache_ttl,
+                                       max_entries=answer_cache_max_entries)
+                _answer_cache = TieredCache(LRUCache(answer_cache_max_entries, answer_cache_ttl), disk)
+    return _answer_cache
+
+
+def content_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def get_cached_answer(user_query, doc_id, body_content, deployment, prompt_version):
+    """
+    Look up a cached LLM answer for a query/document pair.
+
+    Entries are stored under (normalized query, document id, deployment, prompt version) and carry the
+    hash of the body_content they were generated from. When a recrawl changes the document the hashes
+    no longer match, so the stale entry is dropped and the answer is regenerated.
+    """
+    cache = get_answer_cache()
+    key = make_key("answer", normalize_query(user_query), doc_id, deployment, prompt_version)
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry.get("content_hash") != content_hash(body_content):
+        cache.delete(key)
+        return None
+    return entry["answer"]
+
+
+def set_cached_answer(user_query, doc_id, body_content, deployment, prompt_version, answer, last_crawled_at=None):
+    cache = get_answer_cache()
+    key = make_key("answer", normalize_query(user_query), doc_id, deployment, prompt_version)
+    cache.set(key, {
+        "answer": answer,
+        "content_hash": content_hash(body_content),
+        "last_crawled_at": last_crawled_at,
+    })
+
+
+def answer_cache_stats():
+    return get_answer_cache().stats()
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    # Process-wide cache of complete search results, created lazily from the settings in variables.py
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                from variables import result_cache_max_entries, result_cache_max_bytes, result_cache_ttl
+
+                _result_cache = LRUCache(result_cache_max_entries, result_cache_ttl, result_cache_max_bytes)
+    return _result_cache
+
+
+def result_cache_stats():
+    return get_result_cache().stats()
+
+
+_document_store = None
+_document_store_lock = threading.Lock()
+
+
+def get_document_store():
+    # Process-wide, size-bounded store of retrieved document text; chat sessions only keep references to it
+    global _document_store
+    if _document_store is None:
+        with _document_store_lock:
+            if _document_store is None:
+                from variables import document_store_max_entries, document_store_max_bytes
+
+                _document_store = LRUCache(document_store_max_entries, None, document_store_max_bytes,
+                                           sizer=lambda text: len(text.encode("utf-8")))
+    return _document_store
+
+
+def store_document(doc_id, text):
+    """
+    Puts document text in the shared store. Identical text for the same document is stored once, however
+    many sessions reference it.
+
+    Returns:
+    - The reference to keep instead of the text: a dict with the document id and the text's content hash.
+    """
+    reference = {"id": doc_id, "hash": content_hash(text)}
+    key = make_key("document", doc_id, reference["hash"])
+    store = get_document_store()
+    if store.get(key) is None:
+        store.set(key, text)
+    return reference
+
+
+def load_document(reference):
+    # The text behind a store_document reference, or None when it has been evicted
+    return get_document_store().get(make_key("document", reference["id"], reference["hash"]))
+
+
+def document_store_stats():
+    return get_document_store().stats()
+
+
+_passage_fingerprints = None
+_passage_fingerprints_lock = threading.Lock()
+
+
+def get_passage_fingerprints():
+    # Process-wide store of passage inference results, created lazily from the settings in variables.py
+    global _passage_fingerprints
+    if _passage_fingerprints is None:
+        with _passage_fingerprints_lock:
+            if _passage_fingerprints is None:
+                from variables import passage_fingerprint_path, passage_fingerprint_memory_entries, \
+                    passage_fingerprint_max_entries
+
+                disk = None
+                if passage_fingerprint_path:
+                    disk = SQLiteCache(passage_fingerprint_path, table="passage_inference",
+                                       max_entries=passage_fingerprint_max_entries)
+                _passage_fingerprints = TieredCache(LRUCache(passage_fingerprint_memory_entries), disk)
+    return _passage_fingerprints
+
+
+def passage_fingerprint(model_id, text):
+    # Passages are identified by model id and text hash, so a model upgrade never reuses stale output
+    return f"{model_id}:{content_hash(text)}"
+
+
+def passage_fingerprint_stats():
+    return get_passage_fingerprints().stats()
+
+
+# Index generation markers: (last check time, generation) per index, plus a local refresh counter that
+# ingestion bumps so results are invalidated immediately in the ingesting process. Other processes see the
+# write through the _meta.generation marker ingestion stores in the mapping of the concrete index.
+_index_generations = {}
+_index_refresh_counters = {}
+_index_generation_lock = threading.Lock()
+
+
+# Doc count and max last_crawled_at of an index, fetched without returning any documents
+INDEX_GENERATION_QUERY = {
+    "size": 0,
+    "track_total_hits": True,
+    "aggs": {"last_crawled": {"max": {"field": "last_crawled_at"}}}
+}
+INDEX_GENERATION_FILTER_PATH = ["hits.total", "aggregations"]
+# The _meta.generation marker of every concrete index behind an alias, keyed by index name
+INDEX_META_FILTER_PATH = ["*.mappings._meta.generation"]
+
+
+def get_index_generation(es, index):
+    """
+    Returns a marker that changes whenever the index content changes: the document count, the
+    max last_crawled_at and the _meta.generation of the concrete indices (which also changes when
+    the alias moves), re-checked at most every index_generation_check_interval seconds.
+    """
+    generation = cached_index_generation(index)
+    if generation is not None:
+        return generation
+
+    with _index_generation_lock:
+        generation = cached_index_generation(index)
+        if generation is not None:
+            return generation
+        try:
+            response = es.search(index=index, body=INDEX_GENERATION_QUERY, filter_path=INDEX_GENERATION_FILTER_PATH)
+            mapping = es.indices.get_mapping(index=index, filter_path=INDEX_META_FILTER_PATH)
+        except Exception:
+            response, mapping = None, None
+        return update_index_generation(index, response, mapping)
+
+
+def cached_index_generation(index):
+    # The last generation seen for index, or None when it is due for a re-check
+    from variables import index_generation_check_interval
+
+    entry = _index_generations.get(index)
+    if entry is not None and time.time() - entry[0] < index_generation_check_interval:
+        return entry[1]
+    return None
+
+
+def index_meta_generations(mapping):
+    # (concrete index, _meta.generation) pairs from a get_mapping response filtered with INDEX_META_FILTER_PATH
+    return sorted((name, body.get("mappings", {}).get("_meta", {}).get("generation"))
+                  for name, body in (mapping or {}).items() if isinstance(body, dict))
+
+
+def update_index_generation(index, response, mapping=None):
+    # Records the generation from an INDEX_GENERATION_QUERY response and the index mapping (None when the
+    # check failed)
+    entry = _index_generations.get(index)
+    if response is not None:
+        generation = (
+            response.get("hits", {}).get("total", {}).get("value"),
+            response.get("aggregations", {}).get("last_crawled", {}).get("value"),
+            index_meta_generations(mapping),
+            _index_refresh_counters.get(index, 0)
+        )
+    else:
+        # Keep serving with the last known generation rather than failing the search
+        generation = entry[1] if entry is not None else ("unknown", _index_refresh_counters.get(index, 0))
+    _index_generations[index] = (time.time(), generation)
+    return generation
+
+
+def bump_index_generation(es, index):
+    """
+    Called after writing to an index so cached results for it are not served again. The new generation is
+    written to _meta.generation of the concrete index behind index, where every process reads it on its next
+    check; this process drops its cached generation immediately.
+    """
+    with _index_generation_lock:
+        _index_refresh_counters[index] = _index_refresh_counters.get(index, 0) + 1
+        _index_generations.pop(index, None)
+    try:
+        es.indices.put_mapping(index=index, meta={"generation": uuid.uuid4().hex})
+    except Exception as e:
+        logger.warning(f"Could not update the generation marker of {index}, other processes may serve cached "
+                       f"results until the doc count or last_crawled_at changes: {e}")
@@ -0,0 +1,171 @@
+from utils.cache_helper import load_document, store_document
+from utils.history_helper import CONTEXT_MARKER, count_tokens
+from utils.metrics_helper import logger, metrics
+from variables import rag_context_token_budget
+
+
+def _hit_url(source):
+    # Prefer 'additional_urls' if available and non-empty
+    additional_urls = source.get("additional_urls", [])
+    return additional_urls[0] if additional_urls else source.get("url", "No URL available")
+
+
+def first_passage(hit):
+    """
+    Returns the text of the first passage of a hit, or None.
+
+    Projected searches return it as the first_passage script field instead of the passages array.
+    """
+    if "first_passage" in hit.get("fields", {}):
+        values = hit["fields"]["first_passage"]
+        return values[0] if values and values[0] else None
+    passages = hit.get("_source", {}).get("passages") or []
+    return passages[0].get("text") if passages else None
+
+
+def matched_passages(hit):
+    """
+    Returns (score, text) pairs for the passages ES matched in this hit.
+
+    Uses the nested inner_hits when the query asked for them, otherwise falls back to the first
+    passage, scored with the document score. Unprojected responses fall back to all passages in
+    _source in document order.
+    """
+    inner = hit.get("inner_hits", {}).get("passages", {}).get("hits", {}).get("hits", [])
+    if inner:
+        passages = []
+        for inner_hit in inner:
+            source = inner_hit.get("_source", {})
+            # Nested inner hit sources are relative to the nested object
+            text = source.get("text") or source.get("passages", {}).get("text")
+            if text:
+                passages.append((inner_hit.get("_score") or 0.0, text))
+        return passages
+
+    score = hit.get("_score") or 0.0
+    if "first_passage" in hit.get("fields", {}):
+        text = first_passage(hit)
+        return [(score, text)] if text else []
+    return [(score, passage["text"]) for passage in hit.get("_source", {}).get("passages", []) if passage.get("text")]
+
+
+def build_passage_context(results, top_n=3, token_budget=None):
+    """
+    Packs the best matching passages of the top documents into a prompt context.
+
+    Passages from the top_n hits are ranked by score, deduplicated on normalized text and added
+    until token_budget is used up. The packed passages are grouped per document in rank order,
+    each group headed with a numbered source line.
+
+    Parameters:
+    - results: The Elasticsearch response, ideally from a query with passage inner_hits.
+    - top_n: Number of top documents to draw passages from.
+    - token_budget: Maximum tokens of passage text. Defaults to rag_context_token_budget.
+
+    Returns:
+    - A tuple (context, sources): the context string and a list of dicts with title, url and the
+      number of passages used from each document.
+    """
+    return format_passage_context(select_context_documents(results, top_n, token_budget))
+
+
+def select_context_documents(results, top_n=3, token_budget=None):
+    """
+    The passage selection of build_passage_context, before formatting.
+
+    Returns:
+    - A list of dicts with id, title, url and the selected passages, one per document in rank order.
+    """
+    token_budget = token_budget or rag_context_token_budget
+    hits = results.get('hits', {}).get('hits', [])[:top_n]
+
+    candidates = []
+    for rank, hit in enumerate(hits):
+        for score, text in matched_passages(hit):
+            candidates.append((score, rank, text))
+    # Highest score first; ties keep the document order
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+
+    seen = set()
+    selected = {}
+    used = 0
+    for score, rank, text in candidates:
+        fingerprint = " ".join(text.split()).lower()
+        if fingerprint in seen:
+            continue
+        tokens = count_tokens(text)
+        if used + tokens > token_budget:
+            continue
+        seen.add(fingerprint)
+        selected.setdefault(rank, []).append(text)
+        used += tokens
+
+    documents = []
+    for rank in sorted(selected):
+        hit = hits[rank]
+        source = hit.get("_source", {})
+        documents.append({"id": source.get("id", hit.get("_id")), "title": source.get("title", "No title available"),
+                          "url": _hit_url(source), "passages": selected[rank]})
+    return documents
+
+
+def document_section(document):
+    # One document's part of the context, without its source number
+    passages = "\n".join(f"- {text}" for text in document["passages"])
+    return f"{document['title']} ({document['url']})\n{passages}"
+
+
+def format_passage_context(documents):
+    # Numbered source sections in rank order; returns (context, sources) like build_passage_context
+    sections = [f"[{number}] {document_section(document)}" for number, document in enumerate(documents, 1)]
+    sources = [{"title": document["title"], "url": document["url"], "passages": len(document["passages"])}
+               for document in documents]
+    return "\n\n".join(sections), sources
+
+
+def format_sources(sources):
+    # Markdown list of the sources from build_passage_context, numbered like the context sections
+    return "Sources:\n" + "\n".join(f"{number}. [{source['title']}]({source['url']})"
+                                     for number, source in enumerate(sources, 1))
+
+
+def context_message(documents, query):
+    """
+    The chatbot's context message, holding references into the shared document store instead of the
+    document text. rehydrate_messages turns it back into the prompt message.
+
+    Parameters:
+    - documents: From select_context_documents.
+    - query: The question the context was retrieved for, kept so it can be retrieved again after eviction.
+    """
+    references = [store_document(document["id"], document_section(document)) for document in documents]
+    return {"role": "user", "content": f"{CONTEXT_MARKER}:", "context_refs": references, "query": query}
+
+
+def context_available(message):
+    return all(load_document(reference) is not None for reference in message.get("context_refs", []))
+
+
+def rehydrate_messages(messages):
+    """
+    Prompt-ready copies of the session messages: context references are replaced with the stored text.
+
+    Sections evicted from the document store are left out of the prompt and counted in the
+    document_store_misses metric.
+    """
+    prompt_messages = []
+    for message in messages:
+        if "context_refs" not in message:
+            prompt_messages.append(message)
+            continue
+        sections = []
+        for reference in message["context_refs"]:
+            section = load_document(reference)
+            if section is None:
+                metrics.increment("document_store_misses")
+                logger.warning(f"Context of document {reference['id']} was evicted from the document store")
+                continue
+            sections.append(f"[{len(sections) + 1}] {section}")
+        prompt_messages.append({"role": message["role"],
+                                "content": f"{CONTEXT_MARKER}:  " + "\n\n".join(sections)})
+    return prompt_messages
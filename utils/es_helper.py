@@ -1,14 +1,165 @@
-from elasticsearch import Elasticsearch
+import json
+import re
+import threading
+import time
+
+from elasticsearch import Elasticsearch, NotFoundError
+
+from utils.metrics_helper import metrics
+
+from variables import es_connections_per_node, es_request_timeout, es_max_retries, es_retry_on_timeout, \
+    index_versions_to_keep
+
+# Process-wide registry of Elasticsearch clients, keyed by connection details. Streamlit reruns the app
+# scripts on every interaction; reusing the client keeps HTTP keep-alive and TLS sessions warm.
+_es_clients = {}
+_es_clients_lock = threading.Lock()
 
 
 def create_es_client(username, password, cloudid):
     es = Elasticsearch(
         cloud_id=cloudid,
-        basic_auth=(username, password)
+        basic_auth=(username, password),
+        connections_per_node=es_connections_per_node,
+        request_timeout=es_request_timeout,
+        max_retries=es_max_retries,
+        retry_on_timeout=es_retry_on_timeout
     )
     return es
 
 
+def get_es_client(username, password, cloudid):
+    # Returns the shared client for these credentials, creating it on first use
+    key = (cloudid, username, password)
+    es = _es_clients.get(key)
+    if es is None:
+        with _es_clients_lock:
+            es = _es_clients.get(key)
+            if es is None:
+                es = create_es_client(username, password, cloudid)
+                _es_clients[key] = es
+                metrics.add_collector(publish_es_pool_gauges)
+    return es
+
+
+def es_pool_stats():
+    """
+    Connection pool usage for every registered Elasticsearch client.
+
+    Returns:
+    - A list with one dict per node: the pool's maxsize, idle connections and connections in use.
+    """
+    stats = []
+    for (cloudid, username, _), es in list(_es_clients.items()):
+        for node in es.transport.node_pool.all():
+            pool = getattr(node, "pool", None)
+            entry = {"client": f"{username}@{cloudid[:16]}", "node": str(node.base_url)}
+            # urllib3 pools hold a queue prefilled with None placeholders; checked out slots are missing from it
+            queue = getattr(pool, "pool", None)
+            if queue is not None:
+                entry.update({
+                    "maxsize": queue.maxsize,
+                    "idle": sum(1 for conn in list(queue.queue) if conn is not None),
+                    "in_use": queue.maxsize - queue.qsize(),
+                    "connections_opened": getattr(pool, "num_connections", 0),
+                    "requests": getattr(pool, "num_requests", 0),
+                })
+            stats.append(entry)
+    return stats
+
+
+def publish_es_pool_gauges():
+    # es_pool_stats as the es_pool_{maxsize,idle,in_use}_<node> gauges, sampled on every scrape
+    for entry in es_pool_stats():
+        node = re.sub(r"[^A-Za-z0-9]+", "_", entry["node"]).strip("_")
+        for field in ("maxsize", "idle", "in_use"):
+            if field in entry:
+                metrics.set_gauge(f"es_pool_{field}_{node}", entry[field])
+
+
+# Versioned indices: a refresh builds "<alias>-v<timestamp>" next to the live index and then moves the alias
+# in one update_aliases call, so searches never see a missing or half-filled index.
+
+def load_mappings(path):
+    with open(path) as f:
+        return json.load(f)["mappings"]
+
+
+def versioned_index_name(alias):
+    return f"{alias}-v{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+
+def list_index_versions(es, alias):
+    # Oldest first; the timestamp suffix sorts chronologically
+    try:
+        return sorted(es.indices.get(index=f"{alias}-v*", expand_wildcards="open"))
+    except NotFoundError:
+        return []
+
+
+def get_alias_indices(es, alias):
+    # Indices the alias currently points to, empty when it does not exist (or is a concrete index)
+    try:
+        return sorted(es.indices.get_alias(name=alias))
+    except NotFoundError:
+        return []
+
+
+def create_versioned_index(es, alias, mappings, settings=None):
+    index_name = versioned_index_name(alias)
+    es.indices.create(index=index_name, settings=settings, mappings=mappings)
+    print(f"Index {index_name} created successfully!")
+    return index_name
+
+
+def swap_alias(es, alias, new_index):
+    """
+    Atomically points alias at new_index.
+
+    A concrete index still carrying the alias name (from before versioned indices) is removed in the same
+    request, since an alias cannot share its name with an index. Its documents should already have been
+    copied into new_index.
+
+    Returns:
+    - The indices the alias pointed to before the swap.
+    """
+    previous = get_alias_indices(es, alias)
+    actions = [{"remove": {"index": index, "alias": alias}} for index in previous if index != new_index]
+    if not previous and es.indices.exists(index=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": new_index, "alias": alias, "is_write_index": True}})
+    es.indices.update_aliases(actions=actions)
+    print(f"Alias {alias} now points to {new_index} (was {', '.join(previous) or 'unset'})")
+    return previous
+
+
+def rollback_alias(es, alias):
+    """
+    Points alias back at the version built before the live one.
+
+    Returns:
+    - The index the alias now points to.
+    """
+    current = get_alias_indices(es, alias)
+    older = [index for index in list_index_versions(es, alias) if current and index < min(current)]
+    if not older:
+        raise ValueError(f"No previous version of {alias} to roll back to")
+    swap_alias(es, alias, older[-1])
+    return older[-1]
+
+
+def prune_index_versions(es, alias, keep=index_versions_to_keep):
+    # Deletes the oldest versions beyond keep, never one the alias points to
+    live = set(get_alias_indices(es, alias))
+    versions = list_index_versions(es, alias)
+    deleted = []
+    for index in versions[:max(len(versions) - keep, 0)]:
+        if index not in live:
+            es.indices.delete(index=index)
+            print(f"Index {index} deleted!")
+            deleted.append(index)
+    return deleted
+
 
 def manage_index(es: Elasticsearch, index_name: str, settings: dict, mappings: dict, deleteIndex: bool):
     if es.indices.exists(index=index_name):
@@ -40,4 +191,4 @@ def manage_index_no_mapping(es: Elasticsearch, index_name: str, deleteIndex: boo
     else:
         # Create new index with the specified mappings
         es.indices.create(index=index_name)
-        print(f"Index {index_name} created successfully!")
\ No newline at end of file
+        print(f"Index {index_name} created successfully!")
@@ -0,0 +1,159 @@
+import streamlit as st
+
+from variables import chat_history_token_budget, chat_context_token_budget, chat_summary_token_budget, \
+    openai_summary_deployment_name
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # Not installed, or the encoding file cannot be downloaded (offline hosts)
+    _encoding = None
+
+# Marker used by the chatbot for the message carrying the retrieved blog content
+CONTEXT_MARKER = "find the answer using this content only"
+
+# Per-message overhead of the chat format (role, separators), as documented for the gpt-3.5/4 family
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Rough fallback when tiktoken is not installed: ~4 characters per token
+    return len(text) // 4 + 1
+
+
+def count_message_tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+
+def truncate_to_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def is_pinned(message):
+    # The system prompt and the retrieved context are always sent
+    return message["role"] == "system" or CONTEXT_MARKER in message["content"]
+
+
+def summarize_turns(client, previous_summary, turns):
+    """
+    Folds older conversation turns into the rolling summary.
+
+    Parameters:
+    - client: The AzureOpenAI client.
+    - previous_summary: The current summary text, or an empty string.
+    - turns: The messages that are leaving the sliding window.
+
+    Returns:
+    - The updated summary text.
+    """
+    # Imported here: the rate limiter counts tokens with this module
+    from utils.ratelimit_helper import PRIORITY_INTERACTIVE, limited_completion
+
+    # Part of an interactive chat turn, so it is not queued behind background summaries
+    response = limited_completion(client, PRIORITY_INTERACTIVE, **summary_request(previous_summary, turns))
+    return response.choices[0].message.content.strip()
+
+
+def summary_request(previous_summary, turns):
+    # Chat completion arguments for folding turns into the summary, shared with the async service
+    transcript = "\n".join(f"{message['role'].title()}: {message['content']}" for message in turns)
+    return {
+        "model": openai_summary_deployment_name,
+        "max_tokens": chat_summary_token_budget,
+        "messages": [
+            {"role": "system",
+             "content": "You summarize conversations. Keep facts, names, numbers and open questions. Be brief."},
+            {"role": "user",
+             "content": f"Current summary: {previous_summary or 'None'}\n\nAdd these turns to it:\n{transcript}"}
+        ]
+    }
+
+
+def build_chat_messages(client, messages=None, budget=None):
+    """
+    Builds the message list sent to the chat model from the full session history.
+
+    The system prompt and retrieved context are pinned (the context is capped at
+    chat_context_token_budget), the most recent turns are kept in a sliding window, and turns that
+    fall out of the window are folded into a rolling summary kept in st.session_state. The session
+    history itself is left untouched for display.
+
+    Parameters:
+    - client: The AzureOpenAI client, used for summarization.
+    - messages: The full history. Defaults to st.session_state.messages.
+    - budget: Total prompt token budget. Defaults to chat_history_token_budget.
+
+    Returns:
+    - A tuple (prompt_messages, prompt_tokens).
+    """
+    messages = st.session_state.messages if messages is None else messages
+    pinned, conversation, window_start = select_chat_window(messages, budget)
+
+    summary = st.session_state.get("history_summary", "")
+    summarized_upto = st.session_state.get("history_summarized_upto", 0)
+    if window_start > summarized_upto:
+        summary = summarize_turns(client, summary, conversation[summarized_upto:window_start])
+        st.session_state.history_summary = summary
+        st.session_state.history_summarized_upto = window_start
+
+    return assemble_chat_messages(pinned, summary, conversation, window_start)
+
+
+def select_chat_window(messages, budget=None):
+    """
+    Splits the history into pinned messages and conversation turns, and picks the start of the sliding
+    window of recent turns that fits the token budget. Context held as document store references is
+    rehydrated first.
+
+    Returns:
+    - A tuple (pinned, conversation, window_start).
+    """
+    # Imported here: the context helper counts tokens with this module
+    from utils.context_helper import rehydrate_messages
+
+    budget = budget or chat_history_token_budget
+
+    pinned = []
+    conversation = []
+    for message in rehydrate_messages(messages):
+        if is_pinned(message):
+            if message["role"] != "system":
+                message = {"role": message["role"],
+                           "content": truncate_to_tokens(message["content"], chat_context_token_budget)}
+            pinned.append(message)
+        else:
+            conversation.append(message)
+
+    # Space for the window once the pinned messages and the summary allowance are taken out
+    available = budget - sum(count_message_tokens(message) for message in pinned) - chat_summary_token_budget
+
+    window_start = len(conversation)
+    used = 0
+    while window_start > 0:
+        tokens = count_message_tokens(conversation[window_start - 1])
+        # The latest message is always sent, even when it alone exceeds the budget
+        if used + tokens > available and window_start < len(conversation):
+            break
+        used += tokens
+        window_start -= 1
+
+    return pinned, conversation, window_start
+
+
+def assemble_chat_messages(pinned, summary, conversation, window_start):
+    # Pinned messages, then the rolling summary, then the window; returns (prompt_messages, prompt_tokens)
+    prompt_messages = list(pinned)
+    if summary:
+        prompt_messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+    prompt_messages.extend(conversation[window_start:])
+
+    prompt_tokens = sum(count_message_tokens(message) for message in prompt_messages)
+    return prompt_messages, prompt_tokens
@@ -0,0 +1,128 @@
+"""
+httpx transports that report connection pool usage through the public transport API.
+
+The wrapped HTTPTransport / AsyncHTTPTransport keeps its pool; the wrapper counts the requests whose
+response is still open, which is the number of connections in use, and publishes it as gauges.
+"""
+import re
+import threading
+
+import httpx
+
+from utils.metrics_helper import metrics
+
+
+class PoolTracker:
+    """
+    Connections in use for one pooled HTTP client, published as the gauges <prefix>_pool_in_use_<name>,
+    <prefix>_pool_peak_in_use_<name> and <prefix>_pool_max_connections_<name>, plus the counter
+    <prefix>_pool_requests_<name>.
+    """
+
+    def __init__(self, prefix, name, max_connections):
+        self.name = name
+        self.slug = f"{prefix}_pool_{{}}_{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')}"
+        self.max_connections = max_connections
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        metrics.set_gauge(self.slug.format("max_connections"), max_connections)
+        self._publish()
+
+    def started(self):
+        with self._lock:
+            self.in_use += 1
+            self.requests += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+        metrics.increment(self.slug.format("requests"))
+        self._publish()
+
+    def finished(self):
+        with self._lock:
+            self.in_use -= 1
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge(self.slug.format("in_use"), self.in_use)
+        metrics.set_gauge(self.slug.format("peak_in_use"), self.peak_in_use)
+
+    def stats(self):
+        return {"client": self.name, "max_connections": self.max_connections, "in_use": self.in_use,
+                "peak_in_use": self.peak_in_use, "requests": self.requests}
+
+
+class _TrackedStream(httpx.SyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            # The connection goes back to the pool once the response is closed
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+class _AsyncTrackedStream(httpx.AsyncByteStream):
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+class TrackedTransport(httpx.BaseTransport):
+    def __init__(self, tracker, limits):
+        self.tracker = tracker
+        self._transport = httpx.HTTPTransport(limits=limits)
+
+    def handle_request(self, request):
+        self.tracker.started()
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            self.tracker.finished()
+            raise
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_TrackedStream(response.stream, self.tracker.finished),
+                              extensions=response.extensions)
+
+    def close(self):
+        self._transport.close()
+
+
+class AsyncTrackedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, tracker, limits):
+        self.tracker = tracker
+        self._transport = httpx.AsyncHTTPTransport(limits=limits)
+
+    async def handle_async_request(self, request):
+        self.tracker.started()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self.tracker.finished()
+            raise
+        return httpx.Response(response.status_code, headers=response.headers,
+                              stream=_AsyncTrackedStream(response.stream, self.tracker.finished),
+                              extensions=response.extensions)
+
+    async def aclose(self):
+        await self._transport.aclose()
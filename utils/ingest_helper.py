@@ -0,0 +1,334 @@
+import json
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch import NotFoundError, helpers
+
+from utils.cache_helper import bump_index_generation, content_hash, get_passage_fingerprints, passage_fingerprint
+from utils.es_helper import create_versioned_index, load_mappings, prune_index_versions, swap_alias
+from utils.metrics_helper import logger
+
+from variables import model, elser_passage_model, passage_model_limit, byom_index_name, ingest_inference_batch_size, \
+    ingest_docs_per_batch, ingest_thread_count, ingest_chunk_size, byom_mapping_path, index_versions_to_keep
+
+# Same sentence boundaries as the painless script in additional_es_assets/Ingest_pipeline.chunker:
+# split on ". ", "! " and "? ", but not after "Mr.", "Ms." or "Mrs."
+SENTENCE_SPLIT = re.compile(r"(?:(?<!Mr\.)(?<!Ms\.)(?<!Mrs\.)(?<=\.) |(?<=!) |(?<=\?) )")
+
+
+def _java_length(text):
+    # String.length() in painless counts UTF-16 code units, so characters outside the BMP count twice
+    return len(text.encode("utf-16-le")) // 2
+
+
+def chunk_passages(body_content, model_limit=passage_model_limit):
+    """
+    Splits body_content into passages the way the chunker ingest pipeline does: sentences are
+    joined with a space while the passage stays under model_limit characters.
+
+    Returns:
+    - A list of {"text": ...} dicts. An empty body_content gives one empty passage, like the pipeline;
+      documents without body_content get none.
+    """
+    if body_content is None:
+        return []
+
+    sentences = SENTENCE_SPLIT.split(body_content)
+    # Java's String.split drops trailing empty strings, unless nothing matched
+    while len(sentences) > 1 and sentences[-1] == "":
+        sentences.pop()
+
+    passages = []
+    i = 0
+    while i < len(sentences):
+        text = sentences[i]
+        i += 1
+        while i < len(sentences) and _java_length(text) + _java_length(sentences[i]) < model_limit:
+            text = text + " " + sentences[i]
+            i += 1
+        passages.append({"text": text})
+    return passages
+
+
+def infer_batch(es, model_id, texts, batch_size=ingest_inference_batch_size):
+    """
+    Runs a trained model over many texts, batch_size docs per infer_trained_model call.
+
+    Returns:
+    - One inference result dict per text, in input order.
+    """
+    results = []
+    for start in range(0, len(texts), batch_size):
+        docs = [{"text_field": text} for text in texts[start:start + batch_size]]
+        response = es.ml.infer_trained_model(model_id=model_id, docs=docs)
+        results.extend(response.get('inference_results', []))
+    return results
+
+
+def infer_passages(es, model_id, texts, batch_size=ingest_inference_batch_size):
+    """
+    infer_batch with a passage fingerprint store in front: texts seen before (in this call or an earlier
+    ingest run) take their result from the store, only new texts are sent to the ML nodes.
+
+    Returns:
+    - One inference result dict per text, in input order.
+    - Stats: passages, duplicates (served without inference), inferred and inference_seconds.
+    """
+    store = get_passage_fingerprints()
+    results = {}
+    missing = []
+    for text in texts:
+        if text in results:
+            continue
+        result = store.get(passage_fingerprint(model_id, text))
+        results[text] = result
+        if result is None:
+            missing.append(text)
+
+    start_time = time.time()
+    if missing:
+        for text, result in zip(missing, infer_batch(es, model_id, missing, batch_size)):
+            results[text] = result
+            store.set(passage_fingerprint(model_id, text), result)
+    inference_seconds = time.time() - start_time if missing else 0.0
+
+    stats = {"passages": len(texts), "duplicates": len(texts) - len(missing), "inferred": len(missing),
+             "inference_seconds": inference_seconds}
+    return [results[text] for text in texts], stats
+
+
+def _inference_field(model_id, result):
+    # Same shape the inference processor writes to its target_field
+    return {
+        "predicted_value": result.get("predicted_value"),
+        "model_id": model_id,
+        "is_truncated": result.get("is_truncated", False)
+    }
+
+
+def _existing_passages(es, source_index, docs):
+    # Enriched passages already indexed in source_index, by id, for documents whose body_content is unchanged
+    ids = [doc["id"] for doc in docs if doc.get("id")]
+    if not source_index or not ids:
+        return {}
+    try:
+        response = es.mget(index=source_index, ids=ids,
+                           source_includes=["body_content_hash", "body_content", "passages"])
+    except NotFoundError:
+        return {}
+
+    existing = {}
+    for hit in response.get("docs", []):
+        source = hit.get("_source")
+        if not hit.get("found") or not source or not source.get("passages"):
+            continue
+        # Documents indexed before body_content_hash existed are hashed on the fly
+        existing[hit["_id"]] = (source.get("body_content_hash") or content_hash(source.get("body_content")),
+                                source["passages"])
+    return existing
+
+
+def enrich_documents(es, docs, model_limit=passage_model_limit, source_index=None):
+    """
+    Chunks a batch of crawled documents and adds MiniLM vectors and ELSER tokens to every passage,
+    with one set of batched inference calls per model for the whole batch.
+
+    With source_index set, documents whose body_content hash matches the copy in that index reuse its
+    passages and are not sent to inference.
+
+    Returns:
+    - The documents with 'passages' and 'body_content_hash' filled in.
+    """
+    return _enrich_batch(es, docs, model_limit, source_index)[0]
+
+
+def _enrich_batch(es, docs, model_limit, source_index):
+    # enrich_documents, also returning how many documents reused their existing passages and the
+    # infer_passages stats per model
+    for doc in docs:
+        doc["body_content_hash"] = content_hash(doc.get("body_content"))
+    existing = _existing_passages(es, source_index, docs)
+
+    reused = 0
+    inference = {}
+    passages = []
+    for doc in docs:
+        previous = existing.get(doc.get("id"))
+        if previous and previous[0] == doc["body_content_hash"]:
+            doc["passages"] = previous[1]
+            reused += 1
+            continue
+        doc["passages"] = chunk_passages(doc.get("body_content"), model_limit)
+        passages.extend(doc["passages"])
+
+    texts = [passage["text"] for passage in passages]
+    if texts:
+        for model_id, field in ((model, "vector"), (elser_passage_model, "content_embedding")):
+            results, inference[model_id] = infer_passages(es, model_id, texts)
+            for result, passage in zip(results, passages):
+                if result is not None:
+                    passage[field] = _inference_field(model_id, result)
+
+    return docs, reused, inference
+
+
+def read_jsonl(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bounded_map(executor, fn, iterable, max_in_flight):
+    # Like executor.map, but only keeps max_in_flight tasks queued so large inputs are streamed
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def generate_actions(es, docs, index_name, thread_count=ingest_thread_count, docs_per_batch=ingest_docs_per_batch,
+                     model_limit=passage_model_limit, source_index=None, counts=None):
+    # Enrich document batches on a thread pool and turn them into bulk index actions, in input order.
+    # counts, if given, is updated with the number of reused and enriched documents and, per model id, the
+    # summed infer_passages stats.
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        enriched = _bounded_map(executor, lambda batch: _enrich_batch(es, batch, model_limit, source_index),
+                                _batches(docs, docs_per_batch), thread_count * 2)
+        for batch, reused, inference in enriched:
+            if counts is not None:
+                counts["reused"] += reused
+                counts["enriched"] += len(batch) - reused
+                for model_id, stats in inference.items():
+                    totals = counts["inference"].setdefault(model_id, dict.fromkeys(stats, 0))
+                    for key, value in stats.items():
+                        totals[key] += value
+            for doc in batch:
+                action = {"_index": index_name, "_source": doc}
+                if doc.get("id"):
+                    action["_id"] = doc["id"]
+                yield action
+
+
+def ingest_documents(es, docs, index_name=byom_index_name, thread_count=ingest_thread_count,
+                     chunk_size=ingest_chunk_size, docs_per_batch=ingest_docs_per_batch,
+                     model_limit=passage_model_limit, source_index=None):
+    """
+    Chunks, embeds and bulk loads crawled documents without the chunker ingest pipeline.
+
+    Parameters:
+    - es: Elasticsearch client (or a compatible stand-in providing ml.infer_trained_model and bulk).
+    - docs: Iterable of crawled documents.
+    - index_name: Target index.
+    - thread_count: Worker threads for both inference and parallel_bulk.
+    - chunk_size: Documents per bulk request.
+    - docs_per_batch: Documents whose passages share one set of inference calls.
+    - model_limit: Maximum passage length in characters.
+    - source_index: Index (or alias) whose passages are reused for documents with an unchanged body_content.
+
+    Returns:
+    - A dict with indexed/failed counts, reused/enriched counts, elapsed seconds, docs_per_sec and the
+      passage dedup stats from dedup_summary.
+    """
+    start_time = time.time()
+    indexed = 0
+    failed = 0
+    counts = {"reused": 0, "enriched": 0, "inference": {}}
+
+    actions = generate_actions(es, docs, index_name, thread_count, docs_per_batch, model_limit, source_index,
+                               counts)
+    for ok, item in helpers.parallel_bulk(es, actions, thread_count=thread_count, chunk_size=chunk_size,
+                                          raise_on_error=False):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+            logger.warning(f"Failed to index document: {item}")
+
+    # Results cached against the old content must not be served any more
+    bump_index_generation(es, index_name)
+
+    elapsed = time.time() - start_time
+    return {
+        "indexed": indexed,
+        "failed": failed,
+        "reused": counts["reused"],
+        "enriched": counts["enriched"],
+        "elapsed": elapsed,
+        "docs_per_sec": indexed / elapsed if elapsed else 0.0,
+        **dedup_summary(counts["inference"])
+    }
+
+
+def dedup_summary(inference):
+    """
+    Summarizes summed infer_passages stats per model id.
+
+    The time saved is estimated per model from its average inference time per inferred passage, since ELSER
+    is much slower than MiniLM.
+
+    Returns:
+    - passages, duplicate_passages, duplicate_ratio, inference_seconds and inference_seconds_saved.
+    """
+    passages = sum(stats["passages"] for stats in inference.values())
+    duplicates = sum(stats["duplicates"] for stats in inference.values())
+    saved = sum(stats["duplicates"] * stats["inference_seconds"] / stats["inferred"]
+                for stats in inference.values() if stats["inferred"])
+    return {
+        "passages": passages,
+        "duplicate_passages": duplicates,
+        "duplicate_ratio": duplicates / passages if passages else 0.0,
+        "inference_seconds": sum(stats["inference_seconds"] for stats in inference.values()),
+        "inference_seconds_saved": saved
+    }
+
+
+def reindex_documents(es, docs, alias=byom_index_name, mappings_path=byom_mapping_path,
+                      thread_count=ingest_thread_count, chunk_size=ingest_chunk_size,
+                      docs_per_batch=ingest_docs_per_batch, model_limit=passage_model_limit,
+                      keep=index_versions_to_keep):
+    """
+    Rebuilds the index behind alias without downtime: documents are loaded into a new versioned index,
+    reusing the passages of the live index where body_content is unchanged, then the alias is swapped
+    atomically. Older versions beyond keep are deleted; the previous one stays available for rollback.
+
+    The alias is left untouched when any document fails to index.
+
+    Returns:
+    - The ingest_documents stats plus the new index name, the previous indices and whether the alias moved.
+    """
+    # Read passages through the alias, or the concrete index still using its name on the first run
+    source_index = alias if es.indices.exists(index=alias) else None
+    new_index = create_versioned_index(es, alias, load_mappings(mappings_path))
+
+    stats = ingest_documents(es, docs, new_index, thread_count, chunk_size, docs_per_batch, model_limit,
+                             source_index)
+    stats.update({"index": new_index, "previous": [], "swapped": False})
+    if stats["failed"]:
+        logger.warning(f"{stats['failed']} documents failed, {alias} still points to the previous index. "
+                       f"{new_index} was kept for inspection.")
+        return stats
+
+    es.indices.refresh(index=new_index)
+    stats["previous"] = swap_alias(es, alias, new_index)
+    stats["swapped"] = True
+    prune_index_versions(es, alias, keep)
+    bump_index_generation(es, alias)
+    return stats
@@ -0,0 +1,233 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from variables import log_level, trace_log_path, metrics_port
+
+logger = logging.getLogger("ciscoblogsearch")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+logger.setLevel(os.environ.get("CISCOBLOGSEARCH_LOG_LEVEL", log_level))
+
+# Latency histogram bucket bounds in milliseconds
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+def debug_json(label, payload):
+    # Only pay for serializing queries and vectors when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s: %s", label, json.dumps(payload, indent=4, default=str))
+
+
+class _Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS_MS)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(BUCKETS_MS):
+            if value <= bound:
+                self.buckets[i] += 1
+
+
+class _Metrics:
+    """
+    Process-wide span histograms and counters, exported as JSON lines and Prometheus text.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._collectors = []
+        self._trace_file = None
+
+    def record_span(self, span):
+        with self._lock:
+            self.histograms.setdefault(span["name"], _Histogram()).observe(span["duration_ms"])
+            if trace_log_path:
+                if self._trace_file is None:
+                    directory = os.path.dirname(trace_log_path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    self._trace_file = open(trace_log_path, "a", buffering=1, encoding="utf-8")
+                self._trace_file.write(json.dumps(span, default=str) + "\n")
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms.setdefault(name, _Histogram()).observe(value)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def add_collector(self, fn):
+        # fn() sets gauges sampled from state kept elsewhere; it runs before every snapshot and scrape
+        with self._lock:
+            if fn not in self._collectors:
+                self._collectors.append(fn)
+
+    def _collect(self):
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", getattr(collector, "__name__", collector), e)
+
+    def snapshot(self):
+        self._collect()
+        with self._lock:
+            return {
+                "spans": {name: {"count": h.count, "sum_ms": h.total} for name, h in self.histograms.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def prometheus(self):
+        self._collect()
+        lines = []
+        with self._lock:
+            if self.histograms:
+                lines.append("# TYPE ciscoblogsearch_span_duration_ms histogram")
+            for name, histogram in sorted(self.histograms.items()):
+                # Buckets are already cumulative: observe() counts a value in every bucket it fits
+                for bound, count in zip(BUCKETS_MS, histogram.buckets):
+                    lines.append(f'ciscoblogsearch_span_duration_ms_bucket{{span="{name}",le="{bound}"}} {count}')
+                lines.append(f'ciscoblogsearch_span_duration_ms_bucket{{span="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'ciscoblogsearch_span_duration_ms_sum{{span="{name}"}} {histogram.total}')
+                lines.append(f'ciscoblogsearch_span_duration_ms_count{{span="{name}"}} {histogram.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE ciscoblogsearch_{name}_total counter")
+                lines.append(f"ciscoblogsearch_{name}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE ciscoblogsearch_{name} gauge")
+                lines.append(f"ciscoblogsearch_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = _Metrics()
+
+
+@contextmanager
+def trace(name, **attributes):
+    """
+    Starts a new trace for one user request; spans recorded inside it share its trace id.
+    """
+    token = _trace_id.set(uuid.uuid4().hex[:16])
+    try:
+        with span(name, **attributes) as root:
+            yield root
+    finally:
+        _trace_id.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times a block and records it as a span. The yielded dict can be filled with extra attributes,
+    e.g. the ES 'took' next to the client-side time.
+
+        with span("es_search", searchtype=searchtype) as s:
+            results = es.search(...)
+            s["es_took_ms"] = results["took"]
+    """
+    attributes = dict(attributes)
+    start_time = time.time()
+    error = None
+    try:
+        yield attributes
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        record_span(name, start_time, (time.time() - start_time) * 1000, error, **attributes)
+
+
+def record_span(name, start_time, duration_ms, error=None, **attributes):
+    # For spans that cannot be a with block, e.g. across the yields of a streaming generator
+    record = {
+        "name": name,
+        "trace_id": _trace_id.get(),
+        "start": start_time,
+        "duration_ms": duration_ms,
+        "attributes": attributes,
+    }
+    if error:
+        record["error"] = error
+    metrics.record_span(record)
+    logger.debug("span %s %.1fms %s", name, duration_ms, attributes)
+
+
+def propagate_context(fn):
+    # Wraps fn so it runs with the caller's trace id when submitted to a thread pool
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body = metrics.prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path.startswith("/stats"):
+            body = json.dumps(metrics.snapshot()).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=None):
+    """
+    Serves /metrics (Prometheus text) and /stats (JSON) on a background thread. Safe to call on every
+    Streamlit rerun; only the first call starts the server. Does nothing when no port is configured.
+    """
+    global _metrics_server
+    port = port or metrics_port
+    if not port or _metrics_server is not None:
+        return _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+            except OSError as e:
+                # Another process (e.g. the other app) already serves this port
+                logger.warning("Metrics server not started on port %s: %s", port, e)
+                return None
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            _metrics_server = server
+    return _metrics_server
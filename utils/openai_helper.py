@@ -1,57 +1,83 @@
+import json
+import logging
 import openai
+import threading
 import time
-
-from variables import openai_completion_deployment_name, openai_api_sa_base
-
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from variables import openai_completion_deployment_name, openai_api_sa_base, openai_summary_concurrency, \
+    openai_retry_attempts, openai_summary_deployment_name, \
+    openai_max_connections, openai_max_keepalive_connections, openai_request_timeout, openai_max_retries, \
+    rag_top_n_docs, summary_mode, batched_summary_doc_tokens, batched_summary_completion_tokens
+
+from utils.cache_helper import get_cached_answer, set_cached_answer
+from utils.context_helper import build_passage_context, first_passage, format_sources, matched_passages, \
+    rehydrate_messages
+from utils.history_helper import count_tokens, truncate_to_tokens
+from utils.http_helper import PoolTracker, TrackedTransport
+from utils.metrics_helper import logger, metrics, propagate_context, record_span, span
+from utils.ratelimit_helper import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, limited_completion
+
+import httpx
 import streamlit as st
 from openai import AzureOpenAI
 
+# Bump whenever the per-hit summary prompt changes so cached answers from the old prompt are not reused
+SUMMARY_PROMPT_VERSION = 1
+# Same for the batched summary prompt; its answers are cached apart from the per-hit ones
+BATCHED_SUMMARY_PROMPT_VERSION = 1
+
+# Process-wide registry of Azure OpenAI clients, keyed by endpoint, key and API version, so every
+# Streamlit session and rerun shares one pooled HTTP client
+_openai_clients = {}
+_openai_pool_trackers = {}
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key, azure_endpoint, api_version):
+    key = (azure_endpoint, api_key, api_version)
+    client = _openai_clients.get(key)
+    if client is None:
+        with _openai_clients_lock:
+            client = _openai_clients.get(key)
+            if client is None:
+                # The transport is built here so its pool usage can be tracked without httpx internals
+                tracker = PoolTracker("openai", f"{httpx.URL(azure_endpoint).host}_{api_version}",
+                                      openai_max_connections)
+                limits = httpx.Limits(max_connections=openai_max_connections,
+                                      max_keepalive_connections=openai_max_keepalive_connections)
+                http_client = httpx.Client(transport=TrackedTransport(tracker, limits), timeout=openai_request_timeout)
+                _openai_pool_trackers[key] = tracker
+                client = AzureOpenAI(
+                    azure_endpoint=azure_endpoint,
+                    api_key=api_key,
+                    api_version=api_version,
+                    max_retries=openai_max_retries,
+                    timeout=openai_request_timeout,
+                    http_client=http_client
+                )
+                _openai_clients[key] = client
+    return client
 
 
-def get_chat_guidance_rag(prompt, client, results, conversation_history):
-    # Prepare the messages for Azure OpenAI, including the system message
-
-    blog_bodies = []
-    urls = []
-    titles = []
-    passages_texts = []
-    scores = []
-
-    # Check if there are any hits
-    if results['hits']['hits']:
-        # Process up to the first 3 results
-        for hit in results['hits']['hits'][:3]:  # Limit to first 3 results
-            source = hit["_source"]
-
-            # Extract and accumulate the body content
-            blog_body = source.get("body_content", "No body content available")
-            blog_bodies.append(blog_body)
-
-            # Extract and accumulate the URL, preferring 'additional_urls' if available and non-empty
-            additional_urls = source.get("additional_urls", [])
-            url = additional_urls[0] if additional_urls else source.get("url", "No URL available")
-            urls.append(url)
-
-            # Extract and accumulate the title
-            title = source.get("title", "No title available")
-            titles.append(title)
+def openai_pool_stats():
+    """
+    Connection pool usage for every registered Azure OpenAI client, also published as the
+    openai_pool_* gauges.
 
-            # Extract and accumulate the first passage text if passages exist and are non-empty
-            passages = source.get("passages", [])
-            first_passage_text = passages[0].get("text",
-                                                 "No passages text available") if passages else "No passages available"
-            passages_texts.append(first_passage_text)
+    Returns:
+    - A list with one dict per client: configured max connections, connections in use, peak and requests.
+    """
+    return [tracker.stats() for tracker in list(_openai_pool_trackers.values())]
 
-            # Extract and accumulate the score
-            score = hit["_score"]
-            scores.append(score)
 
-    # Concatenate the body contents of up to the first 3 documents into a single blog_body field
-    #blog_body = " ".join(blog_bodies)
+def get_chat_guidance_rag(prompt, client, results, conversation_history):
+    # Prepare the messages for Azure OpenAI, including the system message
 
-    #print("Blog Bodies:", blog_body)
+    # Only the best matching passages of the top 3 results, packed into the context token budget
+    context, sources = build_passage_context(results, top_n=rag_top_n_docs)
 
-    st.session_state.messages.append({"role": "user", "content": f"Answer this question or comment: {prompt} using this text: {blog_body}. If the answer is not in the text, simply return NO ANSWER"})
+    st.session_state.messages.append({"role": "user", "content": f"Answer this question or comment: {prompt} using this text: {context}. If the answer is not in the text, simply return NO ANSWER"})
 
 
     # Print the messages array for debugging or logging purposes
@@ -60,29 +86,39 @@ def get_chat_guidance_rag(prompt, client, results, conversation_history):
     #     print(f"{message['role'].title()}: {message['content']}")
 
     # Generate response from Azure OpenAI
-    response = client.chat.completions.create(
+    response = limited_completion(
+        client, PRIORITY_INTERACTIVE,
         model="gpt-35-turbo-16k",
         messages=st.session_state.messages
     )
 
-    # Extract the text from the response
-    return response.choices[0].message.content.strip()
+    # Extract the text from the response and attribute it to the blogs the context came from
+    answer = response.choices[0].message.content.strip()
+    if sources and "NO ANSWER" not in answer:
+        answer = f"{answer}\n\n{format_sources(sources)}"
+    return answer
 
 
 def get_chat_guidance(client):
     # Prepare the messages for Azure OpenAI, including the system message
 
 
-    # # Print the messages array for debugging or logging purposes
-    print("Messages being sent to Azure OpenAI:")
-    for message in st.session_state.messages:
-       print(f"{message['role'].title()}: {message['content']}")
+    # The session keeps references to the retrieved documents; the prompt gets their text
+    messages = rehydrate_messages(st.session_state.messages)
+
+    # Log the messages array for debugging purposes
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Messages being sent to Azure OpenAI:")
+        for message in messages:
+            logger.debug(f"{message['role'].title()}: {message['content']}")
 
     # Generate response from Azure OpenAI
-    response = client.chat.completions.create(
-        model=openai_completion_deployment_name,
-        messages=st.session_state.messages
-    )
+    with span("llm_completion", deployment=openai_completion_deployment_name):
+        response = limited_completion(
+            client, PRIORITY_INTERACTIVE,
+            model=openai_completion_deployment_name,
+            messages=messages
+        )
 
 
     # Extract the text from the response
@@ -90,110 +126,363 @@ def get_chat_guidance(client):
 
 
 
-def get_openai_large_guidance(user_query, results, num_results, searchtype):
-    client = AzureOpenAI(
-        azure_endpoint=openai_api_sa_base,
-        api_key=st.secrets['sa_pass'],
-        api_version="2023-05-15"
-    )
-
-    processed_results = []
-    retry_attempts = 3  # Number of retries before failing
-
-    query_response_time = results['took']
+def get_chat_guidance_stream(client, timings=None, messages=None):
+    """
+    Streaming variant of get_chat_guidance. Yields response text fragments as they arrive.
 
-    text = None
-    url = None
-    title = None
-    first_passage_text = None
-
-    for idx in range(num_results):
-        genai_start_time = time.time()
-
-
-        try:
-            text = results['hits']['hits'][idx]["_source"]["body_content"]
-            # Accessing the first value of 'additional_urls' if it exists and has at least one URL
-            if results['hits']['hits'][idx]["_source"].get("additional_urls") and len(
-                    results['hits']['hits'][idx]["_source"]["additional_urls"]) > 0:
-                url = results['hits']['hits'][idx]["_source"]["additional_urls"][0]
-            else:
-                url = results['hits']['hits'][idx]["_source"]["url"]
-            title = results['hits']['hits'][idx]["_source"]["title"]
-            # Accessing the first instance of 'passages.text'
-            # Check if 'passages' exists and has at least one item
-            if results['hits']['hits'][idx]["_source"].get("passages") and len(
-                    results['hits']['hits'][idx]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][idx]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
-
-        except KeyError:
-            text = None
-            url = None
-            title = None
-
-        score = results['hits']['hits'][idx]["_score"]
-
-        for _ in range(retry_attempts):
-            try:
-
-                response = client.chat.completions.create(
-                    model="gpt-35-turbo",  # model = "deployment_name".
-                    messages=[
-                        {"role": "system",
-                         "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
-                        {"role": "user",
-                         "content": f"Answer this question. Keep the response less than 30 words.  {user_query} based on the following text {text}"}
-                    ]
-                )
+    Parameters:
+    - client: The AzureOpenAI client.
+    - timings: Optional dict, filled with 'time_to_first_token' and 'total_time' in milliseconds.
+    - messages: The prompt messages. Defaults to st.session_state.messages. Context references are
+      rehydrated from the document store.
+    """
 
-                genai_end_time = time.time()
-                genai_query_time = (genai_end_time - genai_start_time) * 1000
+    messages = rehydrate_messages(st.session_state.messages if messages is None else messages)
 
-                completion_output = response.choices[0].message.content
+    start_time = time.time()
+    first_token_time = None
 
-                processed_results.append(
-                    (text, completion_output, score, query_response_time, genai_query_time, url, title, first_passage_text))
-                break  # If successful, break out of the retry loop
-
-            except openai.error.RateLimitError as e:
-                # Handle rate limit error
-                if _ < retry_attempts - 1:  # If it's not the last attempt
-                    print(f"Rate Limit Error: {e}. Retrying in 1 second...")
-                    time.sleep(1)  # Wait for 1 second before retrying
-                else:
-                    print(f"Rate Limit Error: {e}. No more retries.")
-
-            except openai.error.APIError as e:
-                print(f"OpenAI API returned an API Error: {e}")
-                break
+    # Generate response from Azure OpenAI; chat turns go ahead of queued background summaries
+    stream = limited_completion(
+        client, PRIORITY_INTERACTIVE,
+        model=openai_completion_deployment_name,
+        messages=messages,
+        stream=True
+    )
 
-            except openai.error.AuthenticationError as e:
-                print(f"OpenAI API returned an Authentication Error: {e}")
-                break
+    for chunk in stream:
+        # Azure sends a leading chunk with only content filter results and no choices
+        if not chunk.choices:
+            continue
+        token = chunk.choices[0].delta.content
+        if not token:
+            continue
+        if first_token_time is None:
+            first_token_time = time.time()
+        yield token
+
+    end_time = time.time()
+    time_to_first_token = ((first_token_time or end_time) - start_time) * 1000
+    total_time = (end_time - start_time) * 1000
+    if timings is not None:
+        timings["time_to_first_token"] = time_to_first_token
+        timings["total_time"] = total_time
+    record_span("llm_stream", start_time, total_time, deployment=openai_completion_deployment_name,
+                time_to_first_token_ms=time_to_first_token)
+
+
+def extract_hit_fields(hit):
+    # Pull the fields the blog search page renders out of a single ES hit
+    try:
+        source = hit["_source"]
+        text = source["body_content"]
+        # Accessing the first value of 'additional_urls' if it exists and has at least one URL
+        if source.get("additional_urls") and len(source["additional_urls"]) > 0:
+            url = source["additional_urls"][0]
+        else:
+            url = source["url"]
+        title = source["title"]
+        first_passage_text = first_passage(hit) or "No passages text available"
+    except KeyError:
+        text = None
+        url = None
+        title = None
+        first_passage_text = None
+
+    return text, url, title, first_passage_text
+
+
+def summary_prompt_messages(user_query, text):
+    return [
+        {"role": "system",
+         "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities."},
+        {"role": "user",
+         "content": f"Answer this question. Keep the response less than 30 words.  {user_query} based on the following text {text}"}
+    ]
+
+
+def hit_summary_result(hit, completion_output, query_response_time, genai_start_time):
+    # The processed result tuple the blog search page renders for one summarized hit
+    text, url, title, first_passage_text = extract_hit_fields(hit)
+    genai_query_time = (time.time() - genai_start_time) * 1000
+    return (text, completion_output, hit["_score"], query_response_time, genai_query_time, url, title,
+            first_passage_text)
+
+
+def _hit_doc_id(hit):
+    return hit.get("_source", {}).get("id", hit.get("_id"))
+
+
+def cached_hit_summary(user_query, hit, query_response_time, genai_start_time,
+                       prompt_version=SUMMARY_PROMPT_VERSION):
+    # The processed result from the answer cache, or None. Reads the SQLite tier: async callers run it in a thread
+    text, _, _, _ = extract_hit_fields(hit)
+    completion_output = get_cached_answer(user_query, _hit_doc_id(hit), text, openai_summary_deployment_name,
+                                          prompt_version)
+    if completion_output is None:
+        return None
+    metrics.increment("answer_cache_hits")
+    return hit_summary_result(hit, completion_output, query_response_time, genai_start_time)
+
+
+def store_hit_summary(user_query, hit, completion_output, prompt_version=SUMMARY_PROMPT_VERSION):
+    text, _, _, _ = extract_hit_fields(hit)
+    set_cached_answer(user_query, _hit_doc_id(hit), text, openai_summary_deployment_name, prompt_version,
+                      completion_output, hit.get("_source", {}).get("last_crawled_at"))
+
+
+def log_summary_error(e):
+    # Logs why a summary completion failed; call from the except block so unexpected errors keep their traceback
+    if isinstance(e, openai.RateLimitError):
+        logger.error(f"Rate Limit Error: {e}. No more retries.")
+    elif isinstance(e, TimeoutError):
+        logger.error(f"Rate limiter queue: {e}")
+    elif isinstance(e, openai.AuthenticationError):
+        logger.error(f"OpenAI API returned an Authentication Error: {e}")
+    elif isinstance(e, openai.BadRequestError):
+        logger.error(f"Invalid Request Error: {e}")
+    elif isinstance(e, openai.APITimeoutError):
+        logger.error(f"Request timed out: {e}")
+    elif isinstance(e, openai.APIConnectionError):
+        logger.error(f"Failed to connect to OpenAI API: {e}")
+    elif isinstance(e, openai.APIError):
+        logger.error(f"OpenAI API returned an API Error: {e}")
+    else:
+        logger.exception("An unexpected exception has occurred.")
+
+
+def _summarize_hit(client, user_query, hit, query_response_time, retry_attempts):
+    genai_start_time = time.time()
+
+    # Identical query/document pairs reuse the earlier answer as long as the document has not changed
+    cached = cached_hit_summary(user_query, hit, query_response_time, genai_start_time)
+    if cached is not None:
+        return cached
+
+    text, _, _, _ = extract_hit_fields(hit)
+    try:
+        # Queued behind the deployment's rate limiter; rate limit errors are retried there
+        with span("llm_completion", deployment=openai_summary_deployment_name):
+            response = limited_completion(
+                client, PRIORITY_BACKGROUND, retry_attempts,
+                model=openai_summary_deployment_name,  # model = "deployment_name".
+                messages=summary_prompt_messages(user_query, text)
+            )
+
+        completion_output = response.choices[0].message.content
+        store_hit_summary(user_query, hit, completion_output)
+        return hit_summary_result(hit, completion_output, query_response_time, genai_start_time)
+
+    except Exception as e:
+        log_summary_error(e)
+
+    return None
+
+
+def batched_summary_passages(hit, token_budget=batched_summary_doc_tokens):
+    # The best matching passages of one hit, up to token_budget; the body when the hit has no passages
+    passages = sorted(matched_passages(hit), key=lambda passage: passage[0], reverse=True)
+    selected = []
+    used = 0
+    for _, text in passages:
+        tokens = count_tokens(text)
+        if used + tokens > token_budget:
+            if not selected:
+                selected.append(truncate_to_tokens(text, token_budget))
+            break
+        selected.append(text)
+        used += tokens
+    if not selected:
+        return truncate_to_tokens(hit.get("_source", {}).get("body_content") or "", token_budget)
+    return "\n".join(selected)
+
+
+def batched_summary_messages(user_query, documents):
+    """
+    One prompt asking for a short answer per document.
+
+    Parameters:
+    - user_query: The user's question.
+    - documents: List of (doc_id, text) pairs.
+    """
+    blocks = "\n\n".join(f'<document id="{doc_id}">\n{text}\n</document>' for doc_id, text in documents)
+    return [
+        {"role": "system",
+         "content": "You are an AI assistant. Your answers should stay short and concise. explain your answer. no formalities. "
+                    "Reply with JSON only."},
+        {"role": "user",
+         "content": f"Answer this question for each document below, using only that document's text. Keep each answer "
+                    f"less than 30 words.  {user_query}\n\n{blocks}\n\n"
+                    f'Return a JSON array with one object per document: [{{"id": "<document id>", "insight": "<answer>"}}]'}
+    ]
+
+
+def parse_batched_insights(content, doc_ids):
+    """
+    Validates a batched summary response.
+
+    Parameters:
+    - content: The completion text, a JSON array of {"id", "insight"} objects, possibly wrapped in prose,
+      a code fence or an object.
+    - doc_ids: The document ids that were asked for.
+
+    Returns:
+    - A dict {doc_id: insight} with the valid answers; unknown ids, duplicates and empty answers are dropped.
+
+    Raises:
+    - ValueError when the content holds no parseable JSON array.
+    """
+    start, end = content.find("["), content.rfind("]")
+    if start == -1 or end < start:
+        raise ValueError("no JSON array in the batched summary response")
+    entries = json.loads(content[start:end + 1])
+
+    wanted = {str(doc_id): doc_id for doc_id in doc_ids}
+    insights = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        doc_id = wanted.get(str(entry.get("id")))
+        insight = entry.get("insight")
+        if doc_id is None or doc_id in insights or not isinstance(insight, str) or not insight.strip():
+            continue
+        insights[doc_id] = insight.strip()
+    return insights
+
+
+def plan_batched_summary(user_query, hits, query_response_time):
+    """
+    Splits hits into cached answers and the documents the batched request has to cover. Reads the answer
+    cache: async callers run it in a thread.
+
+    Returns:
+    - A tuple (answered, pending, kwargs): answered maps rank to a processed result tuple, pending is a list
+      of (rank, hit, doc_id) and kwargs are the completion arguments, or None when nothing is pending.
+    """
+    genai_start_time = time.time()
+    answered = {}
+    pending = []
+    documents = []
+    for rank, hit in enumerate(hits):
+        cached = cached_hit_summary(user_query, hit, query_response_time, genai_start_time,
+                                    f"batched-{BATCHED_SUMMARY_PROMPT_VERSION}")
+        if cached is not None:
+            answered[rank] = cached
+        else:
+            doc_id = _hit_doc_id(hit)
+            pending.append((rank, hit, doc_id))
+            documents.append((doc_id, batched_summary_passages(hit)))
+
+    if not pending:
+        return answered, pending, None
+    return answered, pending, {
+        "model": openai_summary_deployment_name,
+        "messages": batched_summary_messages(user_query, documents),
+        "max_tokens": batched_summary_completion_tokens * len(pending)
+    }
+
+
+def apply_batched_insights(user_query, pending, content, query_response_time, genai_start_time):
+    """
+    Maps a batched summary response back onto its hits and caches the answers (async callers run it in a
+    thread).
+
+    Returns:
+    - A dict {rank: processed result tuple} for the hits that got a valid answer; an empty dict when the
+      response could not be parsed.
+    """
+    try:
+        insights = parse_batched_insights(content or "", [doc_id for _, _, doc_id in pending])
+    except ValueError as e:
+        metrics.increment("batched_summary_parse_failures")
+        logger.warning(f"Batched summary response could not be parsed: {e}")
+        return {}
+
+    answered = {}
+    for rank, hit, doc_id in pending:
+        completion_output = insights.get(doc_id)
+        if completion_output is None:
+            continue
+        store_hit_summary(user_query, hit, completion_output, f"batched-{BATCHED_SUMMARY_PROMPT_VERSION}")
+        answered[rank] = hit_summary_result(hit, completion_output, query_response_time, genai_start_time)
+    return answered
+
+
+def _summarize_hits_batched(client, user_query, hits, query_response_time, retry_attempts):
+    # Summarizes all hits in one completion; returns {rank: result} for the hits it could answer
+    genai_start_time = time.time()
+    answered, pending, kwargs = plan_batched_summary(user_query, hits, query_response_time)
+    if not pending:
+        return answered
+
+    try:
+        with span("llm_completion", deployment=openai_summary_deployment_name, documents=len(pending)):
+            response = limited_completion(client, PRIORITY_BACKGROUND, retry_attempts, **kwargs)
+    except (openai.OpenAIError, TimeoutError) as e:
+        logger.error(f"Batched summary failed: {e}")
+        return answered
+
+    answered.update(apply_batched_insights(user_query, pending, response.choices[0].message.content,
+                                           query_response_time, genai_start_time))
+    return answered
+
+
+def get_openai_large_guidance(user_query, results, num_results, searchtype, max_workers=None, client=None,
+                              mode=None):
+    hits = results['hits']['hits'][:num_results]
+    if not hits:
+        return [], results
+
+    # Collected back into rank order so the processed results match the order ES returned the hits
+    processed_results = [None] * len(hits)
+    for rank, result in iter_openai_large_guidance(user_query, results, num_results, max_workers, client, mode):
+        processed_results[rank] = result
+
+    # Hits whose completion failed after all retries are dropped, as before
+    processed_results = [result for result in processed_results if result is not None]
 
-            except openai.error.APIConnectionError as e:
-                print(f"Failed to connect to OpenAI API: {e}")
-                break
+    return processed_results, results
 
-            except openai.error.InvalidRequestError as e:
-                print(f"Invalid Request Error: {e}")
-                break
 
-            except openai.error.ServiceUnavailableError as e:
-                print(f"Service Unavailable: {e}")
-                break
+def iter_openai_large_guidance(user_query, results, num_results, max_workers=None, client=None, mode=None):
+    """
+    Summarizes the top num_results hits and yields each summary as soon as it finishes.
 
-            except openai.error.Timeout as e:
-                print(f"Request timed out: {e}")
-                break
+    In "per_hit" mode every hit gets its own completion, run concurrently. In "batched" mode one completion
+    answers all hits as a JSON array; hits it misses, or all of them when the response is not valid JSON,
+    fall back to per-hit completions.
 
-            except:
-                # Handles all other exceptions
-                print("An unexpected exception has occurred.")
-                break
+    Yields:
+    - Tuples (rank, result): rank is the hit's position in results, result is the processed result tuple
+      of get_openai_large_guidance, or None when its completion failed.
+    """
+    if client is None:
+        client = get_openai_client(st.secrets['sa_pass'], openai_api_sa_base, "2023-05-15")
 
-            time.sleep(4)
+    retry_attempts = openai_retry_attempts  # Number of retries before failing
+    max_workers = max_workers or openai_summary_concurrency
+    mode = mode or summary_mode
 
-    return processed_results, results
+    query_response_time = results['took']
+    hits = results['hits']['hits'][:num_results]
+    if not hits:
+        return
+
+    pending = list(enumerate(hits))
+    if mode == "batched":
+        answered = _summarize_hits_batched(client, user_query, hits, query_response_time, retry_attempts)
+        for rank, result in sorted(answered.items()):
+            yield rank, result
+        pending = [(rank, hit) for rank, hit in pending if rank not in answered]
+        if not pending:
+            return
+        metrics.increment("batched_summary_fallbacks", len(pending))
+        logger.info(f"Batched summary missed {len(pending)} of {len(hits)} hits, summarizing them one by one")
+
+    # Fan out one completion per hit
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pending)))) as executor:
+        futures = {executor.submit(propagate_context(_summarize_hit), client, user_query, hit, query_response_time,
+                                   retry_attempts): rank
+                   for rank, hit in pending}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
@@ -1,12 +1,67 @@
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from variables import  model, vector_embedding_field, byom_index_name
+from variables import  model, vector_embedding_field, byom_index_name, rag_top_n_docs, rag_passages_per_doc, \
+    rrf_mode, hybrid_fusion, hybrid_weights, ingest_inference_batch_size, batch_msearch_chunk_size, batch_max_in_flight, \
+    byom_int8_index_name, quantized_rescore_oversample, knn_settings_path
 
 
-from utils.openai_helper import get_chat_guidance_rag, get_openai_large_guidance
+from utils.cache_helper import get_embedding_cache, get_index_generation, get_result_cache, make_key, normalize_query
+from utils.context_helper import first_passage, format_passage_context, select_context_documents
+from utils.ingest_helper import infer_batch
+from utils.metrics_helper import debug_json, logger, propagate_context, span
+from utils.singleflight_helper import get_search_flights
+from utils.vector_index_helper import get_local_vector_index
+from utils.openai_helper import extract_hit_fields, get_chat_guidance_rag, iter_openai_large_guidance
 
 
-def build_bm25_query(user_query):
+# Defaults for the kNN parameters of each query builder. knn_settings_path (written by
+# benchmarks/knn_sweep.py) overrides them per builder.
+DEFAULT_KNN_SETTINGS = {
+    "knn": {"num_candidates": 2, "size": None},
+    "rrf": {"num_candidates": 50},
+    "openai_hybrid": {"k": 10, "num_candidates": 100}
+}
+
+_knn_settings = {"mtime": None, "settings": DEFAULT_KNN_SETTINGS}
+
+
+def get_knn_settings(builder):
+    """
+    Returns the kNN parameters for a query builder ("knn", "rrf" or "openai_hybrid"), re-reading the
+    settings file when it changed.
+    """
+    try:
+        mtime = os.path.getmtime(knn_settings_path)
+    except OSError:
+        mtime = None
+    if mtime != _knn_settings["mtime"]:
+        settings = {name: dict(values) for name, values in DEFAULT_KNN_SETTINGS.items()}
+        if mtime is not None:
+            try:
+                with open(knn_settings_path) as f:
+                    for name, values in json.load(f).items():
+                        settings.setdefault(name, {}).update(values)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring invalid kNN settings file {knn_settings_path}: {e}")
+        _knn_settings["settings"] = settings
+        _knn_settings["mtime"] = mtime
+    return _knn_settings["settings"][builder]
+
+
+def passage_inner_hits(size):
+    # inner_hits block returning the text of the best matching passages of each document
+    return {
+        "size": size,
+        "_source": [
+            "passages.text"
+        ]
+    }
+
+
+def build_bm25_query(user_query, passages_per_doc=None):
     # Constructing the match query for 'organic' search using 'body_content'
     bm25_query = {
         "bool": {
@@ -21,13 +76,28 @@ def build_bm25_query(user_query):
         }
     }
 
+    if passages_per_doc:
+        # Zero-boost nested clause: leaves document scores alone but returns the best matching passages
+        bm25_query["bool"]["should"].append({
+            "nested": {
+                "path": "passages",
+                "query": {
+                    "match": {
+                        "passages.text": user_query
+                    }
+                },
+                "boost": 0,
+                "inner_hits": passage_inner_hits(passages_per_doc)
+            }
+        })
+
     full_query = {
         "size": 5,  # Specify the number of results to return
         "query": bm25_query
     }
 
     # Debug: Dump the assembled query for inspection
-    print(json.dumps(full_query, indent=4))
+    debug_json("Elasticsearch query", full_query)
 
     return full_query
 
@@ -42,8 +112,8 @@ def build_openai_hybrid_query(embeddings, user_query, BM25_Boost, KNN_Boost):
 
     knn_query = {
         "field": vector_embedding_field,  # Field containing the OpenAI embeddings
-        "k": 10,
-        "num_candidates": 100,
+        "k": get_knn_settings("openai_hybrid")["k"],
+        "num_candidates": get_knn_settings("openai_hybrid")["num_candidates"],
         "query_vector": embeddings,
         "boost": KNN_Boost
     }
@@ -73,34 +143,60 @@ def build_openai_hybrid_query(embeddings, user_query, BM25_Boost, KNN_Boost):
     if knn_filters:
         query["knn"]["filter"] = knn_filters
 
-    print(json.dumps(query, indent=4))
+    debug_json("Elasticsearch query", query)
 
     return query
 
 
 
+def embedding_cache_key(text):
+    return make_key(model, normalize_query(text))
+
+
+def inference_vector(response):
+    # The query embedding from an infer_trained_model response
+    return response.get('inference_results', [{}])[0].get('predicted_value', [])
+
+
 def build_vector(es, text):
-    docs = [{"text_field": text}]
-    response = es.ml.infer_trained_model(model_id=model, docs=docs)
+    with span("embedding", model=model) as attributes:
+        # Serve repeated queries from the embedding cache and skip the ML node round trip
+        cache = get_embedding_cache()
+        cache_key = embedding_cache_key(text)
+        predicted_value = cache.get(cache_key)
+        attributes["cache_hit"] = predicted_value is not None
+        if predicted_value is not None:
+            return predicted_value
+
+        response = es.ml.infer_trained_model(model_id=model, docs=[{"text_field": text}])
 
-    predicted_value = response.get('inference_results', [{}])[0].get('predicted_value', [])
+        predicted_value = inference_vector(response)
 
-    print(predicted_value)
-    return predicted_value
+        debug_json("Query embedding", predicted_value)
+        if predicted_value:
+            cache.set(cache_key, predicted_value)
+        return predicted_value
 
 
-def build_knn_query(user_query, query_vector):
+def build_knn_query(user_query, query_vector, passages_per_doc=1, rescore_oversample=None, size=None):
     """
     Builds an updated Elasticsearch KNN query for nested structures with query vectors.
 
     Parameters:
     - user_query: The query text input by the user. (Not used in this specific function but kept for compatibility)
     - query_vector: The precomputed vector for the KNN query.
+    - passages_per_doc: Number of matching passages returned per document as inner_hits.
+    - rescore_oversample: For int8 quantized indices. Collects size * rescore_oversample candidates from
+      the quantized HNSW graph and re-scores them against the original float vectors.
+    - size: Number of hits returned, which the rescore window is sized for. Defaults to the tuned kNN size,
+      or the Elasticsearch default of 10 when none is tuned.
 
     Returns:
     - A dictionary representing the Elasticsearch KNN nested query.
     """
 
+    settings = get_knn_settings("knn")
+
     # Nested KNN query structure
     nested_knn_query = {
         "query": {
@@ -110,20 +206,49 @@ def build_knn_query(user_query, query_vector):
                     "knn": {
                         "query_vector": query_vector,
                         "field": "passages.vector.predicted_value",
-                        "num_candidates": 2
+                        "num_candidates": settings["num_candidates"]
                     }
                 },
-                "inner_hits": {
-                    "_source": [
-                        "passages.text"
-                    ]
-                }
+                "inner_hits": passage_inner_hits(passages_per_doc)
             }
         }
     }
 
+    # The knn query has no k of its own; the number of kNN hits is the request size
+    size = size or settings.get("size")
+    if size:
+        nested_knn_query["size"] = size
+
+    if rescore_oversample:
+        window_size = (size or 10) * rescore_oversample
+        knn = nested_knn_query["query"]["nested"]["query"]["knn"]
+        knn["num_candidates"] = max(knn["num_candidates"], window_size)
+        # Same score as the dot_product similarity ((1 + dot) / 2), computed on the float vectors
+        nested_knn_query["rescore"] = {
+            "window_size": window_size,
+            "query": {
+                "rescore_query": {
+                    "nested": {
+                        "path": "passages",
+                        "score_mode": "max",
+                        "query": {
+                            "script_score": {
+                                "query": {"match_all": {}},
+                                "script": {
+                                    "source": "(1.0 + dotProduct(params.query_vector, 'passages.vector.predicted_value')) / 2.0",
+                                    "params": {"query_vector": query_vector}
+                                }
+                            }
+                        }
+                    }
+                },
+                "query_weight": 0.0,
+                "rescore_query_weight": 1.0
+            }
+        }
+
     # Debug: Dump the assembled query for inspection
-    print(json.dumps(nested_knn_query, indent=4))
+    debug_json("Elasticsearch query", nested_knn_query)
 
     return nested_knn_query
 
@@ -161,7 +286,7 @@ def build_rrf_query(embeddings, user_query, rrf_rank_constant, rrf_window_size):
                             "knn": {
                                 "query_vector": embeddings,
                                 "field": "passages.vector.predicted_value",
-                                "num_candidates": 50
+                                "num_candidates": get_knn_settings("rrf")["num_candidates"]
                             }
                         }
                     }
@@ -197,12 +322,12 @@ def build_rrf_query(embeddings, user_query, rrf_rank_constant, rrf_window_size):
         }
     }
     # Debug: Print the assembled query for inspection
-    print(json.dumps(query, indent=4))
+    debug_json("Elasticsearch query", query)
 
     return query
 
 
-def build_elser_query(user_query):
+def build_elser_query(user_query, passages_per_doc=None):
     # Nested query with text_expansion
     nested_query = {
         "nested": {
@@ -224,73 +349,628 @@ def build_elser_query(user_query):
         }
     }
 
+    if passages_per_doc:
+        nested_query["nested"]["inner_hits"] = passage_inner_hits(passages_per_doc)
+
     query = {
         "size": 5,
         "query": nested_query
     }
 
     # Debug: Print the assembled query for inspection
-    print(json.dumps(query, indent=4))
+    debug_json("Elasticsearch query", query)
 
     return query
 
 
 
 
-def search_products(es, user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size):
-    # Select the appropriate query building function based on searchtype
+# Fields each consumer of the search results actually reads. Everything else in the document, in
+# particular the per-passage MiniLM vectors and ELSER sparse vectors, stays on the cluster.
+# Passage text is never projected from _source, which would return every passage of the blog: matched
+# passages come back as inner_hits and the first passage as the first_passage script field.
+PASSAGE_VECTOR_FIELDS = ["passages.vector", "passages.content_embedding"]
+
+SOURCE_PROJECTIONS = {
+    # Blog search page: AI summary over body_content plus title/url/excerpt for display
+    "summary": {
+        "includes": ["id", "title", "url", "additional_urls", "body_content", "last_crawled_at"],
+        "excludes": PASSAGE_VECTOR_FIELDS
+    },
+    # Chatbot retrieval: body_content is the RAG context
+    "chat": {
+        "includes": ["id", "title", "url", "additional_urls", "body_content"],
+        "excludes": PASSAGE_VECTOR_FIELDS
+    },
+    # Display only: no body_content at all
+    "display": {
+        "includes": ["id", "title", "url", "additional_urls"],
+        "excludes": PASSAGE_VECTOR_FIELDS
+    },
+    # Unfiltered, kept for comparisons
+    "full": True
+}
+
+# Reads single passages out of _source on the data node, so only their text is sent back
+FIRST_PASSAGE_FIELD = {
+    "script": {
+        "source": "def p = params._source.passages; return p == null || p.isEmpty() ? '' : p[0].text;"
+    }
+}
+
+
+def passages_at_field(offsets):
+    # Script field with the text of the passages at the given offsets, '' where a document has fewer passages
+    return {
+        "script": {
+            "source": "def p = params._source.passages; def texts = []; "
+                      "for (int i : params.offsets) { texts.add(p != null && i < p.size() ? p[i].text : ''); } "
+                      "return texts;",
+            "params": {"offsets": offsets}
+        }
+    }
+
+# Only the parts of the response the helpers read
+SEARCH_FILTER_PATH = [
+    "took",
+    "hits.total",
+    "hits.hits._id",
+    "hits.hits._score",
+    "hits.hits._source",
+    "hits.hits.fields",
+    "hits.hits.inner_hits.passages.hits.hits._score",
+    "hits.hits.inner_hits.passages.hits.hits._source"
+]
+
+
+def apply_source_projection(query, consumer):
+    """
+    Returns a copy of the query with the _source projection for the given consumer.
+
+    Parameters:
+    - query: A query body produced by one of the build_* functions.
+    - consumer: One of the keys in SOURCE_PROJECTIONS.
+    """
+    if consumer not in SOURCE_PROJECTIONS:
+        raise ValueError(f"Invalid consumer: {consumer}")
+
+    projected = dict(query)
+    projected["_source"] = SOURCE_PROJECTIONS[consumer]
+    if consumer != "full":
+        projected["script_fields"] = dict(query.get("script_fields", {}), first_passage=FIRST_PASSAGE_FIELD)
+    return projected
+
+
+def search_index(es, query, consumer, index=byom_index_name):
+    # Full responses are requested unfiltered so the comparison benchmark sees the original payload
+    if consumer == "full":
+        return es.search(index=index, body=apply_source_projection(query, consumer))
+
+    with span("es_search", consumer=consumer) as attributes:
+        results = es.search(index=index, body=apply_source_projection(query, consumer),
+                            filter_path=SEARCH_FILTER_PATH)
+        # Client-side duration minus ES 'took' is network, queueing and (de)serialization
+        attributes["es_took_ms"] = results.get("took")
+
+    ensure_hits(results)
+    return results
+
+
+def ensure_hits(results):
+    # filter_path drops hits.hits entirely when nothing matched; callers expect an empty list
+    body = getattr(results, "body", results)
+    body.setdefault("hits", {}).setdefault("hits", [])
+    return body
+
+
+# Searchtypes whose query needs the query embedding
+VECTOR_SEARCHTYPES = ("Vector", "Vector Quantized", "Reciprocal Rank Fusion")
+
+
+def build_search_query(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, passages_per_doc=None,
+                       query_vector=None):
+    # Select the appropriate query building function based on searchtype.
+    # query_vector skips the embedding call when the caller already has it.
+    if searchtype in VECTOR_SEARCHTYPES and query_vector is None:
+        query_vector = build_vector(es, user_query)
+
     if searchtype == "Vector":
-        query = build_knn_query(user_query, build_vector(es, user_query))
+        query = build_knn_query(user_query, query_vector, passages_per_doc or 1)
+    elif searchtype == "Vector Quantized":
+        query = build_knn_query(user_query, query_vector, passages_per_doc or 1,
+                                rescore_oversample=quantized_rescore_oversample)
     elif searchtype == "BM25":
-        query = build_bm25_query(user_query)
+        query = build_bm25_query(user_query, passages_per_doc)
     elif searchtype == "Reciprocal Rank Fusion":
-        query = build_rrf_query(build_vector(es, user_query), user_query, rrf_rank_constant, rrf_window_size)
+        # Ranked sub_searches do not support inner_hits; the context builder falls back to the first passage
+        query = build_rrf_query(query_vector, user_query, rrf_rank_constant, rrf_window_size)
     elif searchtype == "Elser":
-        query = build_elser_query(user_query)
+        query = build_elser_query(user_query, passages_per_doc)
     else:
         raise ValueError(f"Invalid searchtype: {searchtype}")
 
-    results = es.search(index=byom_index_name, body=query, _source=True)
+    return query
 
-    # Set a default value for num_results
-    num_results = 0
 
-    if results and results.get('hits') and results['hits'].get('hits'):
-        # Limit the number of results displayed
+def build_hybrid_leg_queries(user_query, query_vector, window_size):
+    """
+    Builds the individual legs of a client-side hybrid search. Each leg only returns ids and
+    scores for the top window_size documents; display fields are fetched once after fusion.
 
-        num_results = min(5, len(results['hits']['hits']))
+    Parameters:
+    - user_query: The query text input by the user.
+    - query_vector: The query embedding, or None to build only the BM25 and ELSER legs.
+    - window_size: Number of documents each leg contributes to the fusion.
 
-        for i in range(num_results):
-            if results['hits']['hits'][i]["_source"].get("passages") and len(
-                    results['hits']['hits'][i]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][i]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
+    Returns:
+    - A dictionary of leg name to query body.
+    """
+    legs = {
+        "bm25": {
+            "size": window_size,
+            "_source": False,
+            "query": {
+                "match": {
+                    "body_content": user_query
+                }
+            }
+        },
+        "elser": {
+            "size": window_size,
+            "_source": False,
+            "query": build_elser_query(user_query)["query"]
+        }
+    }
 
-            print(first_passage_text)
+    if query_vector is not None:
+        legs["knn"] = {
+            "size": window_size,
+            "_source": False,
+            "query": {
+                "nested": {
+                    "path": "passages",
+                    "query": {
+                        "knn": {
+                            "query_vector": query_vector,
+                            "field": "passages.vector.predicted_value",
+                            "num_candidates": max(50, window_size)
+                        }
+                    }
+                }
+            }
+        }
 
-    else:
-        print("No results found.")
+    return legs
 
-    if searchtype != "GenAI":
-        return get_openai_large_guidance(user_query, results, num_results, searchtype)
 
+def fuse_rrf(leg_hits, rank_constant, window_size):
+    # Reciprocal rank fusion: sum of 1 / (rank_constant + rank) over the legs a document appears in
+    scores = {}
+    for hits in leg_hits.values():
+        for rank, hit in enumerate(hits[:window_size], start=1):
+            scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + 1.0 / (rank_constant + rank)
+    return scores
 
-def search_products_for_chatbot(es, user_query, searchtype, rrf_rank_constant, rrf_window_size,
-                                azureclient, conversation_history):
-    # Select the appropriate query building function based on searchtype
+
+def fuse_weighted(leg_hits, weights, window_size):
+    # Weighted sum of per-leg min-max normalized scores, since BM25, kNN and ELSER scores have different scales
+    scores = {}
+    for leg, hits in leg_hits.items():
+        hits = hits[:window_size]
+        if not hits:
+            continue
+        leg_scores = [hit["_score"] or 0.0 for hit in hits]
+        low, high = min(leg_scores), max(leg_scores)
+        for hit, score in zip(hits, leg_scores):
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + weights.get(leg, 1.0) * normalized
+    return scores
+
+
+# Hybrid legs only return ids and scores; display fields are fetched once after fusion
+HYBRID_LEG_FILTER_PATH = ["took", "hits.hits._id", "hits.hits._score"]
+
+
+def fuse_hybrid(leg_hits, fusion, weights, rrf_rank_constant, rrf_window_size):
+    # Fused score per document id; fusion and weights default to hybrid_fusion and hybrid_weights
+    fusion = fusion or hybrid_fusion
+    if fusion == "rrf":
+        return fuse_rrf(leg_hits, rrf_rank_constant, rrf_window_size)
+    if fusion == "weighted":
+        return fuse_weighted(leg_hits, weights or hybrid_weights, rrf_window_size)
+    raise ValueError(f"Invalid fusion: {fusion}")
+
+
+def ids_query(ids):
+    return {"size": len(ids), "query": {"ids": {"values": ids}}}
+
+
+def merge_fused_hits(top_ids, scores, fetched):
+    # The fetched documents in fused order, scored with their fused score
+    by_id = {hit["_id"]: hit for hit in fetched['hits']['hits']}
+    return [dict(by_id[doc_id], _score=scores[doc_id]) for doc_id in top_ids if doc_id in by_id]
+
+
+def _matched_offsets(matches):
+    return sorted({i for _, _, passage_indexes in matches for i in passage_indexes})
+
+
+def local_fetch_query(matches):
+    # ids query for the local kNN matches that also returns the text of their matched passages
+    query = ids_query([doc_id for doc_id, _, _ in matches])
+    query["script_fields"] = {"matched_passages": passages_at_field(_matched_offsets(matches))}
+    return query
+
+
+def merge_local_hits(matches, fetched):
+    # The fetched documents in local kNN order, with the matched passages as inner_hits
+    by_id = {hit["_id"]: hit for hit in fetched['hits']['hits']}
+    offsets = _matched_offsets(matches)
+    hits = []
+    for doc_id, score, passage_indexes in matches:
+        if doc_id not in by_id:
+            continue
+        hit = dict(by_id[doc_id], _score=score)
+        texts = dict(zip(offsets, hit.get("fields", {}).get("matched_passages", [])))
+        hit["inner_hits"] = {"passages": {"hits": {"hits": [
+            {"_score": score, "_source": {"text": texts[i]}} for i in passage_indexes if texts.get(i)
+        ]}}}
+        hits.append(hit)
+    return hits
+
+
+def search_response(hits, total, start_time):
+    # A response shaped like es.search for the client-side engines, 'took' being the wall-clock time
+    took = int((time.time() - start_time) * 1000)
+    return {"took": took, "hits": {"total": {"value": total, "relation": "eq"}, "hits": hits}}
+
+
+def uses_client_hybrid(searchtype):
+    return searchtype == "Client Hybrid" or (searchtype == "Reciprocal Rank Fusion" and rrf_mode == "client")
+
+
+def hybrid_search(es, user_query, rrf_rank_constant, rrf_window_size, consumer="summary", fusion=None,
+                  weights=None, size=5, index=byom_index_name):
+    """
+    Client-side hybrid search. BM25 and ELSER legs are sent immediately, the kNN leg as soon as the
+    query embedding is available; all legs run concurrently and are fused in Python. Works on
+    clusters without the server-side rank.rrf feature.
+
+    Parameters:
+    - es: Elasticsearch client.
+    - user_query: The query text input by the user.
+    - rrf_rank_constant: The rank constant used in RRF ranking.
+    - rrf_window_size: Number of documents each leg contributes.
+    - consumer: Source projection used for the fused top hits.
+    - fusion: "rrf" or "weighted". Defaults to hybrid_fusion in variables.py.
+    - weights: Per-leg weights for "weighted" fusion. Defaults to hybrid_weights.
+    - size: Number of fused hits returned.
+
+    Returns:
+    - A search response shaped like es.search, with 'took' set to the wall-clock time in ms.
+    """
+    start_time = time.time()
+
+    legs = build_hybrid_leg_queries(user_query, None, rrf_window_size)
+
+    def run_leg(name, body):
+        with span("es_search_leg", leg=name) as attributes:
+            results = es.search(index=index, body=body, filter_path=HYBRID_LEG_FILTER_PATH)
+            attributes["es_took_ms"] = results.get("took")
+        return results
+
+    def run_knn_leg():
+        query_vector = build_vector(es, user_query)
+        return run_leg("knn", build_hybrid_leg_queries(user_query, query_vector, rrf_window_size)["knn"])
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = {name: executor.submit(propagate_context(run_leg), name, body) for name, body in legs.items()}
+        futures["knn"] = executor.submit(propagate_context(run_knn_leg))
+        leg_hits = {name: future.result().get("hits", {}).get("hits", []) for name, future in futures.items()}
+
+    scores = fuse_hybrid(leg_hits, fusion, weights, rrf_rank_constant, rrf_window_size)
+    top_ids = sorted(scores, key=scores.get, reverse=True)[:size]
+
+    hits = []
+    if top_ids:
+        fetched = search_index(es, ids_query(top_ids), consumer, index=index)
+        hits = merge_fused_hits(top_ids, scores, fetched)
+
+    return search_response(hits, len(scores), start_time)
+
+
+def local_vector_search(es, user_query, consumer="summary", size=5, passages_per_doc=1, index=byom_index_name):
+    """
+    kNN over the local memory-mapped passage vector snapshot instead of a nested kNN query in ES.
+    Only the display fields of the matched documents are fetched from ES, with a single ids query.
+
+    Returns:
+    - A search response shaped like es.search; the matched passages are returned as inner_hits.
+    """
+    start_time = time.time()
+    query_vector = build_vector(es, user_query)
+
+    with span("local_knn"):
+        matches = get_local_vector_index().search(query_vector, size, passages_per_doc=passages_per_doc)
+
+    hits = []
+    if matches:
+        fetched = search_index(es, local_fetch_query(matches), consumer, index=index)
+        hits = merge_local_hits(matches, fetched)
+
+    return search_response(hits, len(hits), start_time)
+
+
+def execute_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, consumer, passages_per_doc=None):
+    # Runs the search for any searchtype, either as a single query or through the client-side engines
+    if uses_client_hybrid(searchtype):
+        return hybrid_search(es, user_query, rrf_rank_constant, rrf_window_size, consumer)
+    if searchtype == "Local Vector":
+        return local_vector_search(es, user_query, consumer, passages_per_doc=passages_per_doc or 1)
+
+    query = build_search_query(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, passages_per_doc)
+    return search_index(es, query, consumer, index=index_for_searchtype(searchtype))
+
+
+def index_for_searchtype(searchtype):
+    # The quantized kNN mode searches the int8_hnsw copy of the index
+    return byom_int8_index_name if searchtype == "Vector Quantized" else byom_index_name
+
+
+def build_vectors(es, texts, batch_size=ingest_inference_batch_size):
+    """
+    Embeds many query texts with batched infer_trained_model calls, serving cached embeddings first.
+
+    Returns:
+    - One embedding per text, in input order.
+    """
+    cache = get_embedding_cache()
+    keys = [embedding_cache_key(text) for text in texts]
+    vectors = [cache.get(key) for key in keys]
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        results = infer_batch(es, model, [texts[i] for i in missing], batch_size)
+        for i, result in zip(missing, results):
+            vectors[i] = result.get('predicted_value', [])
+            if vectors[i]:
+                cache.set(keys[i], vectors[i])
+
+    return vectors
+
+
+def _batch_query(user_query, query_vector, searchtype, rrf_rank_constant, rrf_window_size):
+    # Same query bodies as build_search_query, with the embedding supplied by the caller
     if searchtype == "Vector":
-        query = build_knn_query(user_query, build_vector(es, user_query))
+        return build_knn_query(user_query, query_vector)
+    elif searchtype == "Vector Quantized":
+        return build_knn_query(user_query, query_vector, rescore_oversample=quantized_rescore_oversample)
     elif searchtype == "BM25":
-        query = build_bm25_query(user_query)
+        return build_bm25_query(user_query)
     elif searchtype == "Reciprocal Rank Fusion":
-        query = build_rrf_query(build_vector(es, user_query), user_query, rrf_rank_constant, rrf_window_size)
+        return build_rrf_query(query_vector, user_query, rrf_rank_constant, rrf_window_size)
     elif searchtype == "Elser":
-        query = build_elser_query(user_query)
+        return build_elser_query(user_query)
+    raise ValueError(f"Invalid searchtype: {searchtype}")
+
+
+def batch_search(es, queries, searchtype, rrf_rank_constant=1, rrf_window_size=200, consumer="display",
+                 chunk_size=batch_msearch_chunk_size, max_in_flight=batch_max_in_flight, index=byom_index_name):
+    """
+    Runs many queries of one searchtype, for relevance evaluation or cache warming.
+
+    Query embeddings are computed with batched inference, the searches are sent in chunks of
+    chunk_size through _msearch with at most max_in_flight requests outstanding.
+
+    Parameters:
+    - es: Elasticsearch client.
+    - queries: List of query texts.
+    - searchtype: One of the searchtypes accepted by execute_search.
+    - consumer: Source projection applied to every search.
+
+    Returns:
+    - A list in input order of dicts with 'query', 'results' (the search response or None) and
+      'error' (None on success).
+    """
+    outcomes = [{"query": user_query, "results": None, "error": None} for user_query in queries]
+    if not queries:
+        return outcomes
+
+    if uses_client_hybrid(searchtype):
+        # Each hybrid search is already several concurrent requests; run whole searches in parallel instead
+        def run_hybrid(i):
+            try:
+                outcomes[i]["results"] = hybrid_search(es, queries[i], rrf_rank_constant, rrf_window_size, consumer,
+                                                       index=index)
+            except Exception as e:
+                outcomes[i]["error"] = repr(e)
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            list(executor.map(run_hybrid, range(len(queries))))
+        return outcomes
+
+    if searchtype in VECTOR_SEARCHTYPES or searchtype == "Local Vector":
+        vectors = [None] * len(queries)
+        for start in range(0, len(queries), chunk_size):
+            try:
+                vectors[start:start + chunk_size] = build_vectors(es, queries[start:start + chunk_size])
+            except Exception as e:
+                for outcome in outcomes[start:start + chunk_size]:
+                    outcome["error"] = f"embedding failed: {e!r}"
     else:
-        raise ValueError(f"Invalid searchtype: {searchtype}")
+        vectors = [None] * len(queries)
+
+    # Local Vector: the kNN runs in process and _msearch only fetches the display fields of the matches
+    local_matches = {}
+    searches = []
+    for i, user_query in enumerate(queries):
+        if outcomes[i]["error"] is not None:
+            continue
+        try:
+            if searchtype == "Local Vector":
+                local_matches[i] = get_local_vector_index().search(vectors[i], 5)
+                query = local_fetch_query(local_matches[i])
+            else:
+                query = _batch_query(user_query, vectors[i], searchtype, rrf_rank_constant, rrf_window_size)
+        except Exception as e:
+            outcomes[i]["error"] = repr(e)
+            continue
+        searches.append((i, apply_source_projection(query, consumer)))
+
+    def run_chunk(chunk):
+        body = []
+        for _, query in chunk:
+            body.append({"index": index_for_searchtype(searchtype) if index == byom_index_name else index})
+            body.append(query)
+        try:
+            responses = es.msearch(body=body)["responses"]
+        except Exception as e:
+            for i, _ in chunk:
+                outcomes[i]["error"] = repr(e)
+            return
+        for (i, _), response in zip(chunk, responses):
+            if "error" in response:
+                outcomes[i]["error"] = json.dumps(response["error"])
+            elif i in local_matches:
+                hits = merge_local_hits(local_matches[i], response)
+                outcomes[i]["results"] = {"took": response.get("took"),
+                                          "hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits}}
+            else:
+                outcomes[i]["results"] = response
+
+    chunks = [searches[start:start + chunk_size] for start in range(0, len(searches), chunk_size)]
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        list(executor.map(run_chunk, chunks))
+
+    return outcomes
+
+
+def search_products_key(searchtype, user_query, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size,
+                        generation):
+    # Result cache and in-flight key shared by search_products and search_products_progressive, sync and async
+    return make_key("search_products", searchtype, normalize_query(user_query), BM25_Boost, KNN_Boost,
+                    rrf_rank_constant, rrf_window_size, generation)
 
-    results = es.search(index=byom_index_name, body=query, _source=True)
+
+def search_products_v2_key(searchtype, user_query, rrf_rank_constant, rrf_window_size, generation):
+    return make_key("search_products_v2", searchtype, normalize_query(user_query), rrf_rank_constant,
+                    rrf_window_size, generation)
+
+
+def summary_hits(results, num_results=5):
+    # The hits search_products summarizes
+    hits = results['hits']['hits'][:num_results]
+    if not hits:
+        logger.info("No results found.")
+    return hits
+
+
+def finish_search_products(cache_key, processed_results, results):
+    """
+    Caches a complete search_products page and returns its result.
+
+    Parameters:
+    - processed_results: One entry per summarized hit, in rank order; None where the completion failed.
+
+    Returns:
+    - A tuple (processed_results, results) without the failed hits. Pages where some summaries failed are
+      returned but not cached.
+    """
+    if all(result is not None for result in processed_results):
+        get_result_cache().set(cache_key, (processed_results, results))
+    return [result for result in processed_results if result is not None], results
+
+
+def top_blog_bodies(results, num_results=3):
+    # search_products_v2: the body_content of the top hits
+    return [hit["_source"].get("body_content", "No body content available")
+            for hit in results['hits']['hits'][:num_results]]
+
+
+def search_products(es, user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size,
+                    azureclient=None):
+    # Streamlit reruns the script on every interaction; identical searches against the same index
+    # generation are served from the result cache without embedding, search or LLM calls
+    result_cache = get_result_cache()
+    cache_key = search_products_key(searchtype, user_query, BM25_Boost, KNN_Boost, rrf_rank_constant,
+                                    rrf_window_size, get_index_generation(es, index_for_searchtype(searchtype)))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Identical searches already running in another session share that execution instead of repeating it
+    return get_search_flights().do(cache_key, _search_products, es, user_query, searchtype, rrf_rank_constant,
+                                   rrf_window_size, azureclient, cache_key)
+
+
+def _search_products(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, azureclient, cache_key):
+    # The progressive execution with nobody listening to its events
+    return _search_products_progressive(lambda event: None, es, user_query, searchtype, rrf_rank_constant,
+                                        rrf_window_size, azureclient, cache_key)
+
+
+def hits_event(results, num_results):
+    # The fields the blog search page renders before any summary is ready
+    hits = []
+    for rank, hit in enumerate(results['hits']['hits'][:num_results]):
+        _, url, title, first_passage_text = extract_hit_fields(hit)
+        hits.append({"rank": rank, "url": url, "title": title, "first_passage_text": first_passage_text,
+                     "score": hit.get("_score")})
+    return {"event": "hits", "took": results.get('took'), "hits": hits}
+
+
+def result_events(processed_results, results):
+    # The progressive events of a finished search_products result
+    yield hits_event(results, len(processed_results))
+    for rank, result in enumerate(processed_results):
+        yield {"event": "summary", "rank": rank, "result": result}
+
+
+def search_products_progressive(es, user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant,
+                                rrf_window_size, azureclient=None):
+    """
+    Incremental variant of search_products for progressive rendering.
+
+    Yields:
+    - {"event": "hits", "took": ..., "hits": [...]} as soon as ES returns, with rank, url, title,
+      first_passage_text and score of each hit that will be summarized.
+    - {"event": "summary", "rank": ..., "result": ...} per hit as its completion finishes, in completion
+      order. result is the search_products tuple for that hit, or None when its completion failed.
+
+    Complete result sets are stored in (and served from) the same result cache as search_products, and
+    identical searches in flight, progressive or not, share one execution.
+    """
+    result_cache = get_result_cache()
+    cache_key = search_products_key(searchtype, user_query, BM25_Boost, KNN_Boost, rrf_rank_constant,
+                                    rrf_window_size, get_index_generation(es, index_for_searchtype(searchtype)))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        yield from result_events(*cached)
+        return
+
+    yield from get_search_flights().stream(cache_key, _search_products_progressive,
+                                           lambda result: result_events(*result), es, user_query, searchtype,
+                                           rrf_rank_constant, rrf_window_size, azureclient, cache_key)
+
+
+def _search_products_progressive(publish, es, user_query, searchtype, rrf_rank_constant, rrf_window_size,
+                                 azureclient, cache_key):
+    # Publishes the progressive events; returns the search_products result for callers waiting on it
+    results = execute_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "summary")
+    hits = summary_hits(results)
+    publish(hits_event(results, len(hits)))
+
+    processed_results = [None] * len(hits)
+    for rank, result in iter_openai_large_guidance(user_query, results, len(hits), client=azureclient):
+        processed_results[rank] = result
+        publish({"event": "summary", "rank": rank, "result": result})
+
+    return finish_search_products(cache_key, processed_results, results)
+
+
+def search_products_for_chatbot(es, user_query, searchtype, rrf_rank_constant, rrf_window_size,
+                                azureclient, conversation_history):
+    results = execute_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "chat")
 
     # Set a default value for num_results
     num_results = 0
@@ -301,88 +981,60 @@ def search_products_for_chatbot(es, user_query, searchtype, rrf_rank_constant, r
         num_results = min(5, len(results['hits']['hits']))
 
         for i in range(num_results):
-            if results['hits']['hits'][i]["_source"].get("passages") and len(
-                    results['hits']['hits'][i]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][i]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
+            first_passage_text = first_passage(results['hits']['hits'][i]) or "No passages text available"
 
-            print(first_passage_text)
+            logger.debug("First passage: %s", first_passage_text)
 
     else:
-        print("No results found.")
+        logger.info("No results found.")
 
     return get_chat_guidance_rag(user_query, azureclient, results, conversation_history)
 
 
 def search_products_v2(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
-    # Select the appropriate query building function based on searchtype
-    if searchtype == "Vector":
-        query = build_knn_query(user_query, build_vector(es, user_query))
-    elif searchtype == "BM25":
-        query = build_bm25_query(user_query)
-    elif searchtype == "Reciprocal Rank Fusion":
-        query = build_rrf_query(build_vector(es, user_query), user_query, rrf_rank_constant, rrf_window_size)
-    elif searchtype == "Elser":
-        query = build_elser_query(user_query)
-    else:
-        raise ValueError(f"Invalid searchtype: {searchtype}")
+    result_cache = get_result_cache()
+    cache_key = search_products_v2_key(searchtype, user_query, rrf_rank_constant, rrf_window_size,
+                                       get_index_generation(es, index_for_searchtype(searchtype)))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
-    results = es.search(index=byom_index_name, body=query, _source=True)
+    return get_search_flights().do(cache_key, _search_products_v2, es, user_query, searchtype, rrf_rank_constant,
+                                   rrf_window_size, cache_key)
 
-    # Set a default value for num_results
-    num_results = 0
 
-    if results and results.get('hits') and results['hits'].get('hits'):
-        # Limit the number of results displayed
+def _search_products_v2(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, cache_key):
+    results = execute_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "chat")
+    if not results['hits']['hits']:
+        logger.info("No results found.")
+    blog_bodies = top_blog_bodies(results)
 
-        num_results = min(5, len(results['hits']['hits']))
+    get_result_cache().set(cache_key, blog_bodies)
+    return blog_bodies
 
-        for i in range(num_results):
-            if results['hits']['hits'][i]["_source"].get("passages") and len(
-                    results['hits']['hits'][i]["_source"]["passages"]) > 0:
-                first_passage_text = results['hits']['hits'][i]["_source"]["passages"][0]["text"]
-            else:
-                first_passage_text = "No passages text available"
 
-            print(first_passage_text)
+def search_passage_context(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    Retrieves the best matching passages of the top documents and packs them into a prompt context.
 
-    else:
-        print("No results found.")
-
-    blog_bodies = []
-    urls = []
-    titles = []
-    passages_texts = []
-    scores = []
-
-    # Check if there are any hits
-    if results['hits']['hits']:
-        # Process up to the first 3 results
-        for hit in results['hits']['hits'][:3]:  # Limit to first 3 results
-            source = hit["_source"]
-
-            # Extract and accumulate the body content
-            blog_body = source.get("body_content", "No body content available")
-            blog_bodies.append(blog_body)
-
-            # Extract and accumulate the URL, preferring 'additional_urls' if available and non-empty
-            additional_urls = source.get("additional_urls", [])
-            url = additional_urls[0] if additional_urls else source.get("url", "No URL available")
-            urls.append(url)
-
-            # Extract and accumulate the title
-            title = source.get("title", "No title available")
-            titles.append(title)
-
-            # Extract and accumulate the first passage text if passages exist and are non-empty
-            passages = source.get("passages", [])
-            first_passage_text = passages[0].get("text",
-                                                 "No passages text available") if passages else "No passages available"
-            passages_texts.append(first_passage_text)
-
-            # Extract and accumulate the score
-            score = hit["_score"]
-            scores.append(score)
+    Returns:
+    - A tuple (context, sources) from build_passage_context.
+    """
+    return format_passage_context(search_context_documents(es, user_query, searchtype, rrf_rank_constant,
+                                                           rrf_window_size))
 
-    return blog_bodies
+
+def search_context_documents(es, user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    """
+    search_passage_context before formatting, for the chatbot's document store.
+
+    Returns:
+    - The documents from select_context_documents.
+    """
+    results = execute_search(es, user_query, searchtype, rrf_rank_constant, rrf_window_size, "display",
+                             passages_per_doc=rag_passages_per_doc)
+
+    if not results['hits']['hits']:
+        logger.info("No results found.")
+
+    return select_context_documents(results, top_n=rag_top_n_docs)
@@ -0,0 +1,320 @@
+"""
+Process-wide request and token rate limiting for Azure OpenAI deployments.
+
+Every completion goes through the limiter of its deployment: it waits in a priority queue until both the
+requests-per-minute and the tokens-per-minute bucket have room for it, instead of sleeping blindly. A 429
+pauses the whole deployment for its Retry-After and the request is queued again.
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+
+import openai
+
+from utils.history_helper import count_message_tokens
+from utils.metrics_helper import logger, metrics
+
+from variables import openai_rate_limits, openai_default_rpm, openai_default_tpm, openai_expected_completion_tokens, \
+    openai_queue_timeout, openai_retry_attempts, openai_backoff_base, openai_backoff_max, openai_max_retries
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Errors the SDK would retry itself (APITimeoutError is an APIConnectionError); retried here up to
+# openai_max_retries with backoff, since the SDK's own retries are turned off
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+
+class _Waiter:
+    def __init__(self, priority, seq, tokens, wake):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class RateLimiter:
+    """
+    Token buckets for requests and tokens per minute, shared by every caller of one deployment.
+
+    Waiters are granted strictly in (priority, arrival) order, so a queued chat turn always goes before
+    queued background summaries. Both threads (acquire) and coroutines (acquire_async) can wait.
+    """
+
+    def __init__(self, name, rpm, tpm):
+        self.name = name
+        self.slug = re.sub(r"\W", "_", name)
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def _dispatch(self):
+        # Grants queued waiters in order while there is capacity. Returns the seconds until the head of
+        # the queue can be served, or None when the queue is empty. Called with the lock held.
+        now = time.monotonic()
+        self._refill(now)
+        delay = None
+        while self._queue:
+            head = self._queue[0]
+            if head.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            if now < self._paused_until:
+                delay = self._paused_until - now
+                break
+            if self._requests < 1:
+                delay = (1 - self._requests) * 60 / self.rpm
+                break
+            if self._tokens < head.tokens:
+                delay = (head.tokens - self._tokens) * 60 / self.tpm
+                break
+            heapq.heappop(self._queue)
+            self._requests -= 1
+            self._tokens -= head.tokens
+            head.granted = True
+            head.wake()
+        metrics.set_gauge(f"openai_queue_depth_{self.slug}", len(self._queue))
+        return delay
+
+    def _enqueue(self, tokens, priority, wake):
+        # Requests larger than the whole bucket would never fit; they wait for a full bucket instead
+        waiter = _Waiter(priority, next(self._seq), min(tokens, self.tpm), wake)
+        with self._lock:
+            heapq.heappush(self._queue, waiter)
+            delay = self._dispatch()
+        return waiter, delay
+
+    def _poll(self, waiter):
+        with self._lock:
+            return None if waiter.granted else self._dispatch()
+
+    def _cancel(self, waiter):
+        with self._lock:
+            waiter.cancelled = True
+            # Let the waiters behind it move up
+            self._dispatch()
+
+    def _granted(self, waiter, start_time):
+        wait_ms = (time.monotonic() - start_time) * 1000
+        metrics.observe(f"openai_queue_wait_{self.slug}", wait_ms)
+        if wait_ms > 1000:
+            logger.debug(f"Waited {wait_ms:.0f}ms for {self.name} capacity")
+
+    def acquire(self, tokens, priority=PRIORITY_BACKGROUND, timeout=openai_queue_timeout):
+        start_time = time.monotonic()
+        event = threading.Event()
+        waiter, delay = self._enqueue(tokens, priority, event.set)
+        try:
+            while not waiter.granted:
+                remaining = timeout - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    metrics.increment(f"openai_queue_timeouts_{self.slug}")
+                    raise TimeoutError(f"Timed out after {timeout}s waiting for {self.name} rate limit capacity")
+                event.wait(min(delay, remaining) if delay is not None else remaining)
+                event.clear()
+                delay = self._poll(waiter)
+        finally:
+            if not waiter.granted:
+                self._cancel(waiter)
+        self._granted(waiter, start_time)
+
+    async def acquire_async(self, tokens, priority=PRIORITY_BACKGROUND, timeout=openai_queue_timeout):
+        start_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter, delay = self._enqueue(tokens, priority, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while not waiter.granted:
+                remaining = timeout - (time.monotonic() - start_time)
+                if remaining <= 0:
+                    metrics.increment(f"openai_queue_timeouts_{self.slug}")
+                    raise TimeoutError(f"Timed out after {timeout}s waiting for {self.name} rate limit capacity")
+                try:
+                    await asyncio.wait_for(event.wait(), min(delay, remaining) if delay is not None else remaining)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+                delay = self._poll(waiter)
+        finally:
+            if not waiter.granted:
+                self._cancel(waiter)
+        self._granted(waiter, start_time)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        # Corrects the token bucket once the response reports the real usage
+        with self._lock:
+            self._tokens -= actual_tokens - min(estimated_tokens, self.tpm)
+
+    def pause(self, seconds):
+        # Honours a Retry-After: nothing is sent to the deployment until it has passed
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        metrics.increment(f"openai_rate_limited_{self.slug}")
+
+    def stats(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {"queued": sum(1 for waiter in self._queue if not waiter.cancelled),
+                    "requests_available": self._requests, "tokens_available": self._tokens,
+                    "paused_for": max(0.0, self._paused_until - time.monotonic())}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(deployment):
+    limiter = _limiters.get(deployment)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(deployment)
+            if limiter is None:
+                limits = openai_rate_limits.get(deployment, {})
+                limiter = RateLimiter(deployment, limits.get("rpm", openai_default_rpm),
+                                      limits.get("tpm", openai_default_tpm))
+                _limiters[deployment] = limiter
+    return limiter
+
+
+def reset_rate_limiters():
+    # Drops every limiter, so the next requests start from full buckets (used between benchmark runs)
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def set_rate_limits(limits, default_rpm, default_tpm):
+    """
+    Replaces the configured quotas and drops the existing limiters. The benchmarks use it to run against
+    the stubs without quotas.
+
+    Parameters:
+    - limits: Per deployment {"rpm", "tpm"}, like openai_rate_limits.
+    - default_rpm, default_tpm: Quota of deployments without an entry in limits.
+    """
+    global openai_rate_limits, openai_default_rpm, openai_default_tpm
+    with _limiters_lock:
+        openai_rate_limits, openai_default_rpm, openai_default_tpm = limits, default_rpm, default_tpm
+        _limiters.clear()
+
+
+def rate_limiter_stats():
+    return {deployment: limiter.stats() for deployment, limiter in list(_limiters.items())}
+
+
+def estimate_tokens(messages, max_tokens=None):
+    # Prompt tokens plus the completion allowance; TPM quotas count both
+    return sum(count_message_tokens(message) for message in messages) + (max_tokens or
+                                                                          openai_expected_completion_tokens)
+
+
+def retry_after(error, attempt):
+    """
+    Seconds to pause a deployment after a 429: the retry-after-ms / retry-after headers when present,
+    otherwise full jitter exponential backoff.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[header]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return backoff_delay(attempt)
+
+
+def backoff_delay(attempt):
+    # Full jitter exponential backoff: somewhere in [0, min(max, base * 2^attempt)]
+    return random.uniform(0, min(openai_backoff_max, openai_backoff_base * (2 ** attempt)))
+
+
+def limited_completion(client, priority=PRIORITY_BACKGROUND, retry_attempts=openai_retry_attempts, **kwargs):
+    """
+    client.chat.completions.create behind the deployment's rate limiter.
+
+    Rate limit errors pause the deployment for the Retry-After and queue the request again, up to
+    retry_attempts times. Connection errors, timeouts and 5xx responses are retried with backoff up to
+    openai_max_retries times, as the SDK would; other errors are raised. The SDK's own retries are disabled
+    so its sleeps do not bypass the queue.
+    """
+    limiter = get_rate_limiter(kwargs["model"])
+    tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    attempt = 0
+    failures = 0
+    while True:
+        limiter.acquire(tokens, priority)
+        try:
+            response = client.with_options(max_retries=0).chat.completions.create(**kwargs)
+        except openai.RateLimitError as e:
+            limiter.pause(retry_after(e, attempt))
+            attempt += 1
+            if attempt >= retry_attempts:
+                raise
+            logger.warning(f"Rate Limit Error on {limiter.name}: {e}. Queued for retry.")
+            continue
+        except TRANSIENT_ERRORS as e:
+            if failures >= openai_max_retries:
+                raise
+            delay = backoff_delay(failures)
+            failures += 1
+            logger.warning(f"{type(e).__name__} on {limiter.name}: {e}. Retrying in {delay:.1f}s.")
+            time.sleep(delay)
+            continue
+        usage = getattr(response, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None):
+            limiter.settle(tokens, usage.total_tokens)
+            metrics.increment(f"openai_tokens_{limiter.slug}", usage.total_tokens)
+        return response
+
+
+async def limited_completion_async(client, priority=PRIORITY_BACKGROUND, retry_attempts=openai_retry_attempts,
+                                   **kwargs):
+    # limited_completion for AsyncAzureOpenAI
+    limiter = get_rate_limiter(kwargs["model"])
+    tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+    attempt = 0
+    failures = 0
+    while True:
+        await limiter.acquire_async(tokens, priority)
+        try:
+            response = await client.with_options(max_retries=0).chat.completions.create(**kwargs)
+        except openai.RateLimitError as e:
+            limiter.pause(retry_after(e, attempt))
+            attempt += 1
+            if attempt >= retry_attempts:
+                raise
+            logger.warning(f"Rate Limit Error on {limiter.name}: {e}. Queued for retry.")
+            continue
+        except TRANSIENT_ERRORS as e:
+            if failures >= openai_max_retries:
+                raise
+            delay = backoff_delay(failures)
+            failures += 1
+            logger.warning(f"{type(e).__name__} on {limiter.name}: {e}. Retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+            continue
+        usage = getattr(response, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None):
+            limiter.settle(tokens, usage.total_tokens)
+            metrics.increment(f"openai_tokens_{limiter.slug}", usage.total_tokens)
+        return response
@@ -0,0 +1,118 @@
+"""
+Thin synchronous client for cisco-search-service.py, used by the Streamlit apps when search_service_url is set.
+"""
+import json
+import threading
+import time
+
+import httpx
+
+from utils.context_helper import rehydrate_messages
+from utils.metrics_helper import logger
+from variables import search_service_url, search_service_timeout
+
+_client = None
+_client_lock = threading.Lock()
+
+# 503s from a saturated service are retried this many times, waiting for its Retry-After
+SERVICE_RETRY_ATTEMPTS = 3
+
+
+def get_service_client():
+    # Process-wide pooled HTTP client, shared by every Streamlit session and rerun
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(base_url=search_service_url, timeout=search_service_timeout)
+    return _client
+
+
+def _post(path, payload):
+    for attempt in range(SERVICE_RETRY_ATTEMPTS):
+        response = get_service_client().post(path, json=payload)
+        if response.status_code != 503 or attempt == SERVICE_RETRY_ATTEMPTS - 1:
+            break
+        delay = float(response.headers.get("Retry-After", 1))
+        logger.warning(f"Search service overloaded, retrying {path} in {delay:.0f}s")
+        time.sleep(delay)
+    response.raise_for_status()
+    return response.json()
+
+
+def search_products(user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size):
+    # Same return value as utils.query_helper.search_products
+    response = _post("/search_products", {
+        "user_query": user_query, "searchtype": searchtype, "BM25_Boost": BM25_Boost, "KNN_Boost": KNN_Boost,
+        "rrf_rank_constant": rrf_rank_constant, "rrf_window_size": rrf_window_size
+    })
+    return [tuple(result) for result in response["processed_results"]], response["results"]
+
+
+def search_products_progressive(user_query, searchtype, BM25_Boost, KNN_Boost, rrf_rank_constant, rrf_window_size):
+    # Same events as utils.query_helper.search_products_progressive, read from the service's NDJSON stream
+    payload = {
+        "user_query": user_query, "searchtype": searchtype, "BM25_Boost": BM25_Boost, "KNN_Boost": KNN_Boost,
+        "rrf_rank_constant": rrf_rank_constant, "rrf_window_size": rrf_window_size
+    }
+    with get_service_client().stream("POST", "/search_products/stream", json=payload) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if event["event"] == "summary" and event["result"] is not None:
+                event["result"] = tuple(event["result"])
+            yield event
+
+
+def search_products_v2(user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    return _post("/search_products_v2", {
+        "user_query": user_query, "searchtype": searchtype, "rrf_rank_constant": rrf_rank_constant,
+        "rrf_window_size": rrf_window_size
+    })["blog_bodies"]
+
+
+def search_passage_context(user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    response = _post("/chat/context", {
+        "user_query": user_query, "searchtype": searchtype, "rrf_rank_constant": rrf_rank_constant,
+        "rrf_window_size": rrf_window_size
+    })
+    return response["context"], response["sources"]
+
+
+def search_context_documents(user_query, searchtype, rrf_rank_constant, rrf_window_size):
+    # Same return value as utils.query_helper.search_context_documents
+    return _post("/chat/context", {
+        "user_query": user_query, "searchtype": searchtype, "rrf_rank_constant": rrf_rank_constant,
+        "rrf_window_size": rrf_window_size, "documents": True
+    })["documents"]
+
+
+def chat_stream(messages, state, timings=None):
+    """
+    Streams the chat answer from the service, yielding text fragments as they arrive.
+
+    Parameters:
+    - messages: The full session history; the service applies the token budget and rolling summary.
+      Context references are rehydrated before sending.
+    - state: Dict with 'history_summary' and 'history_summarized_upto'; updated in place.
+    - timings: Optional dict, filled with prompt_tokens, time_to_first_token and total_time.
+    """
+    # The service is stateless: context references are resolved against this process's document store
+    payload = {"messages": rehydrate_messages(messages), "state": {key: state.get(key) for key in
+                                               ("history_summary", "history_summarized_upto") if key in state}}
+    with get_service_client().stream("POST", "/chat", json=payload) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if "token" in event:
+                yield event["token"]
+            elif "state" in event:
+                state.update(event["state"])
+                if timings is not None:
+                    timings["prompt_tokens"] = event["prompt_tokens"]
+            elif "timings" in event and timings is not None:
+                timings.update(event["timings"])
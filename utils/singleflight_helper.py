@@ -0,0 +1,273 @@
+import asyncio
+import threading
+import time
+
+from utils.metrics_helper import metrics, propagate_context
+
+from variables import singleflight_timeout
+
+
+class _Call:
+    def __init__(self, streamed=False):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # Items published by a stream() execution, for every caller sharing it
+        self.events = [] if streamed else None
+        self.changed = threading.Condition()
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution. The first caller (the leader) runs
+    the function; callers arriving while it is in flight wait for its result, or get its exception.
+
+    Parameters:
+    - name: Prefix of the counters reported to metrics ("<name>_collapsed", "<name>_timeouts", ...).
+    - timeout: Seconds a waiter waits for the leader before raising TimeoutError. The leader itself is
+      bounded by the client timeouts of the calls it makes.
+    """
+
+    def __init__(self, name, timeout=singleflight_timeout):
+        self.name = name
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.collapsed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            metrics.increment(f"{self.name}_collapsed")
+            return self._wait(call)
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            self.errors += 1
+            metrics.increment(f"{self.name}_errors")
+            raise
+        finally:
+            # Later callers start a new execution; waiters already holding the call get its outcome
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _wait(self, call):
+        if not call.done.wait(self.timeout):
+            self._timed_out()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _timed_out(self):
+        self.timeouts += 1
+        metrics.increment(f"{self.name}_timeouts")
+        raise TimeoutError(f"Timed out after {self.timeout}s waiting for an identical in-flight request")
+
+    def stream(self, key, fn, replay, *args, **kwargs):
+        """
+        do() for executions that report progress. fn(publish, *args, **kwargs) calls publish(item) as it goes,
+        and every caller sharing the execution gets all items from the first one on. fn's return value is
+        the result do() callers with the same key receive.
+
+        The execution runs on its own thread, so it finishes and can fill caches even when the caller that
+        started it stops reading. A caller joining a do() execution, which publishes nothing, gets
+        replay(result) instead. timeout bounds the wait between two items.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call(streamed=True)
+                self.leaders += 1
+            else:
+                self.collapsed += 1
+
+        if leader:
+            threading.Thread(target=propagate_context(self._produce), args=(key, call, fn, args, kwargs),
+                             daemon=True).start()
+        else:
+            metrics.increment(f"{self.name}_collapsed")
+            if call.events is None:
+                yield from replay(self._wait(call))
+                return
+
+        index = 0
+        while True:
+            with call.changed:
+                deadline = time.monotonic() + self.timeout
+                while index == len(call.events) and not call.done.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timed_out()
+                    call.changed.wait(remaining)
+                items = call.events[index:]
+                finished = call.done.is_set()
+            yield from items
+            index += len(items)
+            if finished and index == len(call.events):
+                break
+        if call.error is not None:
+            raise call.error
+
+    def _produce(self, key, call, fn, args, kwargs):
+        def publish(item):
+            with call.changed:
+                call.events.append(item)
+                call.changed.notify_all()
+
+        try:
+            call.result = fn(publish, *args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            self.errors += 1
+            metrics.increment(f"{self.name}_errors")
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            with call.changed:
+                call.done.set()
+                call.changed.notify_all()
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "collapsed": self.collapsed,
+                "timeouts": self.timeouts, "errors": self.errors}
+
+
+class _EventLog:
+    # Items published by an AsyncSingleFlight.stream() execution
+    def __init__(self):
+        self.events = []
+        self.changed = asyncio.Event()
+
+    def publish(self, item):
+        self.events.append(item)
+        self.notify()
+
+    def notify(self):
+        # Wakes the current waiters; later waiters wait on a fresh event
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop, used by the async search service.
+    """
+
+    def __init__(self, name, timeout=singleflight_timeout):
+        self.name = name
+        self.timeout = timeout
+        self._calls = {}
+        self._logs = {}
+        self.leaders = 0
+        self.collapsed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        future = self._calls.get(key)
+        if future is not None:
+            self.collapsed += 1
+            metrics.increment(f"{self.name}_collapsed")
+            return await self._wait(future)
+
+        self.leaders += 1
+        future = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+        future.add_done_callback(lambda done: self._finish(key, done))
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            if future.done() and not future.cancelled():
+                self.errors += 1
+                metrics.increment(f"{self.name}_errors")
+            raise
+
+    async def _wait(self, future):
+        try:
+            # shield: a waiter giving up or being cancelled must not cancel the shared execution
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self._timed_out()
+
+    def _timed_out(self):
+        self.timeouts += 1
+        metrics.increment(f"{self.name}_timeouts")
+        raise TimeoutError(f"Timed out after {self.timeout}s waiting for an identical in-flight request")
+
+    async def stream(self, key, fn, replay, *args, **kwargs):
+        """
+        SingleFlight.stream for coroutines: fn(publish, *args, **kwargs) is awaited as a task shared by every
+        caller with the same key, and each caller gets all published items. The task keeps running when a
+        caller goes away.
+        """
+        future = self._calls.get(key)
+        if future is None:
+            self.leaders += 1
+            log = self._logs[key] = _EventLog()
+            future = self._calls[key] = asyncio.ensure_future(fn(log.publish, *args, **kwargs))
+            future.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            self.collapsed += 1
+            metrics.increment(f"{self.name}_collapsed")
+            log = self._logs.get(key)
+            if log is None:
+                for item in replay(await self._wait(future)):
+                    yield item
+                return
+
+        index = 0
+        while True:
+            while index < len(log.events):
+                index += 1
+                yield log.events[index - 1]
+            if future.done():
+                break
+            try:
+                await asyncio.wait_for(log.changed.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                self._timed_out()
+        # Raises the execution's exception, if any
+        future.result()
+
+    def _finish(self, key, future):
+        self._calls.pop(key, None)
+        log = self._logs.pop(key, None)
+        if log is not None:
+            log.notify()
+            if not future.cancelled() and future.exception() is not None:
+                self.errors += 1
+                metrics.increment(f"{self.name}_errors")
+        # Mark the exception as retrieved in case the leader was cancelled and nobody awaited it
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self):
+        return {"in_flight": len(self._calls), "leaders": self.leaders, "collapsed": self.collapsed,
+                "timeouts": self.timeouts, "errors": self.errors}
+
+
+_search_flights = SingleFlight("search_singleflight")
+
+
+def get_search_flights():
+    # Process-wide coalescing of identical searches across Streamlit sessions
+    return _search_flights
+
+
+def search_flight_stats():
+    return _search_flights.stats()
@@ -0,0 +1,243 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from elasticsearch import helpers
+
+from utils.metrics_helper import logger, span
+from variables import byom_index_name, local_vector_dims, local_vector_index_path, ivf_nlist, ivf_nprobe
+
+# Snapshot layout, all files sharing one path prefix:
+#   <prefix>.vectors.f32   float32 passage vectors, one row per passage (memory-mapped)
+#   <prefix>.rows.i32      int32 pairs (document ordinal, passage index) for every vector row
+#   <prefix>.meta.json     document ids by ordinal, deleted ordinals, dims and the refresh watermark
+#   <prefix>.ivf.npz       optional IVF centroids and row assignments
+
+
+def _paths(prefix):
+    return {
+        "vectors": f"{prefix}.vectors.f32",
+        "rows": f"{prefix}.rows.i32",
+        "meta": f"{prefix}.meta.json",
+        "ivf": f"{prefix}.ivf.npz",
+    }
+
+
+def _scan_passage_vectors(es, index, query=None, batch_size=500):
+    # Yields (doc id, last_crawled_at, [passage vectors]) for every document matching the query
+    for hit in helpers.scan(es, index=index, query={"query": query or {"match_all": {}}}, size=batch_size,
+                            _source=["id", "last_crawled_at", "passages.vector.predicted_value"]):
+        source = hit["_source"]
+        vectors = [passage.get("vector", {}).get("predicted_value") for passage in source.get("passages", [])]
+        yield hit["_id"], source.get("last_crawled_at"), vectors
+
+
+def _append_documents(es, index, prefix, meta, query, batch_size):
+    paths = _paths(prefix)
+    ordinals = {doc_id: ordinal for ordinal, doc_id in enumerate(meta["doc_ids"])}
+    deleted = set(meta["deleted"])
+    appended = 0
+
+    with open(paths["vectors"], "ab") as vector_file, open(paths["rows"], "ab") as row_file:
+        for doc_id, last_crawled_at, vectors in _scan_passage_vectors(es, index, query, batch_size):
+            # A re-crawled document gets a new ordinal; the rows of its old version are masked out
+            if doc_id in ordinals:
+                deleted.add(ordinals[doc_id])
+            ordinal = len(meta["doc_ids"])
+            meta["doc_ids"].append(doc_id)
+            ordinals[doc_id] = ordinal
+
+            rows = [(ordinal, passage_idx) for passage_idx, vector in enumerate(vectors)
+                    if vector and len(vector) == meta["dims"]]
+            if rows:
+                matrix = np.asarray([vectors[passage_idx] for _, passage_idx in rows], dtype=np.float32)
+                vector_file.write(matrix.tobytes())
+                row_file.write(np.asarray(rows, dtype=np.int32).tobytes())
+                appended += len(rows)
+
+            if last_crawled_at and (meta["watermark"] is None or last_crawled_at > meta["watermark"]):
+                meta["watermark"] = last_crawled_at
+
+    meta["deleted"] = sorted(deleted)
+    meta["count"] += appended
+    meta["updated_at"] = time.time()
+    with open(paths["meta"] + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(paths["meta"] + ".tmp", paths["meta"])
+    return appended
+
+
+def export_snapshot(es, prefix=local_vector_index_path, index=byom_index_name, dims=local_vector_dims,
+                    batch_size=500):
+    """
+    Scrolls the whole index and writes every passage vector to a fresh memory-mappable snapshot.
+
+    Returns:
+    - The number of passage vectors written.
+    """
+    paths = _paths(prefix)
+    directory = os.path.dirname(prefix)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    for path in paths.values():
+        if os.path.exists(path):
+            os.remove(path)
+
+    meta = {"index": index, "dims": dims, "count": 0, "doc_ids": [], "deleted": [], "watermark": None}
+    return _append_documents(es, index, prefix, meta, None, batch_size)
+
+
+def refresh_snapshot(es, prefix=local_vector_index_path, batch_size=500):
+    """
+    Incrementally refreshes a snapshot with documents crawled at or after its watermark. Changed documents
+    are appended and their previous rows masked; removed documents are only dropped by a full export.
+
+    Returns:
+    - The number of passage vectors appended.
+    """
+    with open(_paths(prefix)["meta"]) as f:
+        meta = json.load(f)
+    # gte: documents crawled in the same batch as the watermark document may not have been indexed yet at the
+    # last refresh; the ones already in the snapshot are appended again and their previous rows masked
+    query = {"range": {"last_crawled_at": {"gte": meta["watermark"]}}} if meta["watermark"] else None
+    appended = _append_documents(es, meta["index"], prefix, meta, query, batch_size)
+    # Existing IVF assignments do not cover the new rows
+    if appended and os.path.exists(_paths(prefix)["ivf"]):
+        os.remove(_paths(prefix)["ivf"])
+    return appended
+
+
+def build_ivf(prefix=local_vector_index_path, nlist=ivf_nlist, iterations=10, sample_size=50000, seed=0):
+    """
+    Builds an inverted file index over the snapshot: k-means centroids on a sample of the vectors
+    and the nearest centroid of every row. Searches then only score the rows of the closest lists.
+
+    Returns:
+    - The number of lists built; 0 for an empty snapshot, which is left to the flat scan.
+    """
+    index = LocalVectorIndex(prefix)
+    vectors = index.vectors
+    if not len(vectors):
+        logger.warning("Snapshot %s is empty, skipping the IVF index", prefix)
+        if os.path.exists(_paths(prefix)["ivf"]):
+            os.remove(_paths(prefix)["ivf"])
+        return 0
+    rng = np.random.default_rng(seed)
+
+    sample = vectors[rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)]
+    nlist = max(1, min(nlist, len(sample)))
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assignments == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), 65536):
+        assignments[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+
+    np.savez(_paths(prefix)["ivf"], centroids=centroids, assignments=assignments)
+    return nlist
+
+
+def snapshot_version(prefix):
+    # Modification times of the metadata and IVF files; build_ivf only writes the latter
+    paths = _paths(prefix)
+    ivf_mtime = os.path.getmtime(paths["ivf"]) if os.path.exists(paths["ivf"]) else None
+    return os.path.getmtime(paths["meta"]), ivf_mtime
+
+
+class LocalVectorIndex:
+    """
+    In-process kNN over a passage vector snapshot. Brute force is a single vectorized dot product
+    over the memory-mapped matrix; with an IVF file present, only the nprobe closest lists are scored.
+    """
+
+    def __init__(self, prefix=local_vector_index_path):
+        paths = _paths(prefix)
+        with open(paths["meta"]) as f:
+            self.meta = json.load(f)
+        self.prefix = prefix
+        self.version = snapshot_version(prefix)
+        count, dims = self.meta["count"], self.meta["dims"]
+        self.vectors = np.memmap(paths["vectors"], dtype=np.float32, mode="r", shape=(count, dims)) if count \
+            else np.zeros((0, dims), dtype=np.float32)
+        self.rows = np.memmap(paths["rows"], dtype=np.int32, mode="r", shape=(count, 2)) if count \
+            else np.zeros((0, 2), dtype=np.int32)
+        self.doc_ids = self.meta["doc_ids"]
+        self.live = np.ones(len(self.doc_ids), dtype=bool)
+        self.live[self.meta["deleted"]] = False
+
+        self.centroids = None
+        self.lists = None
+        if os.path.exists(paths["ivf"]):
+            ivf = np.load(paths["ivf"])
+            self.centroids = ivf["centroids"]
+            assignments = ivf["assignments"]
+            order = np.argsort(assignments, kind="stable")
+            bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+            self.lists = [order[bounds[c]:bounds[c + 1]] for c in range(len(self.centroids))]
+
+    def _candidate_rows(self, query, nprobe):
+        if self.centroids is None:
+            return None
+        closest = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.concatenate([self.lists[c] for c in closest])
+
+    def search(self, query_vector, size=5, nprobe=ivf_nprobe, passages_per_doc=1):
+        """
+        Returns the best documents for a query vector.
+
+        Returns:
+        - A list of (doc id, score, [passage indexes]) tuples, best first. The score is the best
+          passage dot product, the same similarity the mapping uses.
+        """
+        if not len(self.vectors):
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        candidates = self._candidate_rows(query, nprobe)
+        if candidates is None:
+            scores = self.vectors @ query
+            row_ids = np.arange(len(scores))
+        else:
+            scores = self.vectors[candidates] @ query
+            row_ids = candidates
+
+        # Drop rows of documents that were superseded by a refresh
+        live = self.live[self.rows[row_ids, 0]]
+        scores, row_ids = scores[live], row_ids[live]
+
+        # Enough top passages to cover size documents even when several passages share a document
+        take = min(len(scores), size * passages_per_doc * 8)
+        top = np.argpartition(-scores, take - 1)[:take] if take < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        results = {}
+        for position in top:
+            ordinal, passage_idx = self.rows[row_ids[position]]
+            doc_id = self.doc_ids[ordinal]
+            entry = results.setdefault(doc_id, [float(scores[position]), []])
+            if len(entry[1]) < passages_per_doc:
+                entry[1].append(int(passage_idx))
+
+        ranked = sorted(results.items(), key=lambda item: -item[1][0])[:size]
+        return [(doc_id, score, passages) for doc_id, (score, passages) in ranked]
+
+
+_local_index = None
+_local_index_lock = threading.Lock()
+
+
+def get_local_vector_index(prefix=local_vector_index_path):
+    # Process-wide snapshot, reloaded when a refresh rewrote the metadata or the IVF file changed
+    global _local_index
+    with _local_index_lock:
+        if _local_index is None or _local_index.prefix != prefix or snapshot_version(prefix) != _local_index.version:
+            with span("local_vector_index_load"):
+                _local_index = LocalVectorIndex(prefix)
+            logger.info("Loaded local vector index %s with %d passages", prefix, _local_index.meta["count"])
+    return _local_index
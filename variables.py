@@ -7,9 +7,88 @@ openai_completion_deployment_name = "gpt-4-32k"
 byom_index_name = 'cisco-search-blogs-byom'
 number_of_dims = 768
 similarity = "cosine"
-rate_throttle = .2
 deleteExistingIndex = True
 model='sentence-transformers__all-minilm-l6-v2'
 elser_model=".elser_model_1"
 vector_embedding_field = "text_embedding.predicted_value"
 elser_embedding_field = "ml.tokens"
+openai_summary_concurrency = 5  # max in-flight per-hit summary completions
+openai_retry_attempts = 3
+openai_backoff_base = 1  # seconds, doubled on each rate limited retry
+openai_backoff_max = 16  # seconds
+embedding_cache_max_entries = 2048
+embedding_cache_ttl = 24 * 3600  # seconds
+embedding_cache_path = None  # e.g. ".cache/embeddings.sqlite" to keep query embeddings across restarts
+openai_summary_deployment_name = "gpt-35-turbo"
+answer_cache_max_entries = 5000
+answer_cache_ttl = 7 * 24 * 3600  # seconds
+answer_cache_path = ".cache/answers.sqlite"  # set to None to keep answers in memory only
+es_connections_per_node = 20
+es_request_timeout = 30  # seconds
+es_max_retries = 3
+es_retry_on_timeout = True
+openai_max_connections = 20
+openai_max_keepalive_connections = 10
+openai_request_timeout = 60  # seconds
+openai_max_retries = 2  # retries of connection errors, timeouts and 5xx responses
+chat_history_token_budget = 24000  # prompt budget for the 32k chat deployment, leaves room for the answer
+chat_context_token_budget = 16000  # cap for the pinned retrieved content
+chat_summary_token_budget = 500  # allowance for the rolling summary of older turns
+chat_timings_max_entries = 50  # per-turn timings kept in a chatbot session
+rag_top_n_docs = 3  # documents passages are drawn from for chat context
+rag_passages_per_doc = 5  # matched passages requested per document via inner_hits
+rag_context_token_budget = 3000  # tokens of passage text packed into the chat context
+elser_passage_model = ".elser_model_2_linux-x86_64"
+passage_model_limit = 400  # max passage length in characters, same as the chunker pipeline's model_limit
+ingest_inference_batch_size = 32  # passages per infer_trained_model call
+ingest_docs_per_batch = 10  # documents whose passages are embedded together
+ingest_thread_count = 4
+ingest_chunk_size = 50  # documents per bulk request
+rrf_mode = "server"  # "client" runs "Reciprocal Rank Fusion" through the client-side hybrid engine
+hybrid_fusion = "rrf"  # "rrf" or "weighted"
+hybrid_weights = {"bm25": 1.0, "knn": 1.0, "elser": 1.0}  # used by weighted fusion
+batch_msearch_chunk_size = 20  # searches per _msearch request in batch_search
+batch_max_in_flight = 4  # concurrent _msearch requests in batch_search
+log_level = "INFO"  # DEBUG dumps queries, vectors and prompts; overridable with CISCOBLOGSEARCH_LOG_LEVEL
+trace_log_path = None  # e.g. ".cache/traces.jsonl" to export every span as a JSON line
+metrics_port = None  # e.g. 9464 to serve Prometheus metrics on /metrics
+result_cache_max_entries = 256  # complete search results (hits + AI summaries)
+result_cache_max_bytes = 64 * 1024 * 1024  # approximate memory bound for the result cache
+result_cache_ttl = 3600  # seconds
+index_generation_check_interval = 60  # seconds between checks of the index's doc count / max last_crawled_at
+local_vector_index_path = ".cache/passage_vectors"  # prefix of the memory-mapped passage vector snapshot
+local_vector_dims = 384  # passages.vector.predicted_value dims (MiniLM-L6)
+ivf_nlist = 256  # IVF lists built by build_ivf
+ivf_nprobe = 8  # IVF lists scored per query
+byom_int8_index_name = 'cisco-search-blogs-byom-int8'  # int8_hnsw copy of byom_index_name for "Vector Quantized"
+quantized_rescore_oversample = 4  # candidates per requested hit re-scored against the float vectors
+knn_settings_path = "knn_settings.json"  # tuned k/num_candidates written by benchmarks/knn_sweep.py
+byom_mapping_path = "additional_es_assets/cisco-search-blogs-byom.mapping"  # mappings for versioned byom indices
+index_versions_to_keep = 2  # versioned indices kept behind an alias for rollback, including the live one
+passage_fingerprint_path = ".cache/passage_inference.sqlite"  # inference results per (model id, passage hash); None = memory only
+passage_fingerprint_memory_entries = 20000  # fingerprints kept in memory in front of the SQLite store
+passage_fingerprint_max_entries = 500000  # rows kept in the SQLite store before the least recently used are evicted
+search_service_url = None  # e.g. "http://localhost:8080"; the Streamlit apps call cisco-search-service.py when set
+search_service_host = "0.0.0.0"
+search_service_port = 8080
+search_service_workers = 1  # worker processes; more than one shares the port with SO_REUSEPORT
+search_service_max_in_flight = 32  # requests handled concurrently per worker
+search_service_max_queue = 64  # requests waiting per worker before new ones get 503 + Retry-After
+search_service_retry_after = 1  # seconds
+search_service_timeout = 120  # client-side timeout for service calls, seconds
+singleflight_timeout = 90  # seconds a search waits on an identical in-flight one before giving up
+openai_rate_limits = {  # per deployment quota: requests and tokens (prompt + completion) per minute
+    "gpt-4-32k": {"rpm": 60, "tpm": 80000},
+    "gpt-35-turbo": {"rpm": 300, "tpm": 120000},
+    "gpt-35-turbo-16k": {"rpm": 300, "tpm": 120000},
+}
+openai_default_rpm = 300  # requests per minute for deployments without an entry in openai_rate_limits
+openai_default_tpm = 60000  # tokens per minute for deployments without an entry in openai_rate_limits
+openai_expected_completion_tokens = 300  # completion allowance when a request sets no max_tokens
+openai_queue_timeout = 120  # seconds a request waits for rate limit capacity before giving up
+progressive_results = True  # blog search renders hits as soon as ES returns and fills in summaries as they finish
+summary_mode = "per_hit"  # "batched" summarizes all top hits in one JSON completion, falling back to per-hit calls
+batched_summary_doc_tokens = 300  # best matching passage tokens sent per document in batched mode
+batched_summary_completion_tokens = 80  # completion allowance per document in batched mode
+document_store_max_entries = 20000  # retrieved document sections shared by all chat sessions in the process
+document_store_max_bytes = 128 * 1024 * 1024  # memory bound for the document store; least recently used are evicted